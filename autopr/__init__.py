@@ -1,23 +1,60 @@
+import functools
 import os
-import time
+from collections import Counter
 from pathlib import Path
-from typing import Iterator, List, Optional, TextIO
+from typing import TYPE_CHECKING, Any, Iterator, List, Optional, TextIO, Union
 
 import click
-from single_source import get_version
 
-from autopr import config, database, github, repo, workdir
+# PyGithub, requests, marshmallow and yaml take most of the start-up time,
+# so they are only imported by the commands that need them
+from autopr import (
+    concurrency,
+    database,
+    logs,
+    patches,
+    pipeline,
+    ratelimit,
+    repo,
+    ssh,
+    storage,
+    workdir,
+)
 from autopr.util import CliException, error, is_debug, set_debug
 
-__version__ = get_version(
-    "auto-pr",
-    Path(__file__).parent.parent,
-)
+if TYPE_CHECKING:
+    from autopr import config, github, httpcache
 
 DEFAULT_PUSH_DELAY = 30.0
 WORKDIR: workdir.WorkDir
 
 
+@functools.lru_cache(maxsize=None)
+def _get_version() -> str:
+    from importlib import metadata
+
+    try:
+        return metadata.version("auto-pr")
+    except metadata.PackageNotFoundError:
+        # running from a source checkout, read it from pyproject.toml
+        from single_source import get_version
+
+        return get_version("auto-pr", Path(__file__).parent.parent) or "unknown"
+
+
+def __getattr__(name: str) -> Any:
+    if name == "__version__":
+        return _get_version()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _print_version(ctx: click.Context, param: click.Parameter, value: bool):
+    if not value or ctx.resilient_parsing:
+        return
+    click.echo(f"{ctx.find_root().info_name}: {_get_version()}")
+    ctx.exit()
+
+
 def main():
     try:
         cli()
@@ -31,7 +68,39 @@ def main():
         error("Aborted.")
 
 
-def _ensure_set_up(cfg: config.Config, db: database.Database):
+def _create_github_client(api_key: str):
+    from autopr import github, httpcache
+
+    cache = httpcache.HttpCache(WORKDIR.http_cache_dir)
+    click.get_current_context().call_on_close(lambda: _report_http_cache(cache))
+    return github.create_github_client(api_key, cache=cache)
+
+
+def _report_http_cache(cache: "httpcache.HttpCache"):
+    stats = cache.stats
+    if stats.hits + stats.misses > 0:
+        click.secho(
+            f"HTTP cache: {stats.hits} hits, {stats.misses} misses, "
+            f"{stats.evictions} evictions"
+        )
+
+
+class _ProcessCount(click.ParamType):
+    name = "count|auto"
+
+    def convert(self, value, param, ctx):
+        if value == concurrency.AUTO or isinstance(value, int):
+            return value
+        try:
+            count = int(value)
+        except ValueError:
+            count = 0
+        if count < 1:
+            self.fail(f"{value!r} is neither a positive number nor 'auto'", param, ctx)
+        return count
+
+
+def _ensure_set_up(cfg: "config.Config", db: database.Database):
     if db.needs_pulling():
         raise CliException("No data found. Please run 'pull' first.")
 
@@ -65,12 +134,46 @@ def _ensure_set_up(cfg: config.Config, db: database.Database):
     is_flag=True,
     help="Whether to enable debug mode or not",
 )
-@click.version_option(__version__, message="%(prog)s: %(version)s")
-def cli(wd_path: str, repos_dir_path: Optional[str], debug: bool):
+@click.option(
+    "--git-backend",
+    envvar="APR_GIT_BACKEND",
+    type=click.Choice(repo.GIT_BACKENDS),
+    default=repo.GIT_BACKEND_CLI,
+    help="How to run local git operations, 'libgit2' runs them in-process and needs pygit2",
+)
+@click.option(
+    "--ssh-multiplexing/--no-ssh-multiplexing",
+    envvar="APR_SSH_MULTIPLEXING",
+    default=True,
+    help="Whether git commands share a few persistent SSH connections",
+)
+@click.option(
+    "--version",
+    is_flag=True,
+    expose_value=False,
+    is_eager=True,
+    callback=_print_version,
+    help="Show the version and exit.",
+)
+def cli(
+    wd_path: str,
+    repos_dir_path: Optional[str],
+    debug: bool,
+    git_backend: str,
+    ssh_multiplexing: bool,
+):
     global WORKDIR
     custom_repos = Path(repos_dir_path) if repos_dir_path else None
     WORKDIR = workdir.get(wd_path, custom_repos_dir=custom_repos)
     set_debug(debug)
+    repo.set_git_backend(git_backend)
+    logs.start(WORKDIR.logs_dir)
+    click.get_current_context().call_on_close(logs.stop)
+
+    if ssh_multiplexing:
+        # connections are only opened by the commands talking to the remotes
+        ssh.start(WORKDIR.ssh_dir)
+        click.get_current_context().call_on_close(ssh.stop)
 
 
 @cli.command()
@@ -93,6 +196,8 @@ def cli(wd_path: str, repos_dir_path: Optional[str], debug: bool):
 )
 def init(api_key: str, ssh_key_file: str):
     """Initialise configuration and database"""
+    from autopr import config
+
     credentials = config.Credentials(api_key=api_key, ssh_key_file=ssh_key_file)
     workdir.init(WORKDIR, credentials)
 
@@ -113,9 +218,15 @@ def init(api_key: str, ssh_key_file: str):
 @click.option(
     "--process-count",
     "-j",
-    default=os.cpu_count() or 1,
-    type=int,
-    help="How many repositories to pull in parallel",
+    default=str(os.cpu_count() or 1),
+    type=_ProcessCount(),
+    help="How many repositories to pull in parallel, 'auto' adapts it to the observed throughput, errors and throttling",
+)
+@click.option(
+    "--max-process-count",
+    type=click.IntRange(min=1),
+    default=None,
+    help=f"Upper limit of repositories to pull in parallel, defaults to {concurrency.DEFAULT_MAX_CONCURRENCY} with '-j auto'",
 )
 @click.option(
     "--use-global-git-config/--use-primary-email-git-config",
@@ -123,15 +234,34 @@ def init(api_key: str, ssh_key_file: str):
     is_flag=True,
     help="Whether to use the already globally set git config or the primary email of the authenticated Github user. If you have already pulled the repos locally, you also need to pass --update-repos to update the git config in the repos.",
 )
+@click.option(
+    "--skip-unchanged/--no-skip-unchanged",
+    default=True,
+    is_flag=True,
+    help="Whether to skip updating repositories whose default branch on GitHub did not move since they were last pulled",
+)
+@click.option(
+    "--echo-output/--no-echo-output",
+    envvar="APR_ECHO_OUTPUT",
+    default=False,
+    help="Whether to also print the output of every command as it runs, it is always written to the logs directory of the workdir",
+)
 def pull(
     fetch_repo_list: bool,
     update_repos: bool,
-    process_count: int,
+    process_count: Union[int, str],
+    max_process_count: Optional[int],
     use_global_git_config: bool,
+    skip_unchanged: bool,
+    echo_output: bool,
 ):
     """Pull down repositories based on configuration"""
+    from autopr import github
+
+    logs.start(WORKDIR.logs_dir, echo=echo_output)
+
     cfg = workdir.read_config(WORKDIR)
-    gh = github.create_github_client(cfg.credentials.api_key)
+    gh = _create_github_client(cfg.credentials.api_key)
     user = github.get_user(gh, use_global_git_config)
 
     click.secho(f"Running under user '{user.name}' with email '{user.email}'")
@@ -148,20 +278,79 @@ def pull(
         db_new = database.Database(user=user, repositories=repositories)
         db_old.merge_into(db_new)
         workdir.write_database(WORKDIR, db_old)
+        # continue with the stored repositories, which know their last sync
+        repositories = [
+            db_old.get_repository(repository.owner, repository.name) or repository
+            for repository in repositories
+        ]
     else:
         click.secho("Not gathering repository list")
         repositories = db_old.repositories_to_process()
 
+    repos_dir = WORKDIR.repos_dir
+    options = repo.CloneOptions.from_config(cfg)
+    unchanged: List[database.Repository] = []
+    if update_repos and skip_unchanged:
+        click.secho("Checking which default branches moved...")
+        tips = github.get_default_branch_tips(gh, repositories)
+        moved = []
+        for repository in repositories:
+            if repo.needs_sync(repos_dir, repository, tips.get(repository.full_name)):
+                moved.append(repository)
+            else:
+                unchanged.append(repository)
+        repositories = moved
+
+    def record_sync(result: repo.PullResult):
+        # persisted right away, so an interrupted pull resumes from here
+        if result.sha is None:
+            return
+        result.repository.synced_sha = result.sha
+        if result.outcome != repo.SyncOutcome.EXISTING:
+            result.repository.pull_duration = round(result.duration, 3)
+        workdir.update_repository(WORKDIR, db_old, result.repository)
+
+    limit: Union[concurrency.FixedConcurrency, concurrency.AdaptiveConcurrency]
+    if process_count == concurrency.AUTO:
+        limit = concurrency.AdaptiveConcurrency(
+            maximum=max_process_count or concurrency.DEFAULT_MAX_CONCURRENCY
+        )
+    else:
+        limit = concurrency.FixedConcurrency(
+            min(int(process_count), max_process_count or int(process_count))
+        )
+
     # pull all repositories
     click.secho("Pulling repositories...")
-    repo.pull_repositories_parallel(
+    outcomes = repo.pull_repositories_parallel(
         user,
         Path(cfg.credentials.ssh_key_file),
-        WORKDIR.repos_dir,
+        repos_dir,
         repositories,
         update_repos,
-        process_count,
+        limit.maximum,
+        options,
+        on_result=record_sync,
+        concurrency=limit,
     )
+    if len(unchanged) > 0:
+        # the git identity and checkout options may have changed since
+        failed = repo.configure_repositories(
+            user,
+            Path(cfg.credentials.ssh_key_file),
+            repos_dir,
+            unchanged,
+            limit.maximum,
+            options,
+        )
+        outcomes[repo.SyncOutcome.UNCHANGED] += len(unchanged) - failed
+        outcomes[repo.SyncOutcome.FAILED] += failed
+    _print_pull_summary(outcomes)
+    if isinstance(limit, concurrency.AdaptiveConcurrency):
+        click.secho(
+            f"Settled on pulling {limit.limit} repositories in parallel "
+            f"(at most {limit.peak})"
+        )
 
 
 @cli.command()
@@ -171,24 +360,137 @@ def pull(
     is_flag=True,
     help="Whether to pull repositories before testing",
 )
-def test(pull_repos: bool):
+@click.option(
+    "--skip-unchanged/--no-skip-unchanged",
+    default=True,
+    is_flag=True,
+    help="Whether to skip repositories that had no changes on the last run with the same default branch and update command",
+)
+@click.option(
+    "--all",
+    "all_repos",
+    default=False,
+    is_flag=True,
+    help="Test all repositories without asking and write their diffs as patch files",
+)
+@click.option(
+    "--output-dir",
+    type=click.Path(file_okay=False, dir_okay=True, writable=True),
+    default=None,
+    help="Where --all writes the patch files and their index, defaults to patches/ within the workdir",
+)
+@click.option(
+    "--process-count",
+    "-j",
+    type=click.IntRange(min=1),
+    default=os.cpu_count() or 1,
+    help="How many repositories --all tests in parallel",
+)
+@click.option(
+    "--prefetch",
+    type=click.IntRange(min=0),
+    default=pipeline.DEFAULT_PREFETCH,
+    help="How many of the next repositories to prepare in the background while a diff is shown",
+)
+def test(
+    pull_repos: bool,
+    skip_unchanged: bool,
+    all_repos: bool,
+    output_dir: Optional[str],
+    process_count: int,
+    prefetch: int,
+):
     """Check what expected diff will be for command execution"""
     cfg = workdir.read_config(WORKDIR)
     db = workdir.read_database(WORKDIR)
     _ensure_set_up(cfg, db)
 
-    for repository in db.repositories_to_process():
-        try:
-            repo.reset_and_run_script(repository, db, cfg, WORKDIR, pull_repos)
-            diff = repo.get_diff(WORKDIR.repos_dir, repository)
-            click.secho(f"Diff for repository '{repository.name}':\n{diff}")
-        except CliException as e:
-            error(f"Error: {e}")
-
-        if not click.confirm("Continue?"):
-            return
+    if all_repos:
+        _test_all(cfg, db, pull_repos, skip_unchanged, output_dir, process_count)
+        return
+    if output_dir is not None:
+        raise CliException("--output-dir is only used together with --all")
+
+    inputs = repo.get_update_command_fingerprint(cfg, WORKDIR.repos_dir)
+    skipped = 0
+    results = pipeline.prefetch_tests(
+        db.repositories_to_process(),
+        db,
+        cfg,
+        WORKDIR,
+        pull_repos,
+        inputs if skip_unchanged else None,
+        prefetch,
+    )
+    try:
+        for result in results:
+            repository = result.repository
+            click.echo(result.output, nl=False)
+            if result.error is not None:
+                error(f"Error: {result.error}")
+            elif not result.ran:
+                click.secho(
+                    f"Skipping '{repository.name}', nothing changed since the last run"
+                )
+                skipped += 1
+                continue
+            else:
+                click.secho(f"Diff for repository '{repository.name}':\n{result.diff}")
+                repository.record_run(result.sha, inputs, result.diff != "")
+                workdir.update_repository(WORKDIR, db, repository)
+                # lets `run --from-patches` skip running the command again
+                if result.patch != "":
+                    patches.write_patch(
+                        WORKDIR.patches_dir,
+                        repository.name,
+                        result.patch,
+                        result.sha,
+                        inputs,
+                    )
+                else:
+                    patches.remove_patch(WORKDIR.patches_dir, repository.name)
+
+            if not click.confirm("Continue?"):
+                return
+
+            click.secho("\n")
+    finally:
+        results.close()
+        _print_skipped_unchanged(skipped)
+
+
+def _test_all(
+    cfg: "config.Config",
+    db: database.Database,
+    pull_repos: bool,
+    skip_unchanged: bool,
+    output_dir: Optional[str],
+    process_count: int,
+):
+    patches_dir = Path(output_dir) if output_dir else WORKDIR.patches_dir
+    summaries = pipeline.test_repositories(
+        db.repositories_to_process(),
+        db,
+        cfg,
+        WORKDIR,
+        pull_repos,
+        patches_dir,
+        process_count,
+        skip_unchanged,
+    )
 
-        click.secho("\n")
+    statuses = Counter(summary.status for summary in summaries)
+    click.secho(
+        f"Tested {len(summaries)} repositories: "
+        f"{statuses[patches.PatchStatus.CHANGED]} changed, "
+        f"{statuses[patches.PatchStatus.UNCHANGED]} unchanged, "
+        f"{statuses[patches.PatchStatus.SKIPPED]} skipped, "
+        f"{statuses[patches.PatchStatus.FAILED]} failed",
+        bold=True,
+    )
+    click.secho(
+        f"Patches and their index ({patches.INDEX_FILE_NAME}) are in {patches_dir}"
+    )
 
 
 @cli.command()
@@ -202,7 +504,25 @@ def test(pull_repos: bool):
     "--push-delay",
     type=click.FloatRange(min=0.0, max=None, clamp=True),
     default=DEFAULT_PUSH_DELAY,
-    help="Delay in seconds between pushing changes to repositories",
+    help="Average delay in seconds between pushing changes to repositories",
+)
+@click.option(
+    "--push-burst",
+    type=click.IntRange(min=1),
+    default=1,
+    help="How many pushes may happen at once before --push-delay applies",
+)
+@click.option(
+    "--max-prs-per-minute",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Upper limit of pull requests opened per minute",
+)
+@click.option(
+    "--max-prs-per-hour",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Upper limit of pull requests opened per hour",
 )
 @click.option(
     "--api-key",
@@ -211,34 +531,156 @@ def test(pull_repos: bool):
     hide_input=True,
     help="The GitHub API key to use if not statically configured",
 )
-def run(pull_repos: bool, push_delay: Optional[float], api_key: Optional[str]):
+@click.option(
+    "--sync-workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="How many repositories to pull in parallel",
+)
+@click.option(
+    "--transform-workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="How many update commands to run in parallel",
+)
+@click.option(
+    "--commit-workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="How many repositories to diff and commit in parallel",
+)
+@click.option(
+    "--push-workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="How many repositories to push in parallel",
+)
+@click.option(
+    "--pr-workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="How many pull requests to open in parallel",
+)
+@click.option(
+    "--skip-unchanged/--no-skip-unchanged",
+    default=True,
+    is_flag=True,
+    help="Whether to skip repositories that had no changes on the last run with the same default branch and update command",
+)
+@click.option(
+    "--queue-size",
+    type=click.IntRange(min=1),
+    default=pipeline.DEFAULT_QUEUE_SIZE,
+    help="How many repositories may wait between two stages",
+)
+@click.option(
+    "--echo-output/--no-echo-output",
+    envvar="APR_ECHO_OUTPUT",
+    default=False,
+    help="Whether to also print the output of every command as it runs, it is always written to the logs directory of the workdir",
+)
+@click.option(
+    "--from-patches",
+    default=False,
+    is_flag=True,
+    help="Apply the patches saved by `test` instead of running the update command, for repositories whose default branch did not move since",
+)
+@click.option(
+    "--patches-dir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True),
+    default=None,
+    help="Where --from-patches reads the patches, defaults to patches/ within the workdir",
+)
+def run(
+    pull_repos: bool,
+    push_delay: Optional[float],
+    push_burst: int,
+    max_prs_per_minute: Optional[int],
+    max_prs_per_hour: Optional[int],
+    api_key: Optional[str],
+    sync_workers: int,
+    transform_workers: int,
+    commit_workers: int,
+    push_workers: int,
+    pr_workers: int,
+    queue_size: int,
+    skip_unchanged: bool,
+    echo_output: bool,
+    from_patches: bool,
+    patches_dir: Optional[str],
+):
     """Run update logic and create pull requests if changes made"""
+    from autopr import config
+
+    logs.start(WORKDIR.logs_dir, echo=echo_output)
     cfg = workdir.read_config(WORKDIR)
     if api_key is not None:
         cfg.credentials.api_key = api_key
     db = workdir.read_database(WORKDIR)
     _ensure_set_up(cfg, db)
-    gh = github.create_github_client(cfg.credentials.api_key)
-
-    repositories = db.repositories_to_process()
-
-    change_pushed = False
-    for i, repository in enumerate(repositories, start=1):
-        if change_pushed and push_delay is not None:
-            click.secho(f"Sleeping for {push_delay} seconds...")
-            time.sleep(push_delay)
+    gh = _create_github_client(cfg.credentials.api_key)
+
+    workers = pipeline.StageWorkers(
+        sync=sync_workers,
+        transform=transform_workers,
+        commit=commit_workers,
+        push=push_workers,
+        pr=pr_workers,
+    )
+    push_limiter = ratelimit.create_limiter(
+        "push", min_interval=push_delay, burst=push_burst
+    )
+    pr_limiter = ratelimit.create_limiter(
+        "pull request", per_minute=max_prs_per_minute, per_hour=max_prs_per_hour
+    )
+    summary = pipeline.run_repositories(
+        db.repositories_to_process(),
+        db,
+        cfg,
+        gh,
+        WORKDIR,
+        pull_repos,
+        push_limiter,
+        pr_limiter,
+        workers,
+        queue_size,
+        skip_unchanged,
+        _patches_dir(from_patches, patches_dir),
+    )
 
+    click.secho(f"Done!", bold=True)
+    _print_skipped_unchanged(summary.skipped_unchanged)
+    if from_patches:
+        click.secho(
+            f"Applied {summary.applied_patches} saved patches, ran the update "
+            f"command again for {summary.outdated_patches} outdated ones"
+        )
+    if cfg.deduplicate:
         click.secho(
-            f"[{i}/{len(repositories)}] Updating '{repository.name}'", bold=True
+            f"Ran the update command {summary.update_command_runs} times, "
+            f"reused its changes for {summary.reused_results} repositories "
+            "with the same input"
         )
+    elif cfg.update_command_mode == config.UPDATE_COMMAND_MODE_BATCH:
+        click.secho(
+            f"Ran the update command {summary.update_command_runs} times "
+            f"in batches of up to {cfg.update_command_batch_size} repositories"
+        )
+    for limiter in (push_limiter, pr_limiter):
+        if limiter.waited > 0:
+            click.secho(
+                f"Waited {limiter.waited:.1f} seconds on the {limiter.name} limit"
+            )
 
-        try:
-            repo.reset_and_run_script(repository, db, cfg, WORKDIR, pull_repos)
-            change_pushed = repo.push_changes(repository, db, cfg, gh, WORKDIR)
-        except CliException as e:
-            error(f"Error: {e}")
 
-    click.secho(f"Done!", bold=True)
+def _patches_dir(from_patches: bool, patches_dir: Optional[str]) -> Optional[Path]:
+    if not from_patches:
+        if patches_dir is not None:
+            raise CliException(
+                "--patches-dir is only used together with --from-patches"
+            )
+        return None
+    return Path(patches_dir) if patches_dir else WORKDIR.patches_dir
 
 
 @cli.group()
@@ -267,6 +709,65 @@ def reset_from(file: TextIO):
     workdir.write_database(WORKDIR, db)
 
 
+@cli.group(name="db")
+def db_group():
+    """Commands for maintaining the database"""
+    pass
+
+
+@db_group.command()
+def compact():
+    """Fold all journaled updates into db.json"""
+    db = workdir.read_database(WORKDIR)
+    workdir.write_database(WORKDIR, db)
+    click.secho("Database compacted")
+
+
+@db_group.command(name="export")
+@click.argument("file", type=click.Path(dir_okay=False, writable=True))
+def db_export(file: str):
+    """Write the database to FILE in the db.json format"""
+    workdir.export_database(WORKDIR, Path(file))
+    click.secho(f"Database exported to {file}")
+
+
+@db_group.command(name="import")
+@click.argument("file", type=click.Path(exists=True, dir_okay=False, readable=True))
+def db_import(file: str):
+    """Replace the database with FILE in the db.json format"""
+    workdir.import_database(WORKDIR, Path(file))
+    click.secho(f"Database imported from {file}")
+
+
+@db_group.command(name="format")
+@click.argument(
+    "database_format",
+    type=click.Choice([storage.FORMAT_JSON, storage.FORMAT_BINARY]),
+)
+def db_format(database_format: str):
+    """Store the database of this workdir as JSON or in a compact binary format"""
+    workdir.convert_database(WORKDIR, database_format)
+    click.secho(f"Database stored as {database_format}")
+
+
+def _print_pull_summary(outcomes: Counter):
+    counts = [
+        f"{outcomes[outcome]} {outcome.value}"
+        for outcome in repo.SyncOutcome
+        if outcomes[outcome] > 0
+    ]
+    total = sum(outcomes.values())
+    click.secho(f"Pulled {total} repositories: {', '.join(counts) or 'none'}")
+
+
+def _print_skipped_unchanged(skipped: int):
+    if skipped > 0:
+        click.secho(
+            f"Skipped {skipped} repositories which had no changes on the last run "
+            "with the same default branch and update command"
+        )
+
+
 def _print_repository_list(
     title: str, repositories: List[database.Repository], total: int
 ):
@@ -289,29 +790,35 @@ def _print_repository_list(
     help="Whether the `Missing PRs` section should be excluded from status.",
 )
 def status(exclude_missing: bool):
-    cfg = workdir.read_config(WORKDIR)
     db = workdir.read_database(WORKDIR)
-    gh = github.create_github_client(cfg.credentials.api_key)
-
-    click.secho("Collecting data...")
-
     if len(db.repositories) == 0:
         error("No repositories in database.")
         return
 
+    from autopr import github
+
+    cfg = workdir.read_config(WORKDIR)
+    gh = _create_github_client(cfg.credentials.api_key)
+
+    click.secho("Collecting data...")
+
     pr_missing = []
     pr_merged = []
     pr_open = []
     pr_closed = []
 
+    pull_requests = github.get_pull_requests(gh, db.repositories)
+
     # group repositories by PR state
     for repository in db.repositories:
         if repository.existing_pr is None:
             pr_missing.append(repository)
             continue
 
-        pull_request = github.get_pull_request(gh, repository)
-        if pull_request.merged:
+        pull_request = pull_requests.get(repository.full_name)
+        if pull_request is None:
+            error(f"Pull request of {repository.name} not found")
+        elif pull_request.merged:
             pr_merged.append(repository)
         elif pull_request.state == github.PullRequestState.OPEN.value:
             pr_open.append(repository)
@@ -326,15 +833,28 @@ def status(exclude_missing: bool):
         _print_repository_list("Missing PRs", pr_missing, total)
 
 
-def _set_all_pull_requests_state(state: github.PullRequestState):
+def _set_all_pull_requests_state(state: "github.PullRequestState"):
+    from autopr import github
+
     cfg = workdir.read_config(WORKDIR)
     db = workdir.read_database(WORKDIR)
-    gh = github.create_github_client(cfg.credentials.api_key)
+    gh = _create_github_client(cfg.credentials.api_key)
+    pull_requests = github.get_pull_requests(gh, db.repositories)
 
     for repository in db.repositories:
         if repository.existing_pr is not None:
+            pull_request = pull_requests.get(repository.full_name)
+            # merged pull requests are closed too, set_pull_request_state
+            # tells about them
+            if (
+                pull_request is not None
+                and pull_request.state == state.value
+                and not pull_request.merged
+            ):
+                continue
+
             try:
-                github.set_pull_request_state(gh, repository, state)
+                github.set_pull_request_state(gh, repository, state, pull_request)
                 click.secho(
                     f"Updated {repository.name} pull request state to {state.value}"
                 )
@@ -345,6 +865,8 @@ def _set_all_pull_requests_state(state: github.PullRequestState):
 @cli.command()
 def close():
     """Close all open pull requests"""
+    from autopr import github
+
     _set_all_pull_requests_state(github.PullRequestState.CLOSED)
     click.secho("Finished closing all open pull requests")
 
@@ -352,6 +874,8 @@ def close():
 @cli.command()
 def reopen():
     """Reopen all un-merged pull requests"""
+    from autopr import github
+
     _set_all_pull_requests_state(github.PullRequestState.OPEN)
     click.secho("Finished reopening all closed unmerged pull requests")
 
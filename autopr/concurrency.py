@@ -0,0 +1,92 @@
+import time
+from typing import Callable
+
+from autopr import util
+
+AUTO = "auto"
+
+DEFAULT_MAX_CONCURRENCY = 32
+INITIAL_CONCURRENCY = 4
+
+# a round of measurements covers at least this many completed operations
+MIN_ROUND_SIZE = 4
+# share of failed operations in a round above which concurrency is halved
+MAX_ERROR_RATE = 0.2
+# throughput may fall this far below the best one seen and still grow
+THROUGHPUT_TOLERANCE = 0.9
+
+
+class FixedConcurrency:
+    """Always allows the same number of concurrent operations"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.maximum = limit
+
+    def record(self, failed: bool = False, throttled: bool = False) -> None:
+        pass
+
+
+class AdaptiveConcurrency:
+    """
+    Additive-increase/multiplicative-decrease controller for the number of
+    concurrent operations. After each round of completed operations the
+    throughput of the round is compared with the best one so far: the limit
+    grows by one while throughput keeps up, steps back by one once it drops
+    and is halved when the round saw throttling or too many failures.
+    """
+
+    def __init__(
+        self,
+        maximum: int = DEFAULT_MAX_CONCURRENCY,
+        minimum: int = 1,
+        initial: int = INITIAL_CONCURRENCY,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if minimum < 1 or maximum < minimum:
+            raise ValueError("concurrency limits must satisfy 1 <= minimum <= maximum")
+
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self.peak = self.limit
+        self._clock = clock
+        self._best_throughput = 0.0
+        self._start_round()
+
+    def _start_round(self) -> None:
+        self._round_start = self._clock()
+        self._completed = 0
+        self._failed = 0
+        self._throttled = False
+
+    def record(self, failed: bool = False, throttled: bool = False) -> None:
+        """Account for a completed operation and adapt the limit after a round"""
+        self._completed += 1
+        self._failed += 1 if failed else 0
+        self._throttled = self._throttled or throttled
+        if self._completed < max(self.limit, MIN_ROUND_SIZE):
+            return
+
+        elapsed = max(self._clock() - self._round_start, 1e-6)
+        throughput = self._completed / elapsed
+        previous = self.limit
+
+        if self._throttled or self._failed / self._completed > MAX_ERROR_RATE:
+            self.limit = max(self.minimum, self.limit // 2)
+            # measured again from scratch at the lower level
+            self._best_throughput = 0.0
+        elif throughput >= self._best_throughput * THROUGHPUT_TOLERANCE:
+            self._best_throughput = max(self._best_throughput, throughput)
+            self.limit = min(self.maximum, self.limit + 1)
+        else:
+            self.limit = max(self.minimum, self.limit - 1)
+
+        self.peak = max(self.peak, self.limit)
+        if self.limit != previous:
+            util.debug(
+                f"Concurrency {previous} -> {self.limit} "
+                f"({throughput:.2f}/s, {self._failed}/{self._completed} failed"
+                f"{', throttled' if self._throttled else ''})"
+            )
+        self._start_round()
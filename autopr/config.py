@@ -4,7 +4,14 @@ from dataclasses import dataclass, field
 from typing import Any, Dict, List, Optional
 
 import marshmallow_dataclass
-from marshmallow import Schema, fields, post_load
+from marshmallow import (
+    Schema,
+    ValidationError,
+    fields,
+    post_load,
+    validate,
+    validates_schema,
+)
 
 DEFAULT_PR_TITLE = "Automatically generated PR"
 DEFAULT_PR_MESSAGE = "Automatically generated commit"
@@ -17,6 +24,12 @@ FILTER_MODE_REMOVE = "remove"
 FILTER_VISIBILITY_PUBLIC = "public"
 FILTER_VISIBILITY_PRIVATE = "private"
 
+UPDATE_COMMAND_MODE_EACH = "each"  # once per repository, within its directory
+UPDATE_COMMAND_MODE_BATCH = "batch"  # once per chunk of repositories
+BATCH_INPUT_ARGUMENTS = "arguments"  # directories appended to the command
+BATCH_INPUT_MANIFEST = "manifest"  # file listing the directories appended
+DEFAULT_BATCH_SIZE = 50
+
 
 def expand_env_vars(value: str) -> str:
     """
@@ -104,6 +117,16 @@ class Config:
     repositories: List[Filter] = field(default_factory=list)  # is equal to assigning []
     update_command: List[str] = field(default_factory=list)
     custom_repos_dir: Optional[str] = None
+    mirror_dir: Optional[str] = None  # bare repositories shared by all clones
+    sparse_checkout: List[str] = field(default_factory=list)  # paths to check out
+    clone_filter: Optional[str] = None  # partial clone filter, e.g. 'blob:none'
+    skip_lfs_smudge: bool = False  # keep LFS pointer files instead of downloading
+    # run the update command once per distinct tree, or set of these paths
+    deduplicate: bool = False
+    deduplicate_paths: List[str] = field(default_factory=list)
+    update_command_mode: str = UPDATE_COMMAND_MODE_EACH
+    update_command_batch_size: int = DEFAULT_BATCH_SIZE
+    update_command_batch_input: str = BATCH_INPUT_ARGUMENTS
 
 
 class ConfigSchema(Schema):
@@ -112,12 +135,42 @@ class ConfigSchema(Schema):
     repositories = fields.List(fields.Nested(FILTERS_SCHEMA), load_default=list)
     update_command = fields.List(fields.Str(), load_default=list)
     custom_repos_dir = fields.Str(required=False, allow_none=True)
+    mirror_dir = fields.Str(required=False, allow_none=True)
+    sparse_checkout = fields.List(fields.Str(), load_default=list)
+    clone_filter = fields.Str(required=False, allow_none=True)
+    skip_lfs_smudge = fields.Bool(load_default=False)
+    deduplicate = fields.Bool(load_default=False)
+    deduplicate_paths = fields.List(fields.Str(), load_default=list)
+    update_command_mode = fields.Str(
+        load_default=UPDATE_COMMAND_MODE_EACH,
+        validate=validate.OneOf([UPDATE_COMMAND_MODE_EACH, UPDATE_COMMAND_MODE_BATCH]),
+    )
+    update_command_batch_size = fields.Int(
+        load_default=DEFAULT_BATCH_SIZE, validate=validate.Range(min=1)
+    )
+    update_command_batch_input = fields.Str(
+        load_default=BATCH_INPUT_ARGUMENTS,
+        validate=validate.OneOf([BATCH_INPUT_ARGUMENTS, BATCH_INPUT_MANIFEST]),
+    )
+
+    @validates_schema
+    def validate_update_command_mode(self, data: Dict[str, Any], **kwargs: Any):
+        # deduplicated runs wait for each other, which a batch still being
+        # collected by the same worker would never finish
+        if data.get("update_command_mode") == UPDATE_COMMAND_MODE_BATCH and data.get(
+            "deduplicate"
+        ):
+            raise ValidationError(
+                "deduplicate can not be combined with the batch update command mode",
+                "deduplicate",
+            )
 
     @post_load
     def expand_config_env_vars(self, data: Dict[str, Any], **kwargs: Any) -> Config:
-        """Expand environment variables in custom_repos_dir after loading."""
-        if "custom_repos_dir" in data and data["custom_repos_dir"] is not None:
-            data["custom_repos_dir"] = expand_env_vars(data["custom_repos_dir"])
+        """Expand environment variables in custom_repos_dir and mirror_dir after loading."""
+        for key in ("custom_repos_dir", "mirror_dir"):
+            if key in data and data[key] is not None:
+                data[key] = expand_env_vars(data[key])
         return Config(**data)
 
 
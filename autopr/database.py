@@ -1,7 +1,5 @@
-from dataclasses import dataclass, field
-from typing import Dict, Iterator, List, Optional
-
-import marshmallow_dataclass
+from dataclasses import MISSING, dataclass, field, fields
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type, get_type_hints
 
 
 @dataclass
@@ -13,13 +11,38 @@ class Repository:
     existing_pr: Optional[int] = None
     removed: bool = False  # true if the repo is not in the config's filters anymore, but still has a PR open
     done: bool = False  # true if a PR has been opened and 'reset' was not called
+    last_run_sha: Optional[
+        str
+    ] = None  # default branch HEAD the update command last ran against
+    last_run_inputs: Optional[
+        str
+    ] = None  # fingerprint of the update command and its script files
+    last_run_changed: Optional[bool] = None  # whether the last run produced changes
+    github_id: Optional[int] = None  # stays the same when the repo is renamed
+    synced_sha: Optional[str] = None  # default branch HEAD after the last pull
+    size: Optional[int] = None  # in kilobytes, as reported by GitHub
+    pull_duration: Optional[float] = None  # seconds the last pull took
 
     @property
     def full_name(self) -> str:
         return f"{self.owner}/{self.name}"
 
+    @property
+    def key(self) -> Tuple[str, str]:
+        return self.owner, self.name
+
+    def is_unchanged_since_last_run(self, sha: str, inputs: str) -> bool:
+        """True if the last run on the same inputs did not change anything"""
+        return (
+            self.last_run_changed is False
+            and self.last_run_sha == sha
+            and self.last_run_inputs == inputs
+        )
 
-repository_schema = marshmallow_dataclass.class_schema(Repository)()
+    def record_run(self, sha: Optional[str], inputs: str, changed: bool) -> None:
+        self.last_run_sha = sha
+        self.last_run_inputs = inputs
+        self.last_run_changed = changed
 
 
 @dataclass
@@ -28,9 +51,6 @@ class GitUser:
     email: str
 
 
-GIT_USER_SCHEMA = marshmallow_dataclass.class_schema(GitUser)()
-
-
 @dataclass
 class Database:
     user: Optional[GitUser] = None
@@ -38,6 +58,74 @@ class Database:
         default_factory=list
     )  # is equal to assigning []
 
+    def __post_init__(self):
+        self._reindex()
+
+    def _reindex(self) -> None:
+        self._by_key: Dict[Tuple[str, str], Repository] = {}
+        self._by_id: Dict[int, Repository] = {}
+        for repository in self.repositories:
+            self._by_key.setdefault(repository.key, repository)
+            if repository.github_id is not None:
+                self._by_id.setdefault(repository.github_id, repository)
+
+        # used to detect changes made to the list without going through upsert
+        self._indexed_list = self.repositories
+        self._indexed_length = len(self.repositories)
+
+    def _ensure_index(self) -> None:
+        if self._indexed_list is not self.repositories or self._indexed_length != len(
+            self.repositories
+        ):
+            self._reindex()
+
+    def get_repository(self, owner: str, name: str) -> Optional[Repository]:
+        self._ensure_index()
+        return self._by_key.get((owner, name))
+
+    def get_repository_by_id(self, github_id: int) -> Optional[Repository]:
+        self._ensure_index()
+        return self._by_id.get(github_id)
+
+    def upsert(self, repository: Repository) -> Repository:
+        """
+        Add the repository or refresh the metadata of the known one, matching
+        on the GitHub id first to follow renames. Returns the stored repository.
+        """
+        self._ensure_index()
+
+        existing = None
+        if repository.github_id is not None:
+            existing = self._by_id.get(repository.github_id)
+        if existing is None:
+            existing = self._by_key.get(repository.key)
+
+        if existing is None:
+            self.repositories.append(repository)
+            self._indexed_length += 1
+            self._by_key[repository.key] = repository
+            if repository.github_id is not None:
+                self._by_id[repository.github_id] = repository
+            return repository
+
+        if existing.key != repository.key:
+            if self._by_key.get(existing.key) is existing:
+                del self._by_key[existing.key]
+            existing.owner = repository.owner
+            existing.name = repository.name
+            self._by_key[existing.key] = existing
+
+        existing.ssh_url = repository.ssh_url
+        existing.default_branch = repository.default_branch
+        existing.removed = False
+        if repository.size is not None:
+            existing.size = repository.size
+        if repository.github_id is not None:
+            existing.github_id = repository.github_id
+            self._by_id[repository.github_id] = existing
+
+        return existing
+
     def repositories_to_process(self) -> List[Repository]:
         """Get all repositories filtering out done and removed"""
         return [
@@ -50,38 +138,146 @@ class Database:
     def merge_into(self, from_db: "Database") -> None:
         self.user = from_db.user
 
-        # add repositories that are new
-        existing_repos = set(
-            (repository.owner, repository.name) for repository in self.repositories
-        )
+        # add repositories that are new and refresh the known ones
+        merged = set()
         for repository in from_db.repositories:
-            if (repository.owner, repository.name) not in existing_repos:
-                self.repositories.append(repository)
+            merged.add(id(self.upsert(repository)))
 
         # mark repositories that are gone as removed
-        new_repos = set(
-            (repository.owner, repository.name) for repository in from_db.repositories
-        )
         for repository in self.repositories:
-            if (repository.owner, repository.name) not in new_repos:
+            if id(repository) not in merged:
                 repository.removed = True
 
-    def reset_from(self, selected_repos: Iterator[str]):
-        resets: Dict[str, bool] = {name: False for name in selected_repos}
-        for repository in self.repositories:
-            repo_id = f"{repository.owner}/{repository.name}"
-            if repo_id in resets:
-                print(f"{repo_id} was reset")
-                resets[repo_id] = True
-                repository.done = False
+    def reset_from(self, selected_repos: Iterable[str]):
+        unknown = []
+        for repo_id in dict.fromkeys(selected_repos):
+            owner, _, name = repo_id.partition("/")
+            repository = self.get_repository(owner, name)
+            if repository is None:
+                unknown.append(repo_id)
+                continue
 
-        for name, done in resets.items():
-            if not done:
-                print(f"{name} was not in the database")
+            print(f"{repo_id} was reset")
+            repository.done = False
+
+        for repo_id in unknown:
+            print(f"{repo_id} was not in the database")
 
     def reset_all(self) -> None:
         for repository in self.repositories:
             repository.done = False
 
 
-DATABASE_SCHEMA = marshmallow_dataclass.class_schema(Database)()
+class DecodeError(ValueError):
+    pass
+
+
+def _field_types(cls: type) -> Dict[str, Tuple[Tuple[Type, ...], bool]]:
+    """Map each field of the dataclass to its allowed types and whether it is required"""
+    hints = get_type_hints(cls)
+    result = {}
+    for f in fields(cls):
+        hint = hints[f.name]
+        allowed = getattr(hint, "__args__", None) or (hint,)  # unwraps Optional
+        required = f.default is MISSING and f.default_factory is MISSING
+        result[f.name] = (tuple(allowed), required)
+    return result
+
+
+_REPOSITORY_FIELDS = _field_types(Repository)
+_GIT_USER_FIELDS = _field_types(GitUser)
+
+
+def _decode_fields(
+    cls: type, field_types: Dict[str, Tuple[Tuple[Type, ...], bool]], data: Any
+) -> Dict[str, Any]:
+    if not isinstance(data, dict):
+        raise DecodeError(f"{cls.__name__} must be an object, got {data!r}")
+
+    unknown = data.keys() - field_types.keys()
+    if unknown:
+        raise DecodeError(f"Unknown fields of {cls.__name__}: {sorted(unknown)}")
+
+    for name, (allowed, required) in field_types.items():
+        if name not in data:
+            if required:
+                raise DecodeError(f"Missing field '{name}' of {cls.__name__}")
+            continue
+
+        value = data[name]
+        # like marshmallow: numbers are no booleans, but floats may be integers
+        if isinstance(value, bool) and bool not in allowed:
+            valid = False
+        elif isinstance(value, int) and float in allowed and int not in allowed:
+            data[name] = float(value)
+            valid = True
+        else:
+            valid = isinstance(value, allowed)
+        if not valid:
+            raise DecodeError(
+                f"Invalid value for field '{name}' of {cls.__name__}: {value!r}"
+            )
+
+    return data
+
+
+def database_to_dict(db: Database) -> Dict[str, Any]:
+    """Same result as DATABASE_SCHEMA.dump, without the overhead of marshmallow"""
+    return {
+        "user": (
+            None if db.user is None else {"name": db.user.name, "email": db.user.email}
+        ),
+        "repositories": [
+            repository_to_dict(repository) for repository in db.repositories
+        ],
+    }
+
+
+def repository_to_dict(repository: Repository) -> Dict[str, Any]:
+    return {name: getattr(repository, name) for name in _REPOSITORY_FIELDS}
+
+
+def database_from_dict(data: Any) -> Database:
+    """Counterpart of database_to_dict, raises DecodeError for invalid data"""
+    if not isinstance(data, dict):
+        raise DecodeError(f"Database must be an object, got {data!r}")
+
+    unknown = data.keys() - {"user", "repositories"}
+    if unknown:
+        raise DecodeError(f"Unknown fields of Database: {sorted(unknown)}")
+
+    user = None
+    if data.get("user") is not None:
+        user = GitUser(**_decode_fields(GitUser, _GIT_USER_FIELDS, data["user"]))
+
+    repositories = data.get("repositories") or []
+    if not isinstance(repositories, list):
+        raise DecodeError("Repositories must be a list")
+
+    return Database(
+        user=user,
+        repositories=[
+            Repository(**_decode_fields(Repository, _REPOSITORY_FIELDS, repository))
+            for repository in repositories
+        ],
+    )
+
+
+# marshmallow schemas of the dataclasses above, only created when first used
+# since importing marshmallow slows down every start of the CLI
+_SCHEMA_TYPES: Dict[str, type] = {
+    "repository_schema": Repository,
+    "GIT_USER_SCHEMA": GitUser,
+    "DATABASE_SCHEMA": Database,
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _SCHEMA_TYPES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    import marshmallow_dataclass
+
+    schema = marshmallow_dataclass.class_schema(_SCHEMA_TYPES[name])()
+    globals()[name] = schema
+    return schema
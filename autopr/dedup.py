@@ -0,0 +1,72 @@
+"""
+Runs the update command once per distinct input. Repositories generated
+from the same template often have identical files, so the first repository
+with an input hash runs the command and every later one with the same hash
+applies the resulting patch instead.
+"""
+import itertools
+import shutil
+import tempfile
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Optional
+
+from autopr.patches import PATCH_SUFFIX
+
+
+@dataclass
+class SharedResult:
+    repository: str  # name of the repository the command ran in
+    done: threading.Event = field(default_factory=threading.Event)
+    stored: bool = False  # False while running and if the run was released
+    patch_file: Optional[Path] = None  # None if the command changed nothing
+
+
+class UpdateResults:
+    """
+    Patches of update command runs by input hash, kept in a temporary
+    directory until `close`. Safe to use from concurrent transform workers:
+    while one repository runs the command for a hash, the others with the
+    same hash wait for its result.
+    """
+
+    def __init__(self):
+        self._dir = Path(tempfile.mkdtemp(prefix="auto-pr-dedup-"))
+        self._lock = threading.Lock()
+        self._results: Dict[str, SharedResult] = {}
+        self._numbers = itertools.count()
+
+    def claim(self, key: str, repository: str) -> Optional[SharedResult]:
+        """
+        The stored result for `key`, waiting for it if another repository is
+        producing it. None if the caller has to run the command and `store`
+        or `release` the result.
+        """
+        while True:
+            with self._lock:
+                result = self._results.get(key)
+                if result is None:
+                    self._results[key] = SharedResult(repository)
+                    return None
+            result.done.wait()
+            if result.stored:
+                return result
+            # the run was released, try to claim it again
+
+    def store(self, key: str, patch: str) -> None:
+        result = self._results[key]
+        if patch != "":
+            result.patch_file = self._dir / f"{next(self._numbers)}{PATCH_SUFFIX}"
+            result.patch_file.write_text(patch, encoding="utf-8", newline="")
+        result.stored = True
+        result.done.set()
+
+    def release(self, key: str) -> None:
+        """Give up on producing the result, e.g. because the command failed"""
+        with self._lock:
+            result = self._results.pop(key)
+        result.done.set()
+
+    def close(self) -> None:
+        shutil.rmtree(self._dir, ignore_errors=True)
@@ -0,0 +1,80 @@
+"""
+Runs git subprocesses on an asyncio event loop, so that many repositories
+can be pulled concurrently from a single process while their output is
+streamed as it happens.
+"""
+import asyncio
+import os
+from pathlib import Path
+from typing import IO, Dict, List, Optional
+
+from autopr import logs, util
+from autopr.util import CliException
+
+# time a cancelled command gets to exit before it is killed
+TERMINATE_TIMEOUT = 5.0  # seconds
+
+_CHUNK_SIZE = 64 * 1024
+
+
+async def run_cmd(
+    cmd: List[str],
+    additional_env: Optional[Dict[str, str]] = None,
+    cwd: Optional[Path] = None,
+    output: Optional[IO[str]] = None,
+    capture: bool = True,
+) -> str:
+    """
+    Counterpart of `repo.run_cmd` for the event loop. Lines of the command
+    are also written to `output` while it runs. When the calling task is
+    cancelled, e.g. by Ctrl-C, the command is terminated before the
+    cancellation propagates.
+    """
+    env = None
+    if additional_env:
+        env = os.environ.copy()
+        env.update(additional_env)
+
+    util.debug(f"Running: {' '.join(cmd)}")
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        env=env,
+        cwd=cwd,
+    )
+    received = logs.CommandOutput(cmd, capture, live=output)
+    try:
+        assert process.stdout is not None
+        while True:
+            data = await process.stdout.read(_CHUNK_SIZE)
+            if not data:
+                break
+            received.feed(data)
+        returncode = await process.wait()
+    except asyncio.CancelledError:
+        await _terminate(process)
+        raise
+
+    received.finish(returncode)
+    if returncode != 0:
+        raise CliException(
+            f"Command {' '.join(cmd)} failed (code: {returncode}):\n"
+            f"{received.error_text()}"
+        )
+    return received.text()
+
+
+async def _terminate(process: asyncio.subprocess.Process) -> None:
+    if process.returncode is not None:
+        return
+
+    try:
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), TERMINATE_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+    except ProcessLookupError:
+        pass  # exited in the meantime
@@ -1,14 +1,24 @@
 import re
+import time
 from dataclasses import dataclass
 from enum import Enum
-from typing import Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
-from github import Github
+from github import Github, GithubException
 from github.PullRequest import PullRequest
+from github.Requester import HTTPSRequestsConnectionClass
 
 from autopr import config, database
+from autopr.httpcache import CachingAdapter, HttpCache
+from autopr.ratelimit import DEFAULT_RETRY_AFTER, RateLimiter
 from autopr.repo import _git_get_global_config
-from autopr.util import CliException
+from autopr.util import CliException, warning
+
+# how often creating a pull request is retried after hitting a secondary rate limit
+MAX_RATE_LIMIT_RETRIES = 5
+
+# maximum number of pull requests looked up in a single GraphQL query
+GRAPHQL_BATCH_SIZE = 100
 
 
 @dataclass
@@ -24,11 +34,40 @@ class PullRequestState(Enum):
     CLOSED = "closed"
 
 
-def create_github_client(api_key: str) -> Github:
+@dataclass
+class PullRequestInfo:
+    number: int
+    state: str  # same values as the REST API, see PullRequestState
+    merged: bool
+    html_url: str
+
+
+def create_github_client(api_key: str, cache: Optional[HttpCache] = None) -> Github:
     gh = Github(api_key, per_page=150)
+    if cache is not None:
+        _use_http_cache(gh, cache)
     return gh
 
 
+def _use_http_cache(gh: Github, cache: HttpCache) -> None:
+    class CachingConnection(HTTPSRequestsConnectionClass):
+        def __init__(self, *args: Any, **kwargs: Any):
+            super().__init__(*args, **kwargs)
+            self.session.mount(
+                "https://",
+                CachingAdapter(
+                    cache,
+                    max_retries=self.retry,
+                    pool_connections=self.pool_size,
+                    pool_maxsize=self.pool_size,
+                ),
+            )
+
+    # PyGithub has no public way to change the transport of a single client, the
+    # class is only used once the first request is made
+    gh.requester._Requester__connectionClass = CachingConnection  # type: ignore
+
+
 def get_user(gh: Github, use_global_git_config: bool = False) -> database.GitUser:
     gh_user = gh.get_user()
 
@@ -62,40 +101,224 @@ def get_user(gh: Github, use_global_git_config: bool = False) -> database.GitUse
 
 
 def create_pr(
-    gh: Github, repository: database.Repository, pr_template: config.PrTemplate
+    gh: Github,
+    repository: database.Repository,
+    pr_template: config.PrTemplate,
+    limiter: Optional[RateLimiter] = None,
 ) -> PullRequest:
     gh_repo = gh.get_repo(repository.full_name)
-    pull_request = gh_repo.create_pull(
-        base=repository.default_branch,
-        head=pr_template.branch,
-        title=pr_template.title,
-        body=pr_template.body,
-        maintainer_can_modify=True,
-        draft=pr_template.draft,
+
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire()
+
+        try:
+            return gh_repo.create_pull(
+                base=repository.default_branch,
+                head=pr_template.branch,
+                title=pr_template.title,
+                body=pr_template.body,
+                maintainer_can_modify=True,
+                draft=pr_template.draft,
+            )
+        except GithubException as e:
+            retry_after = secondary_rate_limit_delay(e)
+            attempt += 1
+            if limiter is None or retry_after is None:
+                raise
+            if attempt > MAX_RATE_LIMIT_RETRIES:
+                raise CliException(
+                    f"Gave up creating pull request for {repository.name} "
+                    f"after hitting the rate limit {attempt} times"
+                )
+
+            warning(
+                f"Hit GitHub's rate limit creating pull request for "
+                f"{repository.name}, pausing for {retry_after:.0f} seconds"
+            )
+            limiter.pause(retry_after)
+
+
+def secondary_rate_limit_delay(e: GithubException) -> Optional[float]:
+    """Seconds to wait if the exception is a rate limit response, None otherwise"""
+    if e.status not in (403, 429):
+        return None
+
+    headers = {key.lower(): value for key, value in (e.headers or {}).items()}
+    message = str(e).lower()
+    is_rate_limited = (
+        "secondary rate limit" in message
+        or "abuse" in message
+        or "rate limit exceeded" in message
+        or "retry-after" in headers
+        or headers.get("x-ratelimit-remaining") == "0"
     )
-    return pull_request
+    if not is_rate_limited:
+        return None
+
+    try:
+        if "retry-after" in headers:
+            return max(float(headers["retry-after"]), 1.0)
+        if (
+            headers.get("x-ratelimit-remaining") == "0"
+            and "x-ratelimit-reset" in headers
+        ):
+            return max(float(headers["x-ratelimit-reset"]) - time.time(), 1.0)
+    except ValueError:
+        pass
+
+    return DEFAULT_RETRY_AFTER
+
+
+def get_pull_requests(
+    gh: Github, repositories: List[database.Repository]
+) -> Dict[str, PullRequestInfo]:
+    """
+    Look up the existing pull requests of the given repositories, batching up
+    to GRAPHQL_BATCH_SIZE of them into a single GraphQL query. Returns the
+    pull requests keyed by the repository's full name, repositories whose pull
+    request could not be found are left out.
+    """
+    with_pr = [
+        repository for repository in repositories if repository.existing_pr is not None
+    ]
+
+    pull_requests: Dict[str, PullRequestInfo] = {}
+    for start in range(0, len(with_pr), GRAPHQL_BATCH_SIZE):
+        batch = with_pr[start : start + GRAPHQL_BATCH_SIZE]
+        pull_requests.update(_query_pull_requests(gh, batch))
+
+    return pull_requests
+
+
+def _query_pull_requests(
+    gh: Github, repositories: List[database.Repository]
+) -> Dict[str, PullRequestInfo]:
+    parameters = []
+    blocks = []
+    variables: Dict[str, Any] = {}
+    for i, repository in enumerate(repositories):
+        parameters.append(f"$owner{i}: String!, $name{i}: String!, $number{i}: Int!")
+        blocks.append(
+            f"r{i}: repository(owner: $owner{i}, name: $name{i}) {{ "
+            f"pullRequest(number: $number{i}) {{ number state merged url }} }}"
+        )
+        variables[f"owner{i}"] = repository.owner
+        variables[f"name{i}"] = repository.name
+        variables[f"number{i}"] = repository.existing_pr
+
+    data = _query_batch(gh, parameters, blocks, variables, "pull requests")
+
+    pull_requests = {}
+    for i, repository in enumerate(repositories):
+        node = (data.get(f"r{i}") or {}).get("pullRequest")
+        if node is None:
+            continue
+
+        pull_requests[repository.full_name] = PullRequestInfo(
+            number=node["number"],
+            state=(
+                PullRequestState.OPEN.value
+                if node["state"] == "OPEN"
+                else PullRequestState.CLOSED.value
+            ),
+            merged=node["merged"],
+            html_url=node["url"],
+        )
 
+    return pull_requests
+
+
+def get_default_branch_tips(
+    gh: Github, repositories: List[database.Repository]
+) -> Dict[str, str]:
+    """
+    Look up the commit the default branch of each repository points to on
+    GitHub, batching up to GRAPHQL_BATCH_SIZE repositories into a single
+    GraphQL query. Returns the SHAs keyed by the repository's full name,
+    repositories which are gone or whose default branch changed are left out.
+    """
+    tips: Dict[str, str] = {}
+    for start in range(0, len(repositories), GRAPHQL_BATCH_SIZE):
+        batch = repositories[start : start + GRAPHQL_BATCH_SIZE]
+        tips.update(_query_default_branch_tips(gh, batch))
+
+    return tips
+
+
+def _query_default_branch_tips(
+    gh: Github, repositories: List[database.Repository]
+) -> Dict[str, str]:
+    parameters = []
+    blocks = []
+    variables: Dict[str, Any] = {}
+    for i, repository in enumerate(repositories):
+        parameters.append(f"$owner{i}: String!, $name{i}: String!")
+        blocks.append(
+            f"r{i}: repository(owner: $owner{i}, name: $name{i}) {{ "
+            f"defaultBranchRef {{ name target {{ oid }} }} }}"
+        )
+        variables[f"owner{i}"] = repository.owner
+        variables[f"name{i}"] = repository.name
 
-def get_pull_request(gh: Github, repository: database.Repository) -> PullRequest:
-    gh_repo = gh.get_repo(repository.full_name)
-    return gh_repo.get_pull(repository.existing_pr)
+    data = _query_batch(gh, parameters, blocks, variables, "default branches")
+
+    tips = {}
+    for i, repository in enumerate(repositories):
+        node = (data.get(f"r{i}") or {}).get("defaultBranchRef")
+        if node is None or node["name"] != repository.default_branch:
+            continue
+        tips[repository.full_name] = node["target"]["oid"]
+
+    return tips
+
+
+def _query_batch(
+    gh: Github,
+    parameters: List[str],
+    blocks: List[str],
+    variables: Dict[str, Any],
+    description: str,
+) -> Dict[str, Any]:
+    query = f"query({', '.join(parameters)}) {{ {' '.join(blocks)} }}"
+
+    # not using graphql_query as it fails the whole batch on a single missing repo
+    _headers, response = gh.requester.requestJsonAndCheck(
+        "POST",
+        gh.requester.graphql_url,
+        input={"query": query, "variables": variables},
+    )
+    data = (response or {}).get("data") or {}
+    if not data and response and response.get("errors"):
+        raise CliException(f"Failed to query {description}: {response['errors']}")
+    return data
 
 
 def set_pull_request_state(
-    gh: Github, repository: database.Repository, state: PullRequestState
+    gh: Github,
+    repository: database.Repository,
+    state: PullRequestState,
+    pull_request: Optional[PullRequestInfo] = None,
 ):
     if repository.existing_pr is None:
         raise ValueError(f"No existing pull request for {repository.name}")
 
-    gh_repo = gh.get_repo(repository.full_name)
-    pull_request = gh_repo.get_pull(repository.existing_pr)
+    if pull_request is None:
+        pull_request = get_pull_requests(gh, [repository]).get(repository.full_name)
+        if pull_request is None:
+            raise ValueError(f"Pull request not found for {repository.name}")
 
     if pull_request.merged:
         raise ValueError(
             f"Pull request already merged for {repository.name} ({pull_request.html_url})"
         )
 
-    pull_request.edit(state=state.value)
+    gh.requester.requestJsonAndCheck(
+        "PATCH",
+        f"/repos/{repository.full_name}/pulls/{pull_request.number}",
+        input={"state": state.value},
+    )
 
 
 def gather_repository_list(
@@ -117,6 +340,8 @@ def _list_all_repositories(
             name=gh_repo.name,
             ssh_url=gh_repo.ssh_url,
             default_branch=gh_repo.default_branch,
+            github_id=gh_repo.id,
+            size=gh_repo.size,
         )
         filter_info = FilterInfo(
             owner=gh_repo.owner.login,
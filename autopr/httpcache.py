@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_MAX_SIZE = 100 * 1024 * 1024  # bytes
+
+# headers of a 304 response that must not replace the cached ones
+_BODY_HEADERS = {"content-length", "content-encoding", "transfer-encoding"}
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0  # answered with 304, served from the cache
+    misses: int = 0  # cacheable requests that had to be downloaded
+    evictions: int = 0
+
+
+class HttpCache:
+    """
+    On-disk cache of GET responses which carry an ETag or Last-Modified
+    header. Entries are stored as one JSON file each and evicted least
+    recently used first once the directory grows beyond `max_size` bytes.
+    """
+
+    def __init__(self, directory: Path, max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._sizes: Optional[Dict[str, int]] = None
+
+    def _entry_file(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def _load_sizes(self) -> Dict[str, int]:
+        if self._sizes is None:
+            self._sizes = {}
+            if self.directory.exists():
+                for entry_file in self.directory.glob("*.json"):
+                    self._sizes[entry_file.stem] = entry_file.stat().st_size
+        return self._sizes
+
+    @staticmethod
+    def key(request: requests.PreparedRequest) -> str:
+        # responses differ per token and media type, so both are part of the key
+        parts = [
+            request.url or "",
+            str(request.headers.get("Authorization", "")),
+            str(request.headers.get("Accept", "")),
+        ]
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry_file = self._entry_file(key)
+        with self._lock:
+            try:
+                with open(entry_file) as f:
+                    entry = json.load(f)
+                os.utime(entry_file)  # mark as recently used
+                return entry
+            except (IOError, ValueError):
+                return None
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        data = json.dumps(entry)
+        with self._lock:
+            sizes = self._load_sizes()
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+            entry_file = self._entry_file(key)
+            tmp_file = entry_file.with_suffix(".tmp")
+            with open(tmp_file, "w") as f:
+                f.write(data)
+            os.replace(tmp_file, entry_file)
+
+            sizes[key] = len(data)
+            self._evict(sizes)
+
+    def _evict(self, sizes: Dict[str, int]) -> None:
+        total = sum(sizes.values())
+        if total <= self.max_size:
+            return
+
+        by_age = sorted(sizes, key=lambda key: self._entry_file(key).stat().st_mtime_ns)
+        for key in by_age:
+            if total <= self.max_size:
+                break
+            total -= sizes.pop(key)
+            self._entry_file(key).unlink(missing_ok=True)
+            self.stats.evictions += 1
+
+
+class CachingAdapter(HTTPAdapter):
+    """
+    Transport adapter sending conditional GET requests. Unchanged resources
+    come back as 304, which GitHub does not count against the rate limit,
+    and are answered from the cache. GraphQL queries are POST requests and
+    always sent as they are.
+    """
+
+    def __init__(self, cache: HttpCache, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(  # type: ignore[override]
+        self, request: requests.PreparedRequest, **kwargs: Any
+    ) -> requests.Response:
+        if request.method != "GET":
+            return super().send(request, **kwargs)
+
+        key = self.cache.key(request)
+        entry = self.cache.get(key)
+        if entry is not None:
+            if entry.get("etag"):
+                request.headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                request.headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = super().send(request, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            self.cache.stats.hits += 1
+            return self._cached_response(request, response, entry)
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status_code == 200 and (etag or last_modified):
+            self.cache.stats.misses += 1
+            self.cache.put(
+                key,
+                {
+                    "url": request.url,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "headers": {
+                        name: value
+                        for name, value in response.headers.items()
+                        if name.lower() not in _BODY_HEADERS
+                    },
+                    "body": response.text,
+                },
+            )
+
+        return response
+
+    @staticmethod
+    def _cached_response(
+        request: requests.PreparedRequest,
+        not_modified: requests.Response,
+        entry: Dict[str, Any],
+    ) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.url = request.url or entry["url"]
+        response.request = request
+        response.encoding = "utf-8"
+        response.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+        # keep fresh rate limit information from the 304 response
+        for name, value in not_modified.headers.items():
+            if name.lower() not in _BODY_HEADERS:
+                response.headers[name] = value
+        response._content = entry["body"].encode("utf-8")
+        not_modified.close()
+        return response
@@ -0,0 +1,207 @@
+"""
+Output of the commands auto-pr runs. While a repository is in a phase, e.g.
+`pull` or the update command of `run`, the output of its commands is
+streamed to `logs/<repository>/<phase>.log` in the workdir. Only the end of
+it is kept in memory for error messages, unless the caller needs all of it.
+"""
+import codecs
+import contextlib
+import contextvars
+import io
+import sys
+import time
+from pathlib import Path
+from typing import IO, Iterator, List, Optional, cast
+
+import click
+
+# bytes at the end of the output kept for the error message of a command
+TAIL_SIZE = 16 * 1024
+# programs rewrite progress lines with carriage returns, intermediate states
+# are shown at most this often per command while the final one always is
+PROGRESS_INTERVAL = 2.0  # seconds
+
+
+class PrefixedOutput(io.TextIOBase):
+    """
+    Text stream printing every complete line as soon as it is written,
+    prefixed with e.g. the repository name. Keeps the output of concurrent
+    operations apart without buffering it until they are done.
+    """
+
+    def __init__(self, prefix: str, stream: Optional[IO[str]] = None):
+        self.prefix = prefix
+        self._stream = stream  # stdout at the time of writing by default
+        self._partial = ""
+
+    def write(self, text: str) -> int:
+        lines = (self._partial + text).split("\n")
+        self._partial = lines.pop()
+        for line in lines:
+            click.echo(f"{self.prefix}{line}", file=self._stream)
+        return len(text)
+
+    def flush(self) -> None:
+        if self._partial:
+            click.echo(f"{self.prefix}{self._partial}", file=self._stream)
+            self._partial = ""
+
+    def isatty(self) -> bool:
+        # lets click keep colors when the real output is a terminal
+        return (self._stream or sys.stdout).isatty()
+
+
+class PhaseLog:
+    """Log file of one phase of a repository, created on the first write"""
+
+    def __init__(self, path: Path, echo: Optional[IO[str]] = None):
+        self.path = path
+        self.echo = echo  # where output is also shown as it happens
+        self._file: Optional[IO[bytes]] = None
+
+    def write(self, data: bytes) -> None:
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "wb")
+        self._file.write(data)
+        # readable while the command runs and kept if auto-pr dies
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.echo is not None:
+            self.echo.flush()
+
+
+_LOGS_DIR: Optional[Path] = None
+_ECHO = False
+_CURRENT: contextvars.ContextVar[Optional[PhaseLog]] = contextvars.ContextVar(
+    "phase_log", default=None
+)
+
+
+def start(logs_dir: Path, echo: bool = False) -> None:
+    """Log the phases of all repositories below `logs_dir` until `stop`"""
+    global _LOGS_DIR, _ECHO
+    _LOGS_DIR = logs_dir
+    _ECHO = echo
+
+
+def stop() -> None:
+    global _LOGS_DIR, _ECHO
+    _LOGS_DIR = None
+    _ECHO = False
+
+
+@contextlib.contextmanager
+def phase(repository_name: str, name: str) -> Iterator[Optional[PhaseLog]]:
+    """
+    Log the commands run within the block, in this thread or asyncio task,
+    to the log of phase `name` of the repository, replacing an older one
+    """
+    if _LOGS_DIR is None:
+        yield None
+        return
+
+    echo = None
+    if _ECHO:
+        echo = cast(IO[str], PrefixedOutput(f"[{repository_name}] "))
+    log = PhaseLog(_LOGS_DIR / repository_name / f"{name}.log", echo)
+    token = _CURRENT.set(log)
+    try:
+        yield log
+    finally:
+        _CURRENT.reset(token)
+        log.close()
+
+
+def current() -> Optional[PhaseLog]:
+    return _CURRENT.get()
+
+
+class CommandOutput:
+    """
+    Receives the output of a command while it runs: writes it to the log of
+    the current phase, shows it live if asked to and keeps all of it, or
+    only the last `TAIL_SIZE` bytes if `capture` is False.
+    """
+
+    def __init__(
+        self, cmd: List[str], capture: bool = True, live: Optional[IO[str]] = None
+    ):
+        self._log = current()
+        self._capture = capture
+        self._buffer = bytearray()
+        self._dropped = 0
+        if live is None and self._log is not None:
+            live = self._log.echo
+        self._live = _LiveLines(live) if live is not None else None
+
+        if self._log is not None:
+            self._log.write(f"$ {' '.join(cmd)}\n".encode())
+
+    def feed(self, data: bytes) -> None:
+        if self._log is not None:
+            self._log.write(data)
+        if self._live is not None:
+            self._live.feed(data)
+
+        self._buffer += data
+        if not self._capture and len(self._buffer) > TAIL_SIZE:
+            excess = len(self._buffer) - TAIL_SIZE
+            del self._buffer[:excess]
+            self._dropped += excess
+
+    def finish(self, returncode: int) -> None:
+        if self._live is not None:
+            self._live.close()
+        if self._log is not None and returncode != 0:
+            self._log.write(f"exit code {returncode}\n".encode())
+
+    def text(self) -> str:
+        return self._buffer.decode(errors="replace")
+
+    def error_text(self) -> str:
+        """The kept output, saying where to find the rest of it"""
+        if self._dropped == 0:
+            return self.text()
+
+        location = f", see {self._log.path}" if self._log is not None else ""
+        return f"[{self._dropped} bytes omitted{location}]\n{self.text()}"
+
+
+class _LiveLines:
+    """
+    Writes complete lines of the output, indented. Of lines rewritten with
+    carriage returns only the final state is shown, intermediate ones at
+    most every `PROGRESS_INTERVAL` seconds.
+    """
+
+    def __init__(self, output: IO[str]):
+        self._output = output
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._pending = ""
+        self._last_progress = time.monotonic()
+
+    def feed(self, data: bytes) -> None:
+        lines = (self._pending + self._decoder.decode(data)).split("\n")
+        self._pending = lines.pop()
+        for line in lines:
+            line = line.rstrip("\r").rsplit("\r", 1)[-1]
+            if line:
+                self._output.write(f"    {line}\n")
+
+        updates = self._pending.split("\r")
+        self._pending = updates[-1]
+        now = time.monotonic()
+        if len(updates) > 1 and now - self._last_progress >= PROGRESS_INTERVAL:
+            self._output.write(f"    {updates[-2]}\n")
+            self._last_progress = now
+
+    def close(self) -> None:
+        self._pending += self._decoder.decode(b"", final=True)
+        if self._pending:
+            self._output.write(f"    {self._pending}\n")
+            self._pending = ""
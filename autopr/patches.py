@@ -0,0 +1,120 @@
+"""
+Patch files written by `test`, one `<repository>.patch` per repository with
+changes and, for `test --all`, an index summarising every repository. Each
+patch starts with the default branch commit and update command it was
+computed from, so `run --from-patches` knows whether it still applies.
+"""
+import csv
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from typing import Iterable, Optional
+
+PATCH_SUFFIX = ".patch"
+INDEX_FILE_NAME = "index.tsv"
+INDEX_COLUMNS = ["repository", "status", "files", "added", "removed", "patch"]
+# git apply skips everything before the first diff, like an email message
+BASE_HEADER = "auto-pr-base:"
+INPUTS_HEADER = "auto-pr-inputs:"
+
+
+class PatchStatus(Enum):
+    CHANGED = "changed"
+    UNCHANGED = "unchanged"  # the update command changed nothing
+    SKIPPED = "skipped"  # nothing changed since the last run
+    FAILED = "failed"
+
+
+@dataclass
+class PatchSummary:
+    repository: str  # owner/name
+    status: PatchStatus
+    files: int = 0
+    added: int = 0
+    removed: int = 0
+    patch: str = ""  # file name within the output directory
+
+
+def summarize(repository: str, patch: str) -> PatchSummary:
+    """Count the files and lines a patch in git's diff format changes"""
+    if patch == "":
+        return PatchSummary(repository, PatchStatus.UNCHANGED)
+
+    summary = PatchSummary(repository, PatchStatus.CHANGED)
+    in_hunk = False
+    for line in patch.splitlines():
+        if line.startswith("diff --git "):
+            summary.files += 1
+            in_hunk = False
+        elif line.startswith("@@"):
+            in_hunk = True
+        elif in_hunk and line.startswith("+"):
+            summary.added += 1
+        elif in_hunk and line.startswith("-"):
+            summary.removed += 1
+    return summary
+
+
+@dataclass
+class SavedPatch:
+    path: Path
+    base_sha: Optional[str]  # default branch HEAD the patch was computed on
+    inputs: Optional[str]  # fingerprint of the update command
+
+
+def write_patch(
+    output_dir: Path, name: str, patch: str, base_sha: Optional[str], inputs: str
+) -> str:
+    """Write the patch of repository `name`, returns its file name"""
+    file_name = f"{name}{PATCH_SUFFIX}"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(output_dir / file_name, "w", encoding="utf-8", newline="") as f:
+        if base_sha is not None:
+            f.write(f"{BASE_HEADER} {base_sha}\n")
+        f.write(f"{INPUTS_HEADER} {inputs}\n\n")
+        f.write(patch)
+    return file_name
+
+
+def read_patch(patches_dir: Path, name: str) -> Optional[SavedPatch]:
+    """The saved patch of repository `name`, None if there is none"""
+    path = patches_dir / f"{name}{PATCH_SUFFIX}"
+    saved = SavedPatch(path, None, None)
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if line.startswith(BASE_HEADER):
+                    saved.base_sha = line[len(BASE_HEADER) :].strip()
+                elif line.startswith(INPUTS_HEADER):
+                    saved.inputs = line[len(INPUTS_HEADER) :].strip()
+                else:
+                    break
+    except FileNotFoundError:
+        return None
+    return saved
+
+
+def remove_patch(output_dir: Path, name: str) -> None:
+    """Remove a patch of an earlier run, which no longer applies"""
+    (output_dir / f"{name}{PATCH_SUFFIX}").unlink(missing_ok=True)
+
+
+def write_index(output_dir: Path, summaries: Iterable[PatchSummary]) -> Path:
+    """Write a tab separated line per repository, sorted by their names"""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    path = output_dir / INDEX_FILE_NAME
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(INDEX_COLUMNS)
+        for summary in sorted(summaries, key=lambda summary: summary.repository):
+            writer.writerow(
+                [
+                    summary.repository,
+                    summary.status.value,
+                    summary.files,
+                    summary.added,
+                    summary.removed,
+                    summary.patch,
+                ]
+            )
+    return path
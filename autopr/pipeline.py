@@ -0,0 +1,606 @@
+import collections
+import io
+import itertools
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Callable,
+    Deque,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    cast,
+)
+
+import click
+
+from autopr import database, dedup, logs, patches, repo, workdir
+from autopr.database import Repository
+from autopr.ratelimit import RateLimiter
+from autopr.util import CliException, error
+from autopr.workdir import WorkDir
+
+if TYPE_CHECKING:
+    from github import Github
+
+    from autopr import config
+
+DEFAULT_QUEUE_SIZE = 8
+# repositories the interactive `test` prepares ahead of the one shown
+DEFAULT_PREFETCH = 2
+# logs/<BATCH_LOGS>/<stage>-<n>.log holds the output of a stage's batches
+BATCH_LOGS = "batches"
+
+# marks the end of the work for a single stage worker
+_END = None
+
+
+@dataclass
+class Job:
+    index: int
+    total: int
+    repository: Repository
+    base_sha: Optional[str] = None  # default branch HEAD the job is based on
+    updated: bool = False  # whether the changes are in place without a command
+    # what the stages print about the repository, marked with its name
+    output: IO[str] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.output = cast(IO[str], logs.PrefixedOutput(f"[{self.repository.name}] "))
+
+
+@dataclass
+class Stage:
+    name: str
+    func: Callable[[Job], bool]  # returns whether the job moves to the next stage
+    workers: int = 1
+    # with a batch function, each worker collects the jobs passing `func` into
+    # lists of up to `batch_size`, only those it returns move on
+    batch: Optional[Callable[[List[Job]], List[Job]]] = None
+    batch_size: int = 1
+
+
+@dataclass
+class RunSummary:
+    skipped_unchanged: int = 0
+    applied_patches: int = 0
+    outdated_patches: int = 0  # the update command had to run again
+    update_command_runs: int = 0
+    reused_results: int = 0  # got the changes of a run on the same input
+
+
+@dataclass
+class TestResult:
+    repository: Repository
+    output: str = ""  # printed while preparing it in the background
+    ran: bool = False  # False if skipped, nothing changed since the last run
+    diff: str = ""  # colored for the terminal
+    patch: str = ""  # the same changes for `git apply`
+    sha: Optional[str] = None  # default branch HEAD the diff is based on
+    error: Optional[CliException] = None
+
+
+@dataclass
+class StageWorkers:
+    sync: int = 1
+    transform: int = 1
+    commit: int = 1
+    push: int = 1
+    pr: int = 1
+
+
+class Pipeline:
+    """
+    Runs jobs through a list of stages, each stage having its own pool of
+    worker threads. Stages are connected by bounded queues, so a slow stage
+    only lets the stages before it run ahead by `queue_size` jobs.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = DEFAULT_QUEUE_SIZE):
+        if len(stages) == 0:
+            raise ValueError("A pipeline needs at least one stage")
+
+        self.stages = stages
+        self._queues: List[queue.Queue] = [
+            queue.Queue(maxsize=max(queue_size, 1)) for _ in stages
+        ]
+        self._alive = [stage.workers for stage in stages]
+        self._alive_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._failure: Optional[BaseException] = None
+        self._batch_numbers = itertools.count(1)
+
+    def run(self, jobs: List[Job]) -> None:
+        threads = [threading.Thread(target=self._feed, args=(jobs,), daemon=True)]
+        for index, stage in enumerate(self.stages):
+            for number in range(stage.workers):
+                threads.append(
+                    threading.Thread(
+                        target=self._work,
+                        args=(index,),
+                        name=f"{stage.name}-{number}",
+                        daemon=True,
+                    )
+                )
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            # let running jobs finish their current step but start no new ones
+            self._stop.set()
+            raise
+
+        if self._failure is not None:
+            raise self._failure
+
+    def _feed(self, jobs: List[Job]) -> None:
+        for job in jobs:
+            if self._stop.is_set():
+                break
+            self._queues[0].put(job)
+
+        for _ in range(self.stages[0].workers):
+            self._queues[0].put(_END)
+
+    def _work(self, index: int) -> None:
+        stage = self.stages[index]
+        batch: List[Job] = []
+
+        while True:
+            job = self._queues[index].get()
+            if job is _END:
+                break
+
+            if self._stop.is_set():
+                continue
+
+            try:
+                # e.g. logs/<repository>/transform.log for the update command
+                with logs.phase(job.repository.name, stage.name):
+                    passed = stage.func(job)
+            except CliException as e:
+                job.output.flush()
+                error(f"Error: [{job.repository.name}] {e}")
+                passed = False
+            except BaseException as e:
+                self._failure = e
+                self._stop.set()
+                passed = False
+            job.output.flush()
+
+            if not passed:
+                continue
+            if stage.batch is None:
+                self._forward(index, [job])
+                continue
+
+            batch.append(job)
+            if len(batch) >= stage.batch_size:
+                self._run_batch(index, batch)
+                batch = []
+
+        if len(batch) > 0 and not self._stop.is_set():
+            self._run_batch(index, batch)
+
+        with self._alive_lock:
+            self._alive[index] -= 1
+            finished = self._alive[index] == 0
+
+        if finished and index < len(self.stages) - 1:
+            for _ in range(self.stages[index + 1].workers):
+                self._queues[index + 1].put(_END)
+
+    def _run_batch(self, index: int, jobs: List[Job]) -> None:
+        stage = self.stages[index]
+        assert stage.batch is not None
+        log_name = f"{stage.name}-{next(self._batch_numbers)}"
+        try:
+            with logs.phase(BATCH_LOGS, log_name):
+                passed = stage.batch(jobs)
+        except CliException as e:
+            names = ", ".join(job.repository.name for job in jobs)
+            error(f"Error: [{names}] {e}")
+            return
+        except BaseException as e:
+            self._failure = e
+            self._stop.set()
+            return
+
+        self._forward(index, passed)
+
+    def _forward(self, index: int, jobs: List[Job]) -> None:
+        if index < len(self.stages) - 1:
+            for job in jobs:
+                self._queues[index + 1].put(job)
+
+
+def run_repositories(
+    repositories: List[Repository],
+    db: database.Database,
+    cfg: "config.Config",
+    gh: "Github",
+    wd: WorkDir,
+    pull_repos: bool,
+    push_limiter: RateLimiter,
+    pr_limiter: RateLimiter,
+    workers: StageWorkers,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    skip_unchanged: bool = True,
+    patches_dir: Optional[Path] = None,
+) -> RunSummary:
+    """
+    Update repositories, pushing changes and opening pull requests. With
+    `patches_dir`, patches saved by `test` are applied instead of running
+    the update command if the default branch and the command are the same.
+    In batch mode, the transform workers run the update command once per
+    chunk of prepared repositories.
+    """
+    from autopr import config
+
+    batch_mode = cfg.update_command_mode == config.UPDATE_COMMAND_MODE_BATCH
+
+    ssh_key_file = Path(cfg.credentials.ssh_key_file)
+    repos_dir = wd.repos_dir
+    clone_options = repo.CloneOptions.from_config(cfg)
+    inputs = repo.get_update_command_fingerprint(cfg, repos_dir)
+    summary = RunSummary()
+    summary_lock = threading.Lock()
+    shared_results = dedup.UpdateResults() if cfg.deduplicate else None
+
+    def sync(job: Job) -> bool:
+        if pull_repos:
+            if db.user is None:
+                raise Exception(
+                    "db.user is None - please report at github.com/getyourguide/auto-pr"
+                )
+            repo.pull_repository(
+                db.user,
+                ssh_key_file,
+                repos_dir,
+                job.repository,
+                True,
+                job.output,
+                options=clone_options,
+            )
+        return True
+
+    def transform(job: Job) -> bool:
+        job.base_sha = repo.get_default_branch_sha(repos_dir, job.repository)
+        if (
+            skip_unchanged
+            and job.base_sha is not None
+            and job.repository.is_unchanged_since_last_run(job.base_sha, inputs)
+        ):
+            click.secho(
+                f"[{job.index}/{job.total}] Skipping '{job.repository.name}', "
+                "nothing changed since the last run"
+            )
+            with summary_lock:
+                summary.skipped_unchanged += 1
+            repo.mark_repository_as_done(job.repository, db, wd)
+            return False
+
+        click.secho(
+            f"[{job.index}/{job.total}] Updating '{job.repository.name}'", bold=True
+        )
+        repo.prepare_repository(repos_dir, job.repository, cfg.pr.branch, job.output)
+        if patches_dir is not None and apply_saved_patch(job, patches_dir):
+            job.updated = True
+            return True
+
+        if batch_mode:
+            # the command runs in transform_batch
+            return True
+        if shared_results is not None:
+            run_deduplicated(job, shared_results)
+        else:
+            run_update_command(job)
+        return True
+
+    def run_update_command(job: Job) -> None:
+        repo.run_update_command(
+            repos_dir, job.repository, cfg.update_command, job.output
+        )
+        with summary_lock:
+            summary.update_command_runs += 1
+
+    def transform_batch(jobs: List[Job]) -> List[Job]:
+        pending = [job for job in jobs if not job.updated]
+        if len(pending) > 0:
+            try:
+                repo.run_update_command_batch(
+                    repos_dir,
+                    [job.repository for job in pending],
+                    cfg.update_command,
+                    cfg.update_command_batch_input == config.BATCH_INPUT_MANIFEST,
+                )
+            except CliException as e:
+                names = ", ".join(job.repository.name for job in pending)
+                error(f"Error: [{names}] {e}")
+                # the repositories with a saved patch applied move on regardless
+                jobs = [job for job in jobs if job.updated]
+            with summary_lock:
+                summary.update_command_runs += 1
+
+        passed = []
+        for job in jobs:
+            try:
+                if not job.updated:
+                    repo.stage_changes(repos_dir, job.repository)
+            except CliException as e:
+                error(f"Error: [{job.repository.name}] {e}")
+            else:
+                passed.append(job)
+        return passed
+
+    def run_deduplicated(job: Job, results: dedup.UpdateResults) -> None:
+        key = repo.get_input_hash(repos_dir, job.repository, cfg.deduplicate_paths)
+        shared = results.claim(key, job.repository.name)
+        if shared is None:
+            try:
+                run_update_command(job)
+                results.store(key, repo.get_patch(repos_dir, job.repository))
+            except BaseException:
+                # another repository with the same input runs it instead
+                results.release(key)
+                raise
+            return
+
+        if shared.patch_file is not None:
+            click.secho(
+                f"  - Same input as '{shared.repository}', applying its changes",
+                file=job.output,
+            )
+            try:
+                repo.apply_patch(repos_dir, job.repository, shared.patch_file)
+            except CliException as e:
+                error(f"Error: [{job.repository.name}] {e}")
+                run_update_command(job)
+                return
+        else:
+            click.secho(
+                f"  - Same input as '{shared.repository}', "
+                "which the update command did not change",
+                file=job.output,
+            )
+        with summary_lock:
+            summary.reused_results += 1
+
+    def apply_saved_patch(job: Job, patches_dir: Path) -> bool:
+        saved = patches.read_patch(patches_dir, job.repository.name)
+        if saved is None:
+            return False
+
+        if saved.base_sha is None or saved.base_sha != job.base_sha:
+            click.secho(
+                "  - The default branch moved since the patch was saved",
+                file=job.output,
+            )
+        elif saved.inputs != inputs:
+            click.secho(
+                "  - The update command changed since the patch was saved",
+                file=job.output,
+            )
+        else:
+            click.secho(f"  - Applying saved patch {saved.path.name}", file=job.output)
+            try:
+                repo.apply_patch(repos_dir, job.repository, saved.path)
+            except CliException as e:
+                error(f"Error: [{job.repository.name}] {e}")
+            else:
+                with summary_lock:
+                    summary.applied_patches += 1
+                return True
+
+        with summary_lock:
+            summary.outdated_patches += 1
+        return False
+
+    def commit(job: Job) -> bool:
+        changed = repo.commit_changes(
+            repos_dir, job.repository, cfg.pr.message, job.output
+        )
+        job.repository.record_run(job.base_sha, inputs, changed)
+        if changed:
+            return True
+
+        click.secho(f"  - Nothing updated in '{job.repository.name}'", file=job.output)
+        repo.mark_repository_as_done(job.repository, db, wd)
+        return False
+
+    def push(job: Job) -> bool:
+        repo.push_branch(
+            ssh_key_file,
+            repos_dir,
+            job.repository,
+            cfg.pr.branch,
+            push_limiter,
+            job.output,
+        )
+        return True
+
+    def pull_request(job: Job) -> bool:
+        repo.open_pull_request(job.repository, db, cfg, gh, wd, pr_limiter, job.output)
+        return True
+
+    pipeline = Pipeline(
+        [
+            Stage("sync", sync, workers.sync),
+            Stage(
+                "transform",
+                transform,
+                workers.transform,
+                batch=transform_batch if batch_mode else None,
+                batch_size=cfg.update_command_batch_size,
+            ),
+            Stage("commit", commit, workers.commit),
+            Stage("push", push, workers.push),
+            Stage("pr", pull_request, workers.pr),
+        ],
+        queue_size=queue_size,
+    )
+
+    total = len(repositories)
+    try:
+        pipeline.run(
+            [
+                Job(index=index, total=total, repository=repository)
+                for index, repository in enumerate(repositories, start=1)
+            ]
+        )
+    finally:
+        if shared_results is not None:
+            shared_results.close()
+    return summary
+
+
+def test_repositories(
+    repositories: List[Repository],
+    db: database.Database,
+    cfg: "config.Config",
+    wd: WorkDir,
+    pull_repos: bool,
+    output_dir: Path,
+    workers: int,
+    skip_unchanged: bool = True,
+) -> List[patches.PatchSummary]:
+    """
+    Run the update command on the repositories without asking, `workers` at
+    a time, and write their changes as patch files to `output_dir`
+    """
+    repos_dir = wd.repos_dir
+    inputs = repo.get_update_command_fingerprint(cfg, repos_dir)
+    summaries: Dict[str, patches.PatchSummary] = {}
+    # guards the summaries and database writes
+    lock = threading.Lock()
+
+    def test(job: Job) -> bool:
+        repository = job.repository
+        sha: Optional[str] = None
+        try:
+            ran = repo.reset_and_run_script(
+                repository,
+                db,
+                cfg,
+                wd,
+                pull_repos,
+                inputs if skip_unchanged else None,
+            )
+            if ran:
+                patch = repo.get_patch(repos_dir, repository)
+                summary = patches.summarize(repository.full_name, patch)
+                sha = repo.get_default_branch_sha(repos_dir, repository)
+                with lock:
+                    repository.record_run(sha, inputs, patch != "")
+                    workdir.update_repository(wd, db, repository)
+            else:
+                patch = ""
+                summary = patches.PatchSummary(
+                    repository.full_name, patches.PatchStatus.SKIPPED
+                )
+        except CliException as e:
+            error(f"Error: [{repository.name}] {e}")
+            patch = ""
+            summary = patches.PatchSummary(
+                repository.full_name, patches.PatchStatus.FAILED
+            )
+
+        if patch != "":
+            summary.patch = patches.write_patch(
+                output_dir, repository.name, patch, sha, inputs
+            )
+        else:
+            patches.remove_patch(output_dir, repository.name)
+
+        click.secho(
+            f"[{job.index}/{job.total}] '{repository.name}': {summary.status.value}"
+            + (
+                f", {summary.files} files +{summary.added} -{summary.removed}"
+                if summary.status == patches.PatchStatus.CHANGED
+                else ""
+            )
+        )
+        with lock:
+            summaries[repository.full_name] = summary
+        return True
+
+    total = len(repositories)
+    try:
+        Pipeline([Stage("test", test, workers)]).run(
+            [
+                Job(index=index, total=total, repository=repository)
+                for index, repository in enumerate(repositories, start=1)
+            ]
+        )
+    finally:
+        # also covers the repositories done before an interruption
+        patches.write_index(output_dir, summaries.values())
+    return list(summaries.values())
+
+
+def prefetch_tests(
+    repositories: List[Repository],
+    db: database.Database,
+    cfg: "config.Config",
+    wd: WorkDir,
+    pull_repos: bool,
+    skip_unchanged_inputs: Optional[str],
+    prefetch: int = DEFAULT_PREFETCH,
+) -> Generator[TestResult, None, None]:
+    """
+    Pull, reset and run the update command on the repositories for `test`,
+    yielding their diffs in order. While the caller looks at one, the next
+    `prefetch` repositories are prepared in the background with their
+    output kept for when they are shown. Closing the iterator discards
+    prepared results and waits for the repositories being prepared.
+    """
+
+    def prepare(repository: Repository, out: Optional[io.StringIO]) -> TestResult:
+        result = TestResult(repository)
+        try:
+            result.ran = repo.reset_and_run_script(
+                repository, db, cfg, wd, pull_repos, skip_unchanged_inputs, out
+            )
+            if result.ran:
+                result.diff = repo.get_diff(wd.repos_dir, repository)
+                result.patch = repo.get_patch(wd.repos_dir, repository)
+                result.sha = repo.get_default_branch_sha(wd.repos_dir, repository)
+        except CliException as e:
+            result.error = e
+        if out is not None:
+            result.output = out.getvalue()
+        return result
+
+    if prefetch == 0:
+        for repository in repositories:
+            yield prepare(repository, None)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix="test")
+    pending: Deque[Future] = collections.deque()
+    upcoming = collections.deque(repositories)
+    try:
+        while True:
+            # the one to show next and the ones prepared ahead of it
+            while upcoming and len(pending) < prefetch + 1:
+                pending.append(
+                    executor.submit(prepare, upcoming.popleft(), io.StringIO())
+                )
+            if len(pending) == 0:
+                return
+            future = pending.popleft()
+            if not future.done():
+                click.secho("Preparing the next repository...")
+            yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
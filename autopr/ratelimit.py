@@ -0,0 +1,116 @@
+import threading
+import time
+from typing import Callable, List, Optional
+
+import click
+
+# used if GitHub reports a secondary rate limit without telling how long to wait
+DEFAULT_RETRY_AFTER = 60.0
+
+
+class TokenBucket:
+    """
+    Allows up to `capacity` operations at once and refills at `rate`
+    operations per second after that.
+    """
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = now
+
+    @classmethod
+    def per_period(
+        cls, count: int, period: float, now: float, burst: Optional[int] = None
+    ) -> "TokenBucket":
+        """Bucket for at most `count` operations every `period` seconds"""
+        return cls(rate=count / period, capacity=burst or count, now=now)
+
+    def _refill(self, now: float) -> None:
+        elapsed = max(now - self._updated, 0.0)
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated = now
+
+    def time_until_available(self, now: float) -> float:
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self._tokens -= 1
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter combining several token buckets, e.g. a per-minute
+    and a per-hour limit. An operation may only run once every bucket has a
+    token available. `pause` blocks all operations for a while, which is used
+    when GitHub reports a secondary rate limit.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        buckets: Optional[List[TokenBucket]] = None,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.name = name
+        self.buckets = buckets or []
+        self.waited = 0.0  # total seconds spent waiting on this limiter
+        self._clock = clock
+        self._sleep = sleep
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Wait until the operation is allowed and return how long that took"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = self._clock()
+                delay = max(
+                    [self._blocked_until - now]
+                    + [bucket.time_until_available(now) for bucket in self.buckets]
+                )
+                if delay <= 0:
+                    for bucket in self.buckets:
+                        bucket.take(now)
+                    self.waited += waited
+                    return waited
+
+            click.secho(f"Waiting {delay:.1f} seconds for the {self.name} limit...")
+            self._sleep(delay)
+            waited += delay
+
+    def pause(self, seconds: float) -> None:
+        """Block all operations for the next `seconds` seconds"""
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, self._clock() + seconds)
+
+
+def create_limiter(
+    name: str,
+    per_minute: Optional[int] = None,
+    per_hour: Optional[int] = None,
+    min_interval: Optional[float] = None,
+    burst: Optional[int] = None,
+) -> RateLimiter:
+    now = time.monotonic()
+    buckets = []
+    if min_interval:
+        buckets.append(TokenBucket(rate=1 / min_interval, capacity=burst or 1, now=now))
+    if per_minute:
+        buckets.append(TokenBucket.per_period(per_minute, 60.0, now, burst))
+    if per_hour:
+        buckets.append(TokenBucket.per_period(per_hour, 3600.0, now, burst))
+
+    return RateLimiter(name, buckets)
@@ -1,47 +1,188 @@
+import asyncio
+import collections
+import contextlib
+import fcntl
+import hashlib
 import io
 import os
 import shutil
 import subprocess
 import sys
-from multiprocessing import Pool
+import tempfile
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from enum import Enum
 from pathlib import Path
-from typing import IO, Dict, List, Optional
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
 
 import click
-from github import Github
 
-from autopr import config, database, github, util
+from autopr import database, engine, logs, ssh, util
+from autopr.concurrency import AdaptiveConcurrency, FixedConcurrency
 from autopr.database import Repository
+from autopr.ratelimit import RateLimiter
 from autopr.util import CliException, error
-from autopr.workdir import WorkDir, write_database
+from autopr.workdir import WorkDir, update_repository
+
+if TYPE_CHECKING:
+    from github import Github
+
+    from autopr import config
+
+# guards database writes when repositories are processed concurrently
+_DATABASE_LOCK = threading.Lock()
+
+# attempts of network operations while syncing and the delay before the
+# first retry in seconds, which doubles with every further attempt
+SYNC_ATTEMPTS = 3
+SYNC_RETRY_DELAY = 2.0
+# kilobytes per second assumed for repositories never pulled before, until
+# pulls of repositories with a known size were timed
+DEFAULT_PULL_SPEED = 5 * 1024
+
+# parts of git and ssh error messages, in lower case
+_TRANSIENT_ERRORS = [
+    "could not resolve host",
+    "connection timed out",
+    "connection reset",
+    "connection refused",
+    "connection closed",
+    "operation timed out",
+    "the remote end hung up unexpectedly",
+    "early eof",
+    "rpc failed",
+    "kex_exchange_identification",
+    "temporary failure in name resolution",
+    "network is unreachable",
+]
+# signs of GitHub limiting the number of connections
+_THROTTLING_ERRORS = [
+    "connection refused",
+    "connection reset",
+    "connection closed by remote host",
+    "kex_exchange_identification",
+    "too many",
+    "rate limit",
+]
+_CORRUPTION_ERRORS = [
+    "not a git repository",
+    "corrupt",
+    "bad object",
+    "broken link",
+    "unable to read",
+    "missing blob",
+    "missing tree",
+    "invalid object",
+    "index file",
+]
+
+T = TypeVar("T")
+
+_CHUNK_SIZE = 64 * 1024
+
+GIT_BACKEND_CLI = "cli"
+GIT_BACKEND_LIBGIT2 = "libgit2"
+GIT_BACKENDS = [GIT_BACKEND_CLI, GIT_BACKEND_LIBGIT2]
+# hooks `git commit` runs, which libgit2 does not
+_COMMIT_HOOKS = ["pre-commit", "prepare-commit-msg", "commit-msg", "post-commit"]
+
+
+@dataclass
+class CloneOptions:
+    """How `pull_repository` clones and updates repositories"""
+
+    mirror_dir: Optional[Path] = None  # bare repositories shared by all clones
+    sparse_checkout: List[str] = field(default_factory=list)  # gitignore patterns
+    clone_filter: Optional[str] = None  # e.g. 'blob:none', not used with mirrors
+    skip_lfs_smudge: bool = False
+
+    @classmethod
+    def from_config(cls, cfg: "config.Config") -> "CloneOptions":
+        return cls(
+            mirror_dir=Path(cfg.mirror_dir) if cfg.mirror_dir else None,
+            sparse_checkout=list(cfg.sparse_checkout),
+            clone_filter=cfg.clone_filter,
+            skip_lfs_smudge=cfg.skip_lfs_smudge,
+        )
+
+    def git_env(self, ssh_key_file: Path) -> Dict[str, str]:
+        """Environment of git commands which may download objects"""
+        env = {"GIT_SSH_COMMAND": ssh.git_ssh_command(ssh_key_file)}
+        if self.skip_lfs_smudge:
+            env["GIT_LFS_SKIP_SMUDGE"] = "1"
+        return env
+
+
+class SyncOutcome(Enum):
+    CLONED = "cloned"
+    UP_TO_DATE = "up to date"
+    RESET = "reset to a new commit"
+    RECLONED = "cloned again"
+    EXISTING = "left as they were"
+    UNCHANGED = "unchanged on GitHub"
+    FAILED = "failed"
 
 
-def _pull_repository_task(
+@dataclass
+class PullResult:
+    repository: database.Repository
+    outcome: SyncOutcome
+    sha: Optional[str] = None  # default branch HEAD of the clone afterwards
+    duration: float = 0.0  # seconds
+    throttled: bool = False  # failed because GitHub refused or dropped connections
+
+
+async def _pull_repository_task(
     user: database.GitUser,
     ssh_key_file: Path,
     repos_dir: Path,
     repository: database.Repository,
     update_repo_if_exists: bool,
-) -> None:
-    try:
-        output_buffer = io.StringIO()
+    options: Optional[CloneOptions],
+) -> PullResult:
+    output = cast(IO[str], logs.PrefixedOutput(f"[{repository.name}] "))
 
-        try:
-            pull_repository(
+    start = time.monotonic()
+    sha = None
+    throttled = False
+    try:
+        with logs.phase(repository.name, "pull"):
+            outcome = await _pull_repository(
                 user,
                 ssh_key_file,
                 repos_dir,
                 repository,
                 update_repo_if_exists,
-                out=output_buffer,
+                output,
+                options,
+                git_output=output,
             )
-        except CliException as e:
-            error(f"Error: {e}", file=output_buffer)
+            sha = await _default_branch_sha(repos_dir / repository.name, repository)
+    except CliException as e:
+        error(f"Error: {e}", file=output)
+        outcome = SyncOutcome.FAILED
+        throttled = _is_throttled(f"{e}")
+    finally:
+        output.flush()
 
-        click.echo(output_buffer.getvalue(), nl=False)
-        output_buffer.close()
-    except KeyboardInterrupt:
-        pass  # will be handled on main thread
+    return PullResult(repository, outcome, sha, time.monotonic() - start, throttled)
 
 
 def pull_repositories_parallel(
@@ -51,21 +192,177 @@ def pull_repositories_parallel(
     repositories: List[database.Repository],
     update_repos: bool,
     process_count: int,
-):
-    parameters = []
-    for repository in repositories:
-        parameters.append(
-            (
-                user,
-                ssh_key_file,
-                repos_dir,
-                repository,
-                update_repos,
+    options: Optional[CloneOptions] = None,
+    on_result: Optional[Callable[[PullResult], None]] = None,
+    concurrency: Optional[Union[FixedConcurrency, AdaptiveConcurrency]] = None,
+) -> Counter:
+    """
+    Pull the repositories concurrently on an event loop, starting them in
+    `pull_order`. `concurrency` decides how many run at once, `process_count`
+    by default. Output is printed as it happens, each line prefixed with the
+    repository name. `on_result` is called as soon as a repository is done.
+    Returns how many repositories ended up with each `SyncOutcome`.
+    """
+    return asyncio.run(
+        _pull_repositories(
+            user,
+            ssh_key_file,
+            repos_dir,
+            repositories,
+            update_repos,
+            options,
+            on_result,
+            concurrency or FixedConcurrency(process_count),
+        )
+    )
+
+
+async def _pull_repositories(
+    user: database.GitUser,
+    ssh_key_file: Path,
+    repos_dir: Path,
+    repositories: List[database.Repository],
+    update_repos: bool,
+    options: Optional[CloneOptions],
+    on_result: Optional[Callable[[PullResult], None]],
+    concurrency: Union[FixedConcurrency, AdaptiveConcurrency],
+) -> Counter:
+    waiting = collections.deque(
+        repositories[index] for index in pull_order(repositories)
+    )
+    running: Set[asyncio.Task] = set()
+    outcomes: Counter = Counter()
+    try:
+        while waiting or running:
+            # the limit may change after every result with `-j auto`
+            while waiting and len(running) < concurrency.limit:
+                running.add(
+                    asyncio.create_task(
+                        _pull_repository_task(
+                            user,
+                            ssh_key_file,
+                            repos_dir,
+                            waiting.popleft(),
+                            update_repos,
+                            options,
+                        )
+                    )
+                )
+
+            done, running = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED
             )
+            for task in done:
+                result = task.result()
+                concurrency.record(
+                    failed=result.outcome == SyncOutcome.FAILED,
+                    throttled=result.throttled,
+                )
+                outcomes[result.outcome] += 1
+                if on_result is not None:
+                    on_result(result)
+    finally:
+        # on Ctrl-C or an unexpected error, stop the git processes still running
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+    return outcomes
+
+
+def configure_repositories(
+    user: database.GitUser,
+    ssh_key_file: Path,
+    repos_dir: Path,
+    repositories: List[database.Repository],
+    process_count: int,
+    options: Optional[CloneOptions] = None,
+) -> int:
+    """
+    Apply the git identity and the checkout options to existing clones which
+    are not pulled, like pulling them would. These are local commands only.
+    Returns how many repositories failed.
+    """
+    return asyncio.run(
+        _configure_repositories(
+            user,
+            ssh_key_file,
+            repos_dir,
+            repositories,
+            process_count,
+            options or CloneOptions(),
         )
+    )
 
-    with Pool(processes=process_count) as pool:
-        pool.starmap(_pull_repository_task, parameters)
+
+async def _configure_repositories(
+    user: database.GitUser,
+    ssh_key_file: Path,
+    repos_dir: Path,
+    repositories: List[database.Repository],
+    process_count: int,
+    options: CloneOptions,
+) -> int:
+    semaphore = asyncio.Semaphore(process_count)
+
+    async def configure(repository: database.Repository) -> bool:
+        output = cast(IO[str], logs.PrefixedOutput(f"[{repository.name}] "))
+        repo_dir = repos_dir / repository.name
+        async with semaphore:
+            try:
+                with logs.phase(repository.name, "pull"):
+                    await _configure_checkout(repo_dir, ssh_key_file, options)
+                    await _git_config(repo_dir, "user.name", user.name)
+                    await _git_config(repo_dir, "user.email", user.email)
+                return True
+            except CliException as e:
+                error(f"Error: {e}", file=output)
+                return False
+            finally:
+                output.flush()
+
+    results = await asyncio.gather(*(configure(r) for r in repositories))
+    return results.count(False)
+
+
+def pull_order(repositories: List[database.Repository]) -> List[int]:
+    """
+    Indexes of the repositories, slowest first so they don't end up as the
+    tail of a parallel pull. Repositories are ranked by how long their last
+    pull took; for those which were never pulled, it is estimated from their
+    size as reported by GitHub and the speed of the timed pulls.
+    """
+    timed = [
+        repository
+        for repository in repositories
+        if repository.pull_duration is not None and repository.size
+    ]
+    total_size = sum(repository.size or 0 for repository in timed)
+    if total_size > 0:
+        seconds_per_kb = (
+            sum(repository.pull_duration or 0.0 for repository in timed) / total_size
+        )
+    else:
+        seconds_per_kb = 1 / DEFAULT_PULL_SPEED
+
+    def key(index: int) -> float:
+        repository = repositories[index]
+        if repository.pull_duration is not None:
+            return -repository.pull_duration
+        return -(repository.size or 0) * seconds_per_kb
+
+    return sorted(range(len(repositories)), key=key)
+
+
+def needs_sync(
+    repos_dir: Path, repository: database.Repository, remote_sha: Optional[str]
+) -> bool:
+    """False if the clone is still at the remote tip it was last synced to"""
+    return (
+        remote_sha is None
+        or repository.synced_sha != remote_sha
+        or not (repos_dir / repository.name).exists()
+    )
 
 
 def pull_repository(
@@ -75,76 +372,419 @@ def pull_repository(
     repository: database.Repository,
     update_repo_if_exists: bool,
     out: IO[str] = sys.stdout,
-) -> None:
+    options: Optional[CloneOptions] = None,
+) -> SyncOutcome:
+    """
+    Clone the repository, or bring an existing clone to the tip of the
+    default branch. Existing clones are only deleted and cloned again if
+    they are corrupt, transient network errors are retried.
+    """
+    return asyncio.run(
+        _pull_repository(
+            user,
+            ssh_key_file,
+            repos_dir,
+            repository,
+            update_repo_if_exists,
+            out,
+            options,
+        )
+    )
+
+
+async def _pull_repository(
+    user: database.GitUser,
+    ssh_key_file: Path,
+    repos_dir: Path,
+    repository: database.Repository,
+    update_repo_if_exists: bool,
+    out: IO[str],
+    options: Optional[CloneOptions],
+    git_output: Optional[IO[str]] = None,
+) -> SyncOutcome:
+    """`pull_repository`, with the progress of git written to `git_output`"""
     repo_dir = repos_dir / repository.name
     repo_exists = repo_dir.exists()
 
     if not update_repo_if_exists and repo_exists:
         click.echo(f"Repository '{repository.name}' already exists", file=out)
-        return
+        return SyncOutcome.EXISTING
 
     click.echo(f"Pulling repository '{repository.name}':", file=out)
 
-    pull_failed = False
+    options = options or CloneOptions()
+    mirror = None
+    mirror_dir = options.mirror_dir
+    if mirror_dir is not None:
+        click.echo("  - Updating mirror", file=out)
+        mirror = await _retry_transient(
+            lambda: update_mirror(ssh_key_file, mirror_dir, repository, git_output),
+            out,
+        )
+
+    outcome = SyncOutcome.CLONED
     if repo_exists:
-        click.echo(f"  - Checking out branch '{repository.default_branch}'", file=out)
-        _git_checkout(repo_dir, repository.default_branch)
+        try:
+            outcome = await _sync_repository(
+                ssh_key_file, repo_dir, repository, mirror, out, options, git_output
+            )
+        except CliException as e:
+            if not _is_corrupt(repo_dir, f"{e}"):
+                raise
+            util.debug(f"Failed to update: {e}")
+            click.echo("  - Repository is corrupt; deleting repo", file=out)
+            shutil.rmtree(repo_dir)
+            outcome = SyncOutcome.RECLONED
+
+    if outcome in (SyncOutcome.CLONED, SyncOutcome.RECLONED):
+        try:
+            if mirror is None:
+                click.echo(
+                    f"  - Cloning branch '{repository.default_branch}'", file=out
+                )
+                await _retry_transient(
+                    lambda: _git_shallow_clone(
+                        ssh_key_file,
+                        repo_dir,
+                        repository.ssh_url,
+                        repository.default_branch,
+                        options,
+                        git_output,
+                    ),
+                    out,
+                    cleanup=lambda: shutil.rmtree(repo_dir, ignore_errors=True),
+                )
+            else:
+                click.echo(
+                    f"  - Cloning branch '{repository.default_branch}' from mirror",
+                    file=out,
+                )
+                await _git_clone_from_mirror(
+                    mirror,
+                    repo_dir,
+                    repository.ssh_url,
+                    repository.default_branch,
+                    options,
+                )
+        except asyncio.CancelledError:
+            # a partial clone would be mistaken for an existing one next time
+            shutil.rmtree(repo_dir, ignore_errors=True)
+            raise
+        await _configure_checkout(repo_dir, ssh_key_file, options)
 
-        click.echo("  - Pulling latest changes", file=out)
+        click.echo("  - Setting user and email", file=out)
+    await _git_config(repo_dir, "user.name", user.name)
+    await _git_config(repo_dir, "user.email", user.email)
+    return outcome
+
+
+async def _sync_repository(
+    ssh_key_file: Path,
+    repo_dir: Path,
+    repository: database.Repository,
+    mirror: Optional[Path],
+    out: IO[str],
+    options: CloneOptions,
+    git_output: Optional[IO[str]] = None,
+) -> SyncOutcome:
+    """Fetch the tip of the default branch and force the working tree to it"""
+    if not (repo_dir / ".git").exists():
+        raise CliException(f"{repo_dir} is not a git repository")
+
+    await _configure_checkout(repo_dir, ssh_key_file, options)
+    previous = await _default_branch_sha(repo_dir, repository)
+
+    click.echo("  - Fetching latest changes", file=out)
+    if mirror is None:
+        await _retry_transient(
+            lambda: _git_fetch_branch(
+                repo_dir,
+                "origin",
+                repository.default_branch,
+                options.git_env(ssh_key_file),
+                shallow=True,
+                output=git_output,
+            ),
+            out,
+        )
+    else:
+        await _git_fetch_branch(repo_dir, f"{mirror}", repository.default_branch, {})
+
+    click.echo(
+        f"  - Resetting branch '{repository.default_branch}' to the fetched commit",
+        file=out,
+    )
+    await _git_force_checkout(repo_dir, repository.default_branch, "FETCH_HEAD")
+
+    current = await _default_branch_sha(repo_dir, repository)
+    return SyncOutcome.UP_TO_DATE if current == previous else SyncOutcome.RESET
+
+
+def _is_transient(message: str) -> bool:
+    message = message.lower()
+    return any(pattern in message for pattern in _TRANSIENT_ERRORS)
+
+
+def _is_throttled(message: str) -> bool:
+    message = message.lower()
+    return any(pattern in message for pattern in _THROTTLING_ERRORS)
+
+
+def _is_corrupt(repo_dir: Path, message: str) -> bool:
+    if not (repo_dir / ".git").exists():
+        return True
+    message = message.lower()
+    return any(pattern in message for pattern in _CORRUPTION_ERRORS)
+
+
+async def _retry_transient(
+    func: Callable[[], Awaitable[T]],
+    out: IO[str],
+    cleanup: Optional[Callable[[], None]] = None,
+) -> T:
+    """Await `func()`, retrying with exponential backoff on network errors"""
+    delay = SYNC_RETRY_DELAY
+    for attempt in range(1, SYNC_ATTEMPTS + 1):
         try:
-            _git_pull(repo_dir)
+            return await func()
         except CliException as e:
-            util.debug(f"Failed to pull: {e}")
-            pull_failed = True
+            if attempt == SYNC_ATTEMPTS or not _is_transient(f"{e}"):
+                raise
+            util.debug(f"Transient error: {e}")
+
+        if cleanup is not None:
+            cleanup()
+        click.echo(f"  - Network error; retrying in {delay:.0f} seconds", file=out)
+        await asyncio.sleep(delay)
+        delay *= 2
+
+    raise AssertionError("unreachable")
 
-    if pull_failed:
-        click.echo("  - Pull failed; deleting repo", file=out)
-        shutil.rmtree(repo_dir)
 
-    if not repo_exists or pull_failed:
-        click.echo(f"  - Cloning branch '{repository.default_branch}'", file=out)
-        _git_shallow_clone(
-            ssh_key_file, repo_dir, repository.ssh_url, repository.default_branch
+async def _configure_checkout(
+    repo_dir: Path, ssh_key_file: Path, options: CloneOptions
+):
+    """Apply the sparse checkout and LFS options, also to existing clones"""
+    if options.skip_lfs_smudge:
+        await _git_config(repo_dir, "filter.lfs.smudge", "git-lfs smudge --skip -- %f")
+        await _git_config(
+            repo_dir, "filter.lfs.process", "git-lfs filter-process --skip"
+        )
+        await _git_config(repo_dir, "filter.lfs.required", "false")
+
+    sparse_checkout_file = repo_dir / ".git" / "info" / "sparse-checkout"
+    if len(options.sparse_checkout) > 0:
+        await _git_sparse_checkout(
+            repo_dir,
+            ["set", "--no-cone", *options.sparse_checkout],
+            options.git_env(ssh_key_file),
         )
+    elif sparse_checkout_file.exists():
+        await _git_sparse_checkout(repo_dir, ["disable"], options.git_env(ssh_key_file))
+        sparse_checkout_file.unlink()
 
-        click.echo("  - Setting user and email", file=out)
-    _git_config(repo_dir, "user.name", user.name)
-    _git_config(repo_dir, "user.email", user.email)
+
+async def update_mirror(
+    ssh_key_file: Path,
+    mirror_dir: Path,
+    repository: database.Repository,
+    output: Optional[IO[str]] = None,
+) -> Path:
+    """
+    Fetch the default branch of `repository` into its bare mirror below
+    `mirror_dir` and return the path of the mirror. Mirrors may be shared by
+    several workdirs, so updates of the same mirror are serialised by a lock
+    file next to it.
+    """
+    mirror = mirror_dir / repository.owner / f"{repository.name}.git"
+    mirror.parent.mkdir(parents=True, exist_ok=True)
+
+    async with _file_lock(mirror.with_name(f"{mirror.name}.lock")):
+        if not (mirror / "HEAD").exists():
+            await _git_init_mirror(mirror)
+        # kept up to date in case the repository moved
+        await _git_config(mirror, "remote.origin.url", repository.ssh_url)
+        await _git_fetch_mirror(ssh_key_file, mirror, repository.default_branch, output)
+
+    return mirror
+
+
+@contextlib.asynccontextmanager
+async def _file_lock(path: Path) -> AsyncIterator[None]:
+    with open(path, "w") as lock_file:
+        # waits in a thread, another workdir may hold the lock for a while
+        await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 
-def prepare_repository(repos_dir: Path, repository: database.Repository, branch: str):
+def prepare_repository(
+    repos_dir: Path,
+    repository: database.Repository,
+    branch: str,
+    out: Optional[IO[str]] = None,
+):
     repo_dir = repos_dir / repository.name
 
-    click.echo(f"Resetting repository '{repository.name}':")
+    click.echo(f"Resetting repository '{repository.name}':", file=out)
 
-    click.echo("  - Resetting changes")
-    _git_reset_hard(repo_dir)
+    click.echo(
+        f"  - Resetting changes and branch '{branch}' "
+        f"to default branch '{repository.default_branch}'",
+        file=out,
+    )
+    _GIT_BACKEND.reset_to_branch(repo_dir, repository.default_branch, branch)
 
-    click.echo(f"  - Checking out default branch '{repository.default_branch}'")
-    _git_checkout(repo_dir, repository.default_branch)
 
-    click.echo(f"  - Creating or resetting branch '{branch}'")
-    _git_branch_checkout_reset(repo_dir, branch)
+def run_update_command(
+    repos_dir: Path,
+    repository: database.Repository,
+    command: List[str],
+    out: Optional[IO[str]] = None,
+):
+    repo_dir = repos_dir / repository.name
 
+    click.echo(f"Running update command for repository '{repository.name}':", file=out)
+    run_cmd(command, cwd=repo_dir, capture=False)
 
-def run_update_command(
-    repos_dir: Path, repository: database.Repository, command: List[str]
+    _GIT_BACKEND.add_all(repo_dir)
+
+
+def run_update_command_batch(
+    repos_dir: Path,
+    repositories: List[database.Repository],
+    command: List[str],
+    manifest: bool,
+    out: Optional[IO[str]] = None,
 ):
+    """
+    Run the update command once for all repositories, from `repos_dir`. The
+    absolute paths of their directories are appended to the command or, with
+    `manifest`, written to a file, one per line, whose path is appended.
+    Changes are not staged, see `stage_changes`.
+    """
+    repo_dirs = [
+        f"{(repos_dir / repository.name).absolute()}" for repository in repositories
+    ]
+    names = ", ".join(f"'{repository.name}'" for repository in repositories)
+    click.echo(f"Running update command for repositories {names}:", file=out)
+    if not manifest:
+        run_cmd([*command, *repo_dirs], cwd=repos_dir, capture=False)
+        return
+
+    with tempfile.NamedTemporaryFile(
+        "w", prefix="auto-pr-manifest-", suffix=".txt"
+    ) as manifest_file:
+        manifest_file.write("".join(f"{repo_dir}\n" for repo_dir in repo_dirs))
+        manifest_file.flush()
+        run_cmd([*command, manifest_file.name], cwd=repos_dir, capture=False)
+
+
+def stage_changes(repos_dir: Path, repository: database.Repository):
+    _GIT_BACKEND.add_all(repos_dir / repository.name)
+
+
+def apply_patch(
+    repos_dir: Path, repository: database.Repository, patch_file: Path
+) -> None:
+    repo_dir = repos_dir / repository.name
+    _GIT_BACKEND.apply_patch(repo_dir, patch_file.absolute())
+
+
+def get_input_hash(
+    repos_dir: Path, repository: database.Repository, paths: List[str]
+) -> str:
+    """
+    Identifies the files the update command works on: the tree of the
+    checked out commit or, if given, the objects at `paths` within it
+    """
     repo_dir = repos_dir / repository.name
+    if len(paths) == 0:
+        return _GIT_BACKEND.rev_parse(repo_dir, "HEAD^{tree}")
+
+    # mode, type, object id and path of each path, missing ones are left out
+    entries = run_cmd(["git", "-C", f"{repo_dir}", "ls-tree", "HEAD", "--", *paths])
+    return hashlib.sha256(entries.encode()).hexdigest()
+
+
+def get_update_command_fingerprint(cfg: "config.Config", repos_dir: Path) -> str:
+    """
+    Hash of the update command including the content of every argument that
+    points to a file, e.g. the script run by an interpreter. Relative paths
+    are resolved against the directory the command runs in. Every repository
+    directory has the same parent, so paths leaving it like '../../fix.py'
+    point to the same file for all of them, while the files within the
+    repository are covered by its default branch commit.
+    """
+    from autopr import config
+
+    if cfg.update_command_mode == config.UPDATE_COMMAND_MODE_BATCH:
+        cwd = repos_dir
+    else:
+        cwd = repos_dir / "<repository>"
+
+    digest = hashlib.sha256()
+    for argument in cfg.update_command:
+        digest.update(argument.encode())
+        digest.update(b"\0")
+
+        # resolved lexically, the placeholder directory does not exist
+        path = Path(os.path.normpath(cwd / Path(argument).expanduser()))
+        try:
+            if path.is_file():
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(chunk)
+        except OSError:
+            pass  # unreadable files are only represented by their name
 
-    click.echo(f"Running update command for repository '{repository.name}':")
+    return digest.hexdigest()
 
-    cwd = os.getcwd()
-    os.chdir(repo_dir)
-    run_cmd(command)
-    os.chdir(cwd)
 
-    _git_add_all(repo_dir)
+def get_default_branch_sha(
+    repos_dir: Path, repository: database.Repository
+) -> Optional[str]:
+    repo_dir = repos_dir / repository.name
+    try:
+        return _GIT_BACKEND.rev_parse(
+            repo_dir, f"refs/heads/{repository.default_branch}"
+        )
+    except CliException as e:
+        util.debug(f"Failed to resolve default branch of {repository.name}: {e}")
+        return None
+
+
+async def _default_branch_sha(
+    repo_dir: Path, repository: database.Repository
+) -> Optional[str]:
+    try:
+        return (
+            await engine.run_cmd(
+                [
+                    "git",
+                    "-C",
+                    f"{repo_dir}",
+                    "rev-parse",
+                    "--verify",
+                    f"refs/heads/{repository.default_branch}",
+                ]
+            )
+        ).strip()
+    except CliException as e:
+        util.debug(f"Failed to resolve default branch of {repository.name}: {e}")
+        return None
 
 
 def get_diff(repos_dir: Path, repository: database.Repository):
     repo_dir = repos_dir / repository.name
-    return _git_staged_diff(repo_dir)
+    return _GIT_BACKEND.staged_diff(repo_dir)
+
+
+def get_patch(repos_dir: Path, repository: database.Repository) -> str:
+    repo_dir = repos_dir / repository.name
+    return _GIT_BACKEND.staged_patch(repo_dir)
 
 
 def commit_and_push_changes(
@@ -153,48 +793,303 @@ def commit_and_push_changes(
     repository: database.Repository,
     branch: str,
     message: str,
+    limiter: Optional[RateLimiter] = None,
+) -> bool:
+    if not commit_changes(repos_dir, repository, message):
+        return False
+
+    push_branch(ssh_key_file, repos_dir, repository, branch, limiter)
+    return True
+
+
+def commit_changes(
+    repos_dir: Path,
+    repository: database.Repository,
+    message: str,
+    out: Optional[IO[str]] = None,
 ) -> bool:
     repo_dir = repos_dir / repository.name
-    if _git_staged_diff(repo_dir) == "":
-        click.echo("  - No changes")
+    if not _GIT_BACKEND.has_staged_changes(repo_dir):
+        click.echo("  - No changes", file=out)
         return False
 
-    click.echo("  - Committing and pushing changes")
-    _git_commit(repo_dir, message)
+    click.echo(f"  - Committing changes to '{repository.name}'", file=out)
+    _GIT_BACKEND.commit(repo_dir, message)
+    return True
+
+
+def push_branch(
+    ssh_key_file: Path,
+    repos_dir: Path,
+    repository: database.Repository,
+    branch: str,
+    limiter: Optional[RateLimiter] = None,
+    out: Optional[IO[str]] = None,
+) -> None:
+    repo_dir = repos_dir / repository.name
+    if limiter is not None:
+        limiter.acquire()
 
+    click.echo(f"  - Pushing changes of '{repository.name}'", file=out)
     force_push = repository.existing_pr is not None
     _git_push(ssh_key_file, repo_dir, branch, force_push)
 
-    return True
-
 
-def run_cmd(cmd: List[str], additional_env: Optional[Dict[str, str]] = None) -> str:
+def run_cmd(
+    cmd: List[str],
+    additional_env: Optional[Dict[str, str]] = None,
+    cwd: Optional[Path] = None,
+    capture: bool = True,
+) -> str:
+    """
+    Run the command and return its output, all of it or, if `capture` is
+    False, only its end. The output is streamed to the log of the current
+    phase (see `logs.phase`) while the command runs.
+    """
     env = None
     if additional_env:
         env = os.environ.copy()
         env.update(additional_env)
 
-    try:
-        util.debug(f"Running: {' '.join(cmd)}")
-        return subprocess.check_output(
-            cmd,
-            stderr=subprocess.STDOUT,
-            env=env,
-        ).decode()
-    except subprocess.CalledProcessError as exc:
+    util.debug(f"Running: {' '.join(cmd)}")
+    received = logs.CommandOutput(cmd, capture)
+    with subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, cwd=cwd
+    ) as process:
+        # read1 returns what is there instead of waiting for a full chunk
+        stdout = cast(io.BufferedReader, process.stdout)
+        while True:
+            data = stdout.read1(_CHUNK_SIZE)
+            if not data:
+                break
+            received.feed(data)
+        returncode = process.wait()
+
+    received.finish(returncode)
+    if returncode != 0:
         raise CliException(
-            f"Command {' '.join(cmd)} failed (code: {exc.returncode}):\n{exc.output.decode()}"
+            f"Command {' '.join(cmd)} failed (code: {returncode}):\n"
+            f"{received.error_text()}"
+        )
+    return received.text()
+
+
+class GitBackend:
+    """
+    Local git operations on the clones during `run` and `test`, each one a
+    git process. Everything talking to the remote always uses the git CLI.
+    """
+
+    name = GIT_BACKEND_CLI
+
+    def reset_to_branch(self, repo_dir: Path, start_point: str, branch: str) -> None:
+        """Discard changes and check out `branch`, (re)created at `start_point`"""
+        run_cmd(
+            ["git", "-C", f"{repo_dir}", "checkout", "-f", "-B", branch, start_point],
+            capture=False,
         )
 
+    def add_all(self, repo_dir: Path) -> None:
+        run_cmd(["git", "-C", f"{repo_dir}", "add", "--all"])
+
+    def has_staged_changes(self, repo_dir: Path) -> bool:
+        # the names are enough to tell, unlike the diff they need no blobs
+        names = run_cmd(
+            [
+                "git",
+                "-C",
+                f"{repo_dir}",
+                "diff",
+                "--staged",
+                "--name-only",
+                "--no-renames",
+            ]
+        )
+        return names.strip() != ""
+
+    def staged_diff(self, repo_dir: Path) -> str:
+        return run_cmd(
+            ["git", "-c", "color.ui=always", "-C", f"{repo_dir}", "diff", "--staged"]
+        )
+
+    def staged_patch(self, repo_dir: Path) -> str:
+        """The staged changes in a form `git apply` accepts, binary files included"""
+        return run_cmd(
+            ["git", "-C", f"{repo_dir}", "diff", "--staged", "--binary", "--no-color"]
+        )
+
+    def apply_patch(self, repo_dir: Path, patch_file: Path) -> None:
+        """Apply the patch to the working tree and stage it, all or nothing"""
+        run_cmd(["git", "-C", f"{repo_dir}", "apply", "--index", f"{patch_file}"])
+
+    def commit(self, repo_dir: Path, message: str) -> None:
+        run_cmd(["git", "-C", f"{repo_dir}", "commit", "-m", message], capture=False)
 
-def _get_git_ssh_command(ssh_key_file: Path) -> str:
-    return f"ssh -i {ssh_key_file} -o IdentitiesOnly=yes"
+    def rev_parse(self, repo_dir: Path, rev: str) -> str:
+        return run_cmd(
+            ["git", "-C", f"{repo_dir}", "rev-parse", "--verify", rev]
+        ).strip()
 
 
-def _git_shallow_clone(
-    ssh_key_file: Path, repo_dir: Path, ssh_url: str, branch: str
+class LibGit2Backend(GitBackend):
+    """
+    Runs the local operations in-process with libgit2 through pygit2.
+    libgit2 implements neither sparse checkouts nor filter drivers such as
+    Git LFS, hooks or signing; clones and files using them are handed to
+    the git CLI. The colored diff shown by `test` also comes from the CLI.
+    """
+
+    name = GIT_BACKEND_LIBGIT2
+
+    def __init__(self):
+        try:
+            import pygit2
+        except ImportError:
+            raise CliException(
+                "The libgit2 git backend needs pygit2, "
+                "install it with 'pip install auto-pr[libgit2]'"
+            )
+        self._pygit2 = pygit2
+
+    def _open(self, repo_dir: Path):
+        try:
+            return self._pygit2.Repository(
+                f"{repo_dir}", self._pygit2.enums.RepositoryOpenFlag.NO_SEARCH
+            )
+        except self._pygit2.GitError as e:
+            raise CliException(f"Failed to open {repo_dir}: {e}")
+
+    def reset_to_branch(self, repo_dir: Path, start_point: str, branch: str) -> None:
+        repository = self._open(repo_dir)
+        try:
+            commit = repository.revparse_single(f"refs/heads/{start_point}").peel(
+                self._pygit2.Commit
+            )
+        except (KeyError, self._pygit2.GitError) as e:
+            raise CliException(f"Failed to resolve '{start_point}' in {repo_dir}: {e}")
+
+        # every file the reset may rewrite: changed ones and those that differ
+        # between the checked out commit and the new one
+        paths = set(repository.status(untracked_files="no"))
+        head = repository.head.peel(self._pygit2.Commit)
+        if head.id != commit.id:
+            for delta in repository.diff(head, commit).deltas:
+                paths.update([delta.old_file.path, delta.new_file.path])
+        if self._is_sparse(repository) or self._is_filtered(repository, paths):
+            return super().reset_to_branch(repo_dir, start_point, branch)
+
+        # the branch may be the checked out one, which can't be moved
+        repository.set_head(commit.id)
+        if len(paths) > 0:
+            repository.reset(commit.id, self._pygit2.enums.ResetMode.HARD)
+        repository.branches.local.create(branch, commit, force=True)
+        repository.set_head(f"refs/heads/{branch}")
+
+    def add_all(self, repo_dir: Path) -> None:
+        repository = self._open(repo_dir)
+        if self._is_sparse(repository):
+            return super().add_all(repo_dir)
+
+        # like `git add --all` this also stages deleted files; the index is
+        # only written if none of the staged files needs a filter driver
+        index = repository.index
+        index.add_all()
+        head = repository.head.peel(self._pygit2.Commit)
+        paths = set()
+        for delta in index.diff_to_tree(head.tree).deltas:
+            paths.update([delta.old_file.path, delta.new_file.path])
+        if self._is_filtered(repository, paths):
+            return super().add_all(repo_dir)
+        index.write()
+
+    def has_staged_changes(self, repo_dir: Path) -> bool:
+        repository = self._open(repo_dir)
+        if self._is_sparse(repository):
+            return super().has_staged_changes(repo_dir)
+
+        head = repository.head.peel(self._pygit2.Commit)
+        return repository.index.write_tree() != head.tree_id
+
+    def commit(self, repo_dir: Path, message: str) -> None:
+        repository = self._open(repo_dir)
+        if self._is_sparse(repository) or self._runs_hooks_or_signs(repository):
+            return super().commit(repo_dir, message)
+
+        try:
+            signature = repository.default_signature
+        except (KeyError, self._pygit2.GitError) as e:
+            raise CliException(f"No user and email configured in {repo_dir}: {e}")
+        repository.create_commit(
+            "HEAD",
+            signature,
+            signature,
+            _clean_commit_message(message),
+            repository.index.write_tree(),
+            [repository.head.target],
+        )
+
+    def rev_parse(self, repo_dir: Path, rev: str) -> str:
+        try:
+            return f"{self._open(repo_dir).revparse_single(rev).id}"
+        except (KeyError, ValueError, self._pygit2.GitError) as e:
+            raise CliException(f"Failed to resolve '{rev}' in {repo_dir}: {e}")
+
+    @staticmethod
+    def _is_sparse(repository) -> bool:
+        config = repository.config
+        return "core.sparseCheckout" in config and config.get_bool(
+            "core.sparseCheckout"
+        )
+
+    @staticmethod
+    def _is_filtered(repository, paths: Iterable[str]) -> bool:
+        return any(repository.get_attr(path, "filter") for path in paths)
+
+    @staticmethod
+    def _runs_hooks_or_signs(repository) -> bool:
+        config = repository.config
+        if "core.hooksPath" in config:
+            return True
+        if "commit.gpgsign" in config and config.get_bool("commit.gpgsign"):
+            return True
+        hooks_dir = Path(repository.path) / "hooks"
+        return any((hooks_dir / hook).exists() for hook in _COMMIT_HOOKS)
+
+
+def _clean_commit_message(message: str) -> str:
+    """The message as `git commit -m` stores it"""
+    lines: List[str] = []
+    for line in message.splitlines():
+        line = line.rstrip()
+        if line == "" and (len(lines) == 0 or lines[-1] == ""):
+            continue
+        lines.append(line)
+    while len(lines) > 0 and lines[-1] == "":
+        lines.pop()
+    return "".join(f"{line}\n" for line in lines)
+
+
+_GIT_BACKEND: GitBackend = GitBackend()
+
+
+def set_git_backend(name: str) -> None:
+    """Use the backend `name` for the local git operations from now on"""
+    global _GIT_BACKEND
+    if name == GIT_BACKEND_LIBGIT2:
+        _GIT_BACKEND = LibGit2Backend()
+    else:
+        _GIT_BACKEND = GitBackend()
+
+
+async def _git_shallow_clone(
+    ssh_key_file: Path,
+    repo_dir: Path,
+    ssh_url: str,
+    branch: str,
+    options: Optional[CloneOptions] = None,
+    output: Optional[IO[str]] = None,
 ) -> None:
-    git_ssh_command = _get_git_ssh_command(ssh_key_file)
+    options = options or CloneOptions()
     command = [
         "git",
         "clone",
@@ -205,89 +1100,189 @@ def _git_shallow_clone(
         "--branch",
         branch,
     ]
-
-    run_cmd(command, additional_env={"GIT_SSH_COMMAND": git_ssh_command})
+    if options.clone_filter:
+        command.append(f"--filter={options.clone_filter}")
+    if len(options.sparse_checkout) > 0:
+        command.append("--sparse")  # the patterns are set right after cloning
+    if output is not None:
+        command.append("--progress")
+
+    await engine.run_cmd(
+        command,
+        additional_env=options.git_env(ssh_key_file),
+        output=output,
+        capture=False,
+    )
 
 
-def _git_checkout(repo_dir: Path, branch: str) -> None:
-    run_cmd(["git", "-C", f"{repo_dir}", "checkout", branch])
+async def _git_init_mirror(mirror: Path) -> None:
+    await engine.run_cmd(["git", "init", "--bare", f"{mirror}"])
+    # clones borrow objects from the mirror, so none of them may be pruned
+    await _git_config(mirror, "gc.pruneExpire", "never")
 
 
-def _git_branch_checkout_reset(repo_dir: Path, branch: str) -> None:
-    run_cmd(["git", "-C", f"{repo_dir}", "checkout", "-B", branch])
+async def _git_fetch_mirror(
+    ssh_key_file: Path, mirror: Path, branch: str, output: Optional[IO[str]] = None
+) -> None:
+    git_ssh_command = ssh.git_ssh_command(ssh_key_file)
+    command = ["git", "-C", f"{mirror}", "fetch", "--no-tags"]
+    if output is not None:
+        command.append("--progress")
+    command += ["origin", f"+refs/heads/{branch}:refs/heads/{branch}"]
+
+    await engine.run_cmd(
+        command,
+        additional_env={"GIT_SSH_COMMAND": git_ssh_command},
+        output=output,
+        capture=False,
+    )
 
 
-def _git_reset_hard(repo_dir: Path) -> None:
-    run_cmd(["git", "-C", f"{repo_dir}", "reset", "--hard"])
+async def _git_clone_from_mirror(
+    mirror: Path,
+    repo_dir: Path,
+    ssh_url: str,
+    branch: str,
+    options: Optional[CloneOptions] = None,
+) -> None:
+    options = options or CloneOptions()
+    # --shared uses the objects of the mirror instead of copying them
+    command = [
+        "git",
+        "clone",
+        "--shared",
+        "--branch",
+        branch,
+        f"{mirror}",
+        f"{repo_dir}",
+    ]
+    if len(options.sparse_checkout) > 0:
+        command.append("--sparse")
 
+    env = {"GIT_LFS_SKIP_SMUDGE": "1"} if options.skip_lfs_smudge else None
+    await engine.run_cmd(command, additional_env=env, capture=False)
+    await engine.run_cmd(
+        ["git", "-C", f"{repo_dir}", "remote", "set-url", "origin", ssh_url]
+    )
 
-def _git_pull(repo_dir: Path) -> None:
-    run_cmd(["git", "-C", f"{repo_dir}", "pull", "--depth", "1"])
 
+async def _git_sparse_checkout(
+    repo_dir: Path, args: List[str], env: Dict[str, str]
+) -> None:
+    await engine.run_cmd(
+        ["git", "-C", f"{repo_dir}", "sparse-checkout", *args], additional_env=env
+    )
 
-def _git_config(repo_dir: Path, key: str, value: str) -> None:
-    run_cmd(["git", "-C", f"{repo_dir}", "config", key, value])
 
+async def _git_fetch_branch(
+    repo_dir: Path,
+    remote: str,
+    branch: str,
+    env: Dict[str, str],
+    shallow: bool = False,
+    output: Optional[IO[str]] = None,
+) -> None:
+    command = ["git", "-C", f"{repo_dir}", "fetch", "--no-tags"]
+    if shallow:
+        command += ["--depth", "1"]
+    if output is not None:
+        command.append("--progress")
+    command += [remote, f"+refs/heads/{branch}:refs/remotes/origin/{branch}"]
 
-def _git_get_global_config(key: str) -> str:
-    return run_cmd(["git", "config", "--global", key])
+    await engine.run_cmd(command, additional_env=env, output=output, capture=False)
 
 
-def _git_staged_diff(repo_dir: Path) -> str:
-    return run_cmd(
-        ["git", "-c", "color.ui=always", "-C", f"{repo_dir}", "diff", "--staged"]
+async def _git_force_checkout(repo_dir: Path, branch: str, start_point: str) -> None:
+    await engine.run_cmd(
+        ["git", "-C", f"{repo_dir}", "checkout", "-f", "-B", branch, start_point],
+        capture=False,
     )
 
 
-def _git_add_all(repo_dir: Path) -> None:
-    run_cmd(["git", "-C", f"{repo_dir}", "add", "--all"])
+async def _git_config(repo_dir: Path, key: str, value: str) -> None:
+    await engine.run_cmd(["git", "-C", f"{repo_dir}", "config", key, value])
 
 
-def _git_commit(repo_dir: Path, message) -> None:
-    run_cmd(["git", "-C", f"{repo_dir}", "commit", "-m", message])
+def _git_get_global_config(key: str) -> str:
+    return run_cmd(["git", "config", "--global", key])
 
 
 def _git_push(ssh_key_file: Path, repo_dir: Path, branch: str, force: bool) -> None:
-    git_ssh_command = _get_git_ssh_command(ssh_key_file)
+    git_ssh_command = ssh.git_ssh_command(ssh_key_file)
     cmd = ["git", "-C", f"{repo_dir}", "push", "-u", "origin", branch]
     if force:
         cmd.append("--force")
 
-    run_cmd(cmd, additional_env={"GIT_SSH_COMMAND": git_ssh_command})
+    run_cmd(cmd, additional_env={"GIT_SSH_COMMAND": git_ssh_command}, capture=False)
 
 
 def reset_and_run_script(
     repository: Repository,
     db: database.Database,
-    cfg: config.Config,
+    cfg: "config.Config",
     workdir: WorkDir,
     pull_repo: bool,
-):
+    skip_unchanged_inputs: Optional[str] = None,
+    out: Optional[IO[str]] = None,
+) -> bool:
+    """
+    Returns False without touching the working tree if `skip_unchanged_inputs`
+    is given and the last run on the same inputs did not change anything.
+    Progress is printed to `out`, stdout by default.
+    """
     if db.user is None:
         raise Exception(
             "db.user is None - please report at github.com/getyourguide/auto-pr"
         )
 
+    repos_dir = workdir.repos_dir
     if pull_repo:
-        pull_repository(
-            db.user,
-            Path(cfg.credentials.ssh_key_file),
-            workdir.repos_dir,
-            repository,
-            True,
-        )
+        with logs.phase(repository.name, "sync"):
+            pull_repository(
+                db.user,
+                Path(cfg.credentials.ssh_key_file),
+                repos_dir,
+                repository,
+                True,
+                out or sys.stdout,
+                options=CloneOptions.from_config(cfg),
+            )
 
-    # reset repo and check out branch
-    prepare_repository(workdir.repos_dir, repository, cfg.pr.branch)
-    run_update_command(workdir.repos_dir, repository, cfg.update_command)
+    if skip_unchanged_inputs is not None:
+        sha = get_default_branch_sha(repos_dir, repository)
+        if sha is not None and repository.is_unchanged_since_last_run(
+            sha, skip_unchanged_inputs
+        ):
+            return False
+
+    from autopr import config
+
+    # reset repo and check out branch, logged like the stages of `run`
+    with logs.phase(repository.name, "transform"):
+        prepare_repository(repos_dir, repository, cfg.pr.branch, out)
+        if cfg.update_command_mode == config.UPDATE_COMMAND_MODE_BATCH:
+            # a batch of one, the command expects the directories
+            run_update_command_batch(
+                repos_dir,
+                [repository],
+                cfg.update_command,
+                cfg.update_command_batch_input == config.BATCH_INPUT_MANIFEST,
+                out,
+            )
+            stage_changes(repos_dir, repository)
+        else:
+            run_update_command(repos_dir, repository, cfg.update_command, out)
+    return True
 
 
 def push_changes(
     repository: Repository,
     db: database.Database,
-    cfg: config.Config,
-    gh: Github,
+    cfg: "config.Config",
+    gh: "Github",
     workdir: WorkDir,
+    push_limiter: Optional[RateLimiter] = None,
+    pr_limiter: Optional[RateLimiter] = None,
 ) -> bool:
     updated = commit_and_push_changes(
         Path(cfg.credentials.ssh_key_file),
@@ -295,37 +1290,56 @@ def push_changes(
         repository,
         cfg.pr.branch,
         cfg.pr.message,
+        push_limiter,
     )
 
     if not updated:
         click.secho("  - Nothing updated")
-        _mark_repository_as_done(repository, db, workdir)
+        mark_repository_as_done(repository, db, workdir)
         return False
 
+    return open_pull_request(repository, db, cfg, gh, workdir, pr_limiter)
+
+
+def open_pull_request(
+    repository: Repository,
+    db: database.Database,
+    cfg: "config.Config",
+    gh: "Github",
+    workdir: WorkDir,
+    limiter: Optional[RateLimiter] = None,
+    out: Optional[IO[str]] = None,
+) -> bool:
+    """Open a pull request for the pushed branch unless one is already open"""
+    from autopr import github
+
     if repository.existing_pr:
-        pull_request = github.get_pull_request(gh, repository)
+        existing = github.get_pull_requests(gh, [repository])
+        pull_request = existing.get(repository.full_name)
         if (
-            not pull_request.merged
+            pull_request is not None
+            and not pull_request.merged
             and pull_request.state != github.PullRequestState.CLOSED.value
         ):
-            click.secho(f"  - Pull request: {pull_request.html_url}")
-            _mark_repository_as_done(repository, db, workdir)
+            click.secho(f"  - Pull request: {pull_request.html_url}", file=out)
+            mark_repository_as_done(repository, db, workdir)
             return False
 
-    pull_request = github.create_pr(gh, repository, cfg.pr)
-    repository.existing_pr = pull_request.number
+    created = github.create_pr(gh, repository, cfg.pr, limiter)
+    repository.existing_pr = created.number
 
-    click.secho(f"  - Pull request: {pull_request.html_url}")
+    click.secho(f"  - Pull request: {created.html_url}", file=out)
 
     # persist database to be able to continue from there
-    _mark_repository_as_done(repository, db, workdir)
-    click.secho(f"Done updating repository '{repository.name}'")
+    mark_repository_as_done(repository, db, workdir)
+    click.secho(f"Done updating repository '{repository.name}'", file=out)
 
     return True
 
 
-def _mark_repository_as_done(
+def mark_repository_as_done(
     repository: Repository, db: database.Database, workdir: WorkDir
 ):
-    repository.done = True
-    write_database(workdir, db)
+    with _DATABASE_LOCK:
+        repository.done = True
+        update_repository(workdir, db, repository)
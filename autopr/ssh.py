@@ -0,0 +1,115 @@
+"""
+Shares SSH connections between git commands. Without it every clone, fetch
+and push does its own SSH handshake with the remote; with a started
+`ConnectionPool`, git commands open sessions on a few persistent master
+connections (OpenSSH ControlMaster) instead.
+"""
+import hashlib
+import itertools
+import shlex
+import subprocess
+import tempfile
+import threading
+from pathlib import Path
+from typing import List, Optional
+
+from autopr import util
+
+DEFAULT_CONNECTIONS = 4
+# masters outlive the last session this long, so they also go away when
+# auto-pr is killed before closing them
+CONTROL_PERSIST = 60  # seconds
+# unix socket paths are limited to 104 bytes on macOS, the socket names
+# within the directory take up to about 30 of them
+MAX_CONTROL_DIR_LENGTH = 70
+
+
+class ConnectionPool:
+    """
+    Master connections with their sockets in `control_dir`. Commands are
+    spread over `connections` masters round robin, as servers refuse more
+    than a few sessions per connection (10 by default for OpenSSH). A
+    command whose session is refused falls back to a connection of its own.
+    """
+
+    def __init__(self, control_dir: Path, connections: int = DEFAULT_CONNECTIONS):
+        self.control_dir = control_dir
+        self.connections = connections
+        self._slots = itertools.count()
+        self._lock = threading.Lock()
+
+    def options(self) -> List[str]:
+        """ssh options of the next command"""
+        with self._lock:
+            slot = next(self._slots) % self.connections
+            if not self.control_dir.exists():
+                # the sockets give access to the authenticated connections
+                self.control_dir.mkdir(mode=0o700, parents=True)
+
+        control_path = self.control_dir / f"{slot}-%r@%h:%p"
+        return [
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={control_path}",
+            "-o",
+            f"ControlPersist={CONTROL_PERSIST}",
+        ]
+
+    def close(self) -> None:
+        """Stop the master connections and remove their directory"""
+        if not self.control_dir.exists():
+            return
+
+        for socket in self.control_dir.iterdir():
+            if not socket.is_socket():
+                continue
+            util.debug(f"Closing SSH connection {socket.name}")
+            # the destination is ignored, the socket decides the connection
+            subprocess.run(
+                ["ssh", "-o", f"ControlPath={socket}", "-O", "exit", "auto-pr"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                check=False,
+            )
+
+        try:
+            self.control_dir.rmdir()
+        except OSError:
+            pass  # a master still starting up, it persists only briefly
+
+
+_POOL: Optional[ConnectionPool] = None
+
+
+def control_dir(ssh_dir: Path) -> Path:
+    """`ssh_dir`, or a directory unique to it if its path is too long"""
+    ssh_dir = ssh_dir.absolute()
+    if len(f"{ssh_dir}") <= MAX_CONTROL_DIR_LENGTH:
+        return ssh_dir
+
+    digest = hashlib.sha256(f"{ssh_dir}".encode()).hexdigest()[:12]
+    return Path(tempfile.gettempdir()) / f"auto-pr-ssh-{digest}"
+
+
+def start(ssh_dir: Path, connections: int = DEFAULT_CONNECTIONS) -> ConnectionPool:
+    """Share connections of all following git commands until `stop`"""
+    global _POOL
+    stop()
+    _POOL = ConnectionPool(control_dir(ssh_dir), connections)
+    return _POOL
+
+
+def stop() -> None:
+    global _POOL
+    if _POOL is not None:
+        _POOL.close()
+        _POOL = None
+
+
+def git_ssh_command(ssh_key_file: Path) -> str:
+    """Value of GIT_SSH_COMMAND for git commands which connect to the remote"""
+    command = f"ssh -i {ssh_key_file} -o IdentitiesOnly=yes"
+    if _POOL is not None:
+        command += " " + " ".join(shlex.quote(option) for option in _POOL.options())
+    return command
@@ -0,0 +1,276 @@
+import hashlib
+import json
+import marshal
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from autopr.util import warning
+
+JOURNAL_SUFFIX = ".journal"
+
+FORMAT_JSON = "json"
+FORMAT_BINARY = "binary"
+
+# identifies files written by BinaryStorage, followed by a format version byte
+BINARY_MAGIC = b"APRDB"
+BINARY_VERSION = 1
+
+# the first line of a journal names the snapshot it continues by a hash of
+# its content, so a journal a crash kept from being removed after the
+# snapshot was rewritten is ignored instead of replayed over it
+JOURNAL_HEADER_KEY = "snapshot"
+
+# the journal is compacted once it has more entries than the database has
+# repositories, but never before it reaches this size
+MIN_COMPACTION_ENTRIES = 1000
+
+
+def atomic_write(path: Path, data: Union[str, bytes]) -> None:
+    """Write a file so that readers either see the old or the new content"""
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with open(tmp_path, "wb" if isinstance(data, bytes) else "w") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class JsonStorage:
+    """Keeps the whole database in one JSON file, rewritten on every change"""
+
+    format = FORMAT_JSON
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def files(self) -> List[Path]:
+        return [self.path]
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def read(self) -> Optional[Dict[str, Any]]:
+        if not self.path.exists():
+            return None
+
+        with open(self.path) as f:
+            return json.load(f)
+
+    def encode(self, data: Dict[str, Any]) -> bytes:
+        return json.dumps(data, indent=4, sort_keys=True).encode()
+
+    def write(self, data: Dict[str, Any]) -> None:
+        atomic_write(self.path, self.encode(data))
+
+
+class BinaryStorage(JsonStorage):
+    """
+    Keeps the database in the compact `marshal` format of the running Python,
+    which loads and saves much faster than JSON for large databases. The file
+    is only meant to be read by auto-pr itself, use `db export` to share it.
+    """
+
+    format = FORMAT_BINARY
+
+    def read(self) -> Optional[Dict[str, Any]]:
+        if not self.path.exists():
+            return None
+
+        with open(self.path, "rb") as f:
+            content = f.read()
+
+        header = BINARY_MAGIC + bytes([BINARY_VERSION])
+        if not content.startswith(header):
+            raise ValueError(f"{self.path} is not a binary auto-pr database")
+
+        return marshal.loads(content[len(header) :])
+
+    def encode(self, data: Dict[str, Any]) -> bytes:
+        header = BINARY_MAGIC + bytes([BINARY_VERSION])
+        return header + marshal.dumps(data)
+
+
+class JournalStorage:
+    """
+    Keeps a snapshot of the database plus an append-only journal of
+    repository updates next to it. Updating a single repository only appends
+    a line to the journal; the journal is folded into the snapshot when the
+    whole database is written or it grew larger than the database.
+    """
+
+    def __init__(self, snapshot: JsonStorage):
+        self.snapshot = snapshot
+        self.journal_path = snapshot.path.with_name(
+            f"{snapshot.path.name}{JOURNAL_SUFFIX}"
+        )
+        self._entries: Optional[int] = None
+        # hash of the snapshot and the stat of the file it was computed from
+        self._snapshot_hash: Optional[Tuple[Optional[Tuple[int, int, int]], str]] = None
+
+    @property
+    def format(self) -> str:
+        return self.snapshot.format
+
+    def files(self) -> List[Path]:
+        return self.snapshot.files() + [self.journal_path]
+
+    def exists(self) -> bool:
+        return self.snapshot.exists() or self.journal_path.exists()
+
+    def read(self) -> Optional[Dict[str, Any]]:
+        snapshot_hash = self._current_snapshot_hash()
+        data = self.snapshot.read()
+        updates = self._read_journal(snapshot_hash)
+        if data is None and len(updates) == 0:
+            return None
+
+        data = data or {}
+        repositories: List[Dict[str, Any]] = data.setdefault("repositories", [])
+        positions: Dict[Tuple[str, str], int] = {
+            (repository["owner"], repository["name"]): i
+            for i, repository in enumerate(repositories)
+        }
+        for update in updates:
+            key = (update["owner"], update["name"])
+            if key in positions:
+                repositories[positions[key]] = update
+            else:
+                positions[key] = len(repositories)
+                repositories.append(update)
+
+        return data
+
+    def _read_journal(self, snapshot_hash: str) -> List[Dict[str, Any]]:
+        if not self.journal_path.exists():
+            self._entries = 0
+            return []
+
+        with open(self.journal_path) as f:
+            lines = f.readlines()
+
+        header = _journal_header(lines[0]) if len(lines) > 0 else None
+        if header is not None:
+            if header != snapshot_hash:
+                # the snapshot was rewritten, but the journal not removed
+                warning(
+                    f"Ignoring {self.journal_path}, "
+                    f"it is already part of {self.snapshot.path}"
+                )
+                self._entries = 0
+                return []
+            lines = lines[1:]
+
+        updates = []
+        for number, line in enumerate(lines, start=1):
+            try:
+                updates.append(json.loads(line)["repository"])
+            except (ValueError, KeyError):
+                # left by an interrupted append, the update was never acknowledged
+                warning(f"Ignoring incomplete entry {number} of {self.journal_path}")
+
+        self._entries = len(updates)
+        return updates
+
+    def write(self, data: Dict[str, Any]) -> None:
+        content = self.snapshot.encode(data)
+        snapshot_hash = hashlib.sha256(content).hexdigest()
+        if self.journal_path.exists():
+            header = self._read_journal_header()
+            if header is None:
+                # a journal of an earlier version, tie it to the current snapshot
+                self._add_journal_header()
+            elif header == snapshot_hash:
+                # the snapshot stays the same, but the journal would be
+                # replayed over it if the removal below was interrupted
+                self.journal_path.unlink()
+
+        atomic_write(self.snapshot.path, content)
+        # the snapshot contains every update, so the journal can start over
+        self.journal_path.unlink(missing_ok=True)
+        self._entries = 0
+
+    def write_repository(self, repository: Dict[str, Any]) -> None:
+        snapshot_hash = self._current_snapshot_hash()
+        header = self._read_journal_header()
+        if not self.journal_path.exists() or (
+            header is not None and header != snapshot_hash
+        ):
+            # start a journal for the current snapshot, replacing an outdated one
+            header_line = json.dumps({JOURNAL_HEADER_KEY: snapshot_hash})
+            atomic_write(self.journal_path, f"{header_line}\n")
+            self._entries = 0
+
+        entries = self._count_entries()
+        line = json.dumps({"repository": repository}, sort_keys=True)
+        if not self._ends_with_newline():
+            line = f"\n{line}"  # don't continue an interrupted append
+
+        with open(self.journal_path, "a") as f:
+            f.write(f"{line}\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._entries = entries + 1
+
+    def _current_snapshot_hash(self) -> str:
+        """Hash of the snapshot on disk, only computed again if it changed"""
+        try:
+            stat = os.stat(self.snapshot.path)
+        except FileNotFoundError:
+            return ""
+
+        key = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+        if self._snapshot_hash is None or self._snapshot_hash[0] != key:
+            digest = hashlib.sha256()
+            with open(self.snapshot.path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            self._snapshot_hash = (key, digest.hexdigest())
+        return self._snapshot_hash[1]
+
+    def _add_journal_header(self) -> None:
+        header_line = json.dumps({JOURNAL_HEADER_KEY: self._current_snapshot_hash()})
+        with open(self.journal_path) as f:
+            atomic_write(self.journal_path, f"{header_line}\n{f.read()}")
+
+    def _read_journal_header(self) -> Optional[str]:
+        try:
+            with open(self.journal_path) as f:
+                return _journal_header(f.readline())
+        except FileNotFoundError:
+            return None
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.journal_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def _count_entries(self) -> int:
+        if self._entries is None:
+            if self.journal_path.exists():
+                with open(self.journal_path) as f:
+                    self._entries = sum(1 for _ in f)
+            else:
+                self._entries = 0
+        return self._entries
+
+    def needs_compaction(self, repository_count: int) -> bool:
+        return self._count_entries() >= max(MIN_COMPACTION_ENTRIES, repository_count)
+
+
+def _journal_header(line: str) -> Optional[str]:
+    """
+    The snapshot hash of a journal's first line, None if it is an entry:
+    journals of earlier versions have no header and continue any snapshot
+    """
+    try:
+        header = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(header, dict):
+        return None
+    return header.get(JOURNAL_HEADER_KEY)
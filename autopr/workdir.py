@@ -1,25 +1,64 @@
 import json
+import os
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Iterable, List, Optional, Tuple
 
-import yaml
-from marshmallow import ValidationError
-
-from autopr import config, database
+from autopr import database, storage
 from autopr.util import CliException, warning
 
+if TYPE_CHECKING:
+    from autopr import config
+
 CONFIG_FILE_NAME = "config.yaml"
 DB_FILE_NAME = "db.json"
+DB_BINARY_FILE_NAME = "db.bin"
 REPOS_DIR_NAME = "repos"
+HTTP_CACHE_DIR_NAME = "http-cache"
+SSH_DIR_NAME = "ssh"
+LOGS_DIR_NAME = "logs"
+PATCHES_DIR_NAME = "patches"
+
+# identifies the content of a set of files without reading them
+FileStamp = Tuple[Optional[Tuple[int, int, int]], ...]
+
+
+def _file_stamp(paths: Iterable[Path]) -> FileStamp:
+    stamps: List[Optional[Tuple[int, int, int]]] = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            stamps.append(None)
+        else:
+            stamps.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+    return tuple(stamps)
 
 
 class WorkDir:
+    """
+    Session on a working directory. The parsed config and database are kept
+    for the lifetime of the object and only loaded again once their files
+    change on disk, so they can be requested as often as needed.
+    """
+
     location: Path
     _custom_repos_dir: Optional[Path]
+    _storage: Optional[storage.JournalStorage]
+    _config: Optional[Tuple[FileStamp, "config.Config"]]
+    _database: Optional[Tuple[FileStamp, database.Database]]
 
     def __init__(self, location: Path, custom_repos_dir: Optional[Path] = None):
         self.location = location
         self._custom_repos_dir = custom_repos_dir
+        self._storage = None
+        self._config = None
+        self._database = None
+
+    @property
+    def storage(self) -> storage.JournalStorage:
+        if self._storage is None:
+            self._storage = _create_storage(self, _detect_database_format(self))
+        return self._storage
 
     @property
     def config_file(self) -> Path:
@@ -29,6 +68,26 @@ class WorkDir:
     def database_file(self) -> Path:
         return self.location / DB_FILE_NAME
 
+    @property
+    def binary_database_file(self) -> Path:
+        return self.location / DB_BINARY_FILE_NAME
+
+    @property
+    def http_cache_dir(self) -> Path:
+        return self.location / HTTP_CACHE_DIR_NAME
+
+    @property
+    def ssh_dir(self) -> Path:
+        return self.location / SSH_DIR_NAME
+
+    @property
+    def logs_dir(self) -> Path:
+        return self.location / LOGS_DIR_NAME
+
+    @property
+    def patches_dir(self) -> Path:
+        return self.location / PATCHES_DIR_NAME
+
     @property
     def repos_dir(self) -> Path:
         # Priority: 1. CLI option, 2. Config file, 3. Default
@@ -49,7 +108,21 @@ class WorkDir:
         return self.location / REPOS_DIR_NAME
 
 
-def init(wd: WorkDir, credentials: config.Credentials):
+def _detect_database_format(wd: WorkDir) -> str:
+    if wd.binary_database_file.exists():
+        return storage.FORMAT_BINARY
+    return storage.FORMAT_JSON
+
+
+def _create_storage(wd: WorkDir, database_format: str) -> storage.JournalStorage:
+    if database_format == storage.FORMAT_BINARY:
+        return storage.JournalStorage(storage.BinaryStorage(wd.binary_database_file))
+    return storage.JournalStorage(storage.JsonStorage(wd.database_file))
+
+
+def init(wd: WorkDir, credentials: "config.Credentials"):
+    from autopr import config
+
     # Determine repos dir and validate/create
     repos_dir_to_use = wd.repos_dir
     is_custom_repos_dir = wd._custom_repos_dir is not None or (
@@ -75,15 +148,20 @@ def init(wd: WorkDir, credentials: config.Credentials):
         warning("config file exists - not overriding")
 
     # create empty database
-    if not wd.database_file.exists():
+    if not wd.storage.exists():
         db = database.Database()
         write_database(wd, db)
     else:
         warning("database file exists - not overriding")
 
 
-def write_config(wd: WorkDir, cfg: config.Config):
+def write_config(wd: WorkDir, cfg: "config.Config"):
+    import yaml
+
+    from autopr import config
+
     # load config file
+    wd._config = None
     try:
         data = config.CONFIG_SCHEMA.dump(cfg)
         with open(wd.config_file, "w") as config_file:
@@ -92,7 +170,23 @@ def write_config(wd: WorkDir, cfg: config.Config):
         raise CliException(f"Failed to write config file: {e}")
 
 
-def read_config(wd: WorkDir) -> config.Config:
+def read_config(wd: WorkDir) -> "config.Config":
+    stamp = _file_stamp([wd.config_file])
+    if wd._config is not None and wd._config[0] == stamp:
+        return wd._config[1]
+
+    cfg = _load_config(wd)
+    wd._config = (stamp, cfg)
+    return cfg
+
+
+def _load_config(wd: WorkDir) -> "config.Config":
+    # yaml and marshmallow are slow to import, commands without config skip them
+    import yaml
+    from marshmallow import ValidationError
+
+    from autopr import config
+
     # load config file
     try:
         with open(wd.config_file) as config_file:
@@ -111,33 +205,115 @@ def read_config(wd: WorkDir) -> config.Config:
 
 def write_database(wd: WorkDir, db: database.Database):
     # load database file
+    wd._database = None
     try:
-        data = database.DATABASE_SCHEMA.dump(db)
-        with open(wd.database_file, "w") as database_file:
-            json.dump(data, database_file, indent=4, sort_keys=True)
+        data = database.database_to_dict(db)
+        wd.storage.write(data)
     except IOError as e:
         raise CliException(f"Failed to write database file: {e}")
 
+    wd._database = (_file_stamp(wd.storage.files()), db)
+
+
+def update_repository(
+    wd: WorkDir, db: database.Database, repository: database.Repository
+):
+    """Persist the changes of a single repository of the database"""
+    if wd.storage.needs_compaction(len(db.repositories)):
+        write_database(wd, db)
+        return
+
+    cached = wd._database
+    is_current = (
+        cached is not None
+        and cached[1] is db
+        and cached[0] == _file_stamp(wd.storage.files())
+    )
+    wd._database = None
+    try:
+        data = database.repository_to_dict(repository)
+        wd.storage.write_repository(data)
+    except IOError as e:
+        raise CliException(f"Failed to write database file: {e}")
+
+    # the cached database already contains the change
+    if is_current:
+        wd._database = (_file_stamp(wd.storage.files()), db)
+
 
 def read_database(wd: WorkDir) -> database.Database:
-    if not wd.database_file.exists():
+    """
+    Returns the same database object until the files change on disk, so
+    changes to it are seen by every reader of this workdir
+    """
+    stamp = _file_stamp(wd.storage.files())
+    if wd._database is not None and wd._database[0] == stamp:
+        return wd._database[1]
+
+    db = _load_database(wd)
+    wd._database = (stamp, db)
+    return db
+
+
+def _load_database(wd: WorkDir) -> database.Database:
+    # load database file
+    try:
+        database_dict = wd.storage.read()
+    except IOError as e:
+        raise CliException(f"Failed to read database file: {e}")
+    except (ValueError, EOFError) as e:
+        raise CliException(f"Failed to parse database: {e}")
+
+    if database_dict is None:
         db = database.Database()
         return db
 
-    # load database file
+    # parse database data
+    try:
+        return database.database_from_dict(database_dict)
+    except database.DecodeError as err:
+        raise CliException(f"Failed to deserialize database: {err}")
+
+
+def export_database(wd: WorkDir, path: Path):
+    """Write the database as a single JSON file in the format of db.json"""
+    db = read_database(wd)
+    try:
+        storage.JsonStorage(path).write(database.database_to_dict(db))
+    except IOError as e:
+        raise CliException(f"Failed to export database: {e}")
+
+
+def import_database(wd: WorkDir, path: Path):
+    """Replace the database with the content of a JSON file in the format of db.json"""
     try:
-        with open(wd.database_file) as database_file:
-            database_dict = json.load(database_file)
+        database_dict = storage.JsonStorage(path).read()
     except IOError as e:
         raise CliException(f"Failed to read database file: {e}")
     except json.JSONDecodeError as e:
         raise CliException(f"Failed to parse database: {e}")
 
-    # parse database data
     try:
-        return database.DATABASE_SCHEMA.load(database_dict)
-    except ValidationError as err:
-        raise CliException(f"Failed to deserialize database: {err.messages}")
+        db = database.database_from_dict(database_dict or {})
+    except database.DecodeError as err:
+        raise CliException(f"Failed to deserialize database: {err}")
+
+    write_database(wd, db)
+
+
+def convert_database(wd: WorkDir, database_format: str):
+    """Switch the workdir to store its database in the given format"""
+    if wd.storage.format == database_format:
+        return
+
+    db = read_database(wd)
+    old_storage = wd.storage
+    wd._storage = _create_storage(wd, database_format)
+    write_database(wd, db)
+
+    # only remove the old files once the new ones are complete
+    for path in old_storage.files():
+        path.unlink(missing_ok=True)
 
 
 def get(wd_path: str, custom_repos_dir: Optional[Path] = None) -> WorkDir:
@@ -0,0 +1,75 @@
+"""
+Compares loading and saving the database through the marshmallow schema with
+the fast codec, for JSON and the binary format.
+
+    uv run python benchmarks/database_codec.py [SIZE ...]
+"""
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List
+
+from autopr import database, storage
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+
+
+def _create_database(size: int) -> database.Database:
+    return database.Database(
+        user=database.GitUser(name="Joe Schmoe", email="joe@example.com"),
+        repositories=[
+            database.Repository(
+                owner="getyourguide",
+                name=f"repository-{i}",
+                ssh_url=f"git@github.com:getyourguide/repository-{i}.git",
+                default_branch="main",
+                existing_pr=i if i % 3 == 0 else None,
+                done=i % 2 == 0,
+                last_run_sha="0123456789abcdef0123456789abcdef01234567",
+                github_id=i,
+            )
+            for i in range(size)
+        ],
+    )
+
+
+def _measure(func: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main(sizes: List[int]) -> None:
+    print(f"{'repos':>8} {'variant':<22} {'save (s)':>10} {'load (s)':>10}")
+    for size in sizes:
+        db = _create_database(size)
+        with tempfile.TemporaryDirectory() as tmp:
+            json_storage = storage.JsonStorage(Path(tmp) / "db.json")
+            binary_storage = storage.BinaryStorage(Path(tmp) / "db.bin")
+
+            variants = [
+                (
+                    "marshmallow + json",
+                    lambda: json_storage.write(database.DATABASE_SCHEMA.dump(db)),
+                    lambda: database.DATABASE_SCHEMA.load(json_storage.read()),
+                ),
+                (
+                    "fast codec + json",
+                    lambda: json_storage.write(database.database_to_dict(db)),
+                    lambda: database.database_from_dict(json_storage.read()),
+                ),
+                (
+                    "fast codec + binary",
+                    lambda: binary_storage.write(database.database_to_dict(db)),
+                    lambda: database.database_from_dict(binary_storage.read()),
+                ),
+            ]
+            for name, save, load in variants:
+                save_time = _measure(save)
+                load_time = _measure(load)
+                print(f"{size:>8} {name:<22} {save_time:>10.3f} {load_time:>10.3f}")
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or DEFAULT_SIZES)
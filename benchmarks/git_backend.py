@@ -0,0 +1,93 @@
+"""
+Compares the git backends on the local operations `run` does for every
+repository: reset the branch, stage the changes of the update command,
+check whether anything changed, commit and resolve the default branch.
+
+    uv run --extra libgit2 python benchmarks/git_backend.py [--files N] [--runs N]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Tuple
+from unittest import mock
+
+from autopr import repo
+
+
+def _create_repository(path: Path, files: int) -> None:
+    subprocess.check_output(["git", "init", "-q", "-b", "main", f"{path}"])
+    for key, value in [
+        ("user.name", "Benchmark"),
+        ("user.email", "benchmark@example.com"),
+        ("commit.gpgsign", "false"),
+    ]:
+        subprocess.check_output(["git", "-C", f"{path}", "config", key, value])
+    for i in range(files):
+        directory = path / f"dir{i % 50}"
+        directory.mkdir(exist_ok=True)
+        (directory / f"file{i}.txt").write_text(f"content {i}\n")
+    subprocess.check_output(["git", "-C", f"{path}", "add", "--all"])
+    subprocess.check_output(["git", "-C", f"{path}", "commit", "-q", "-m", "initial"])
+    # files written in the same second as the index look modified to git and
+    # libgit2 until the index is refreshed, unlike in clones that are in use
+    time.sleep(1.1)
+    subprocess.check_output(["git", "-C", f"{path}", "status", "--porcelain"])
+
+
+def _run_once(backend: repo.GitBackend, path: Path, changed: bool) -> None:
+    backend.reset_to_branch(path, "main", "autopr")
+    if changed:
+        (path / "dir0" / "file0.txt").write_text("updated\n")
+    backend.add_all(path)
+    if backend.has_staged_changes(path):
+        backend.commit(path, "Update")
+    backend.rev_parse(path, "refs/heads/main")
+
+
+def _measure(
+    backend: repo.GitBackend, path: Path, runs: int, changed: bool
+) -> Tuple[List[float], int]:
+    times = []
+    with mock.patch("autopr.repo.run_cmd", wraps=repo.run_cmd) as run_cmd:
+        for _ in range(runs):
+            start = time.perf_counter()
+            _run_once(backend, path, changed)
+            times.append(time.perf_counter() - start)
+    return times, run_cmd.call_count // runs
+
+
+def main(files: int, runs: int) -> int:
+    backends: List[repo.GitBackend] = [repo.GitBackend()]
+    try:
+        backends.append(repo.LibGit2Backend())
+    except repo.CliException as e:
+        print(f"skipping libgit2: {e}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "repository"
+        _create_repository(path, files)
+
+        print(f"{files} files, {runs} runs per case")
+        print(f"{'backend':<10} {'changes':<8} {'median (ms)':>12} {'processes':>10}")
+        for backend in backends:
+            for changed in [False, True]:
+                with mock.patch("autopr.util.DEBUG", False):
+                    times, processes = _measure(backend, path, runs, changed)
+                median = statistics.median(times) * 1000
+                print(
+                    f"{backend.name:<10} {'yes' if changed else 'no':<8} "
+                    f"{median:>12.1f} {processes:>10}"
+                )
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--runs", type=int, default=20)
+    arguments = parser.parse_args()
+    sys.exit(main(arguments.files, arguments.runs))
@@ -0,0 +1,65 @@
+"""
+Measures the latency of git transport commands with and without shared SSH
+connections. Every operation is a `git ls-remote` of the default branch,
+the smallest exchange a fetch or push starts with, so the difference is
+the handshake saved per clone, fetch and push of a `pull` or `run`.
+
+    uv run python benchmarks/ssh_multiplexing.py git@github.com:ORG/REPO.git \
+        --key ~/.ssh/id_rsa [--runs N]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+from autopr import ssh
+
+
+def _measure(ssh_url: str, key: Path, runs: int) -> List[float]:
+    times = []
+    for _ in range(runs):
+        env = {**os.environ, "GIT_SSH_COMMAND": ssh.git_ssh_command(key)}
+        start = time.perf_counter()
+        subprocess.run(
+            ["git", "ls-remote", ssh_url, "HEAD"],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main(ssh_url: str, key: Path, runs: int) -> int:
+    plain = _measure(ssh_url, key, runs)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ssh.start(Path(tmp) / "ssh", connections=1)
+        try:
+            # the first command opens the master connection
+            opening = _measure(ssh_url, key, 1)[0]
+            shared = _measure(ssh_url, key, runs)
+        finally:
+            ssh.stop()
+
+    print(f"{'connection':<12} {'median (s)':>10} {'min (s)':>10}")
+    print(f"{'own':<12} {statistics.median(plain):>10.3f} {min(plain):>10.3f}")
+    print(f"{'shared':<12} {statistics.median(shared):>10.3f} {min(shared):>10.3f}")
+    print(f"opening the shared connection took {opening:.3f}s")
+    saved = statistics.median(plain) - statistics.median(shared)
+    print(f"saved per operation: {saved:.3f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ssh_url")
+    parser.add_argument("--key", type=Path, default=Path("~/.ssh/id_rsa"))
+    parser.add_argument("--runs", type=int, default=10)
+    arguments = parser.parse_args()
+    sys.exit(main(arguments.ssh_url, arguments.key.expanduser(), arguments.runs))
@@ -0,0 +1,81 @@
+"""
+Measures how long `auto-pr` takes to start for commands which don't need
+GitHub, and which slow dependencies get imported on the way. Exits with an
+error if the median of a command exceeds the budget.
+
+    uv run python benchmarks/startup.py [--runs N] [--budget SECONDS]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+
+# dependencies that must only be imported by the commands using them
+HEAVY_MODULES = [
+    "github",
+    "marshmallow",
+    "marshmallow_dataclass",
+    "requests",
+    "single_source",
+    "yaml",
+]
+
+COMMANDS = [
+    ["--help"],
+    ["--version"],
+    ["reset", "all"],
+    ["status"],
+]
+
+
+def _run(args: List[str], env: dict) -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", "autopr", *args],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+def _imported_heavy_modules() -> List[str]:
+    code = (
+        "import sys, autopr; "
+        f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    output = subprocess.check_output([sys.executable, "-c", code], text=True)
+    return output.split()
+
+
+def main(runs: int, budget: float) -> int:
+    heavy = _imported_heavy_modules()
+    print(f"heavy modules imported by 'import autopr': {', '.join(heavy) or 'none'}")
+
+    failed = len(heavy) > 0
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ, "APR_WORKDIR": tmp}
+        (Path(tmp) / "db.json").write_text("{}")
+
+        print(f"{'command':<12} {'median (s)':>10} {'min (s)':>10}")
+        for args in COMMANDS:
+            times = [_run(args, env) for _ in range(runs)]
+            median = statistics.median(times)
+            print(f"{' '.join(args):<12} {median:>10.3f} {min(times):>10.3f}")
+            failed = failed or median > budget
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget", type=float, default=0.5)
+    arguments = parser.parse_args()
+    sys.exit(main(arguments.runs, arguments.budget))
@@ -0,0 +1,92 @@
+from typing import List
+
+import pytest
+
+from autopr.concurrency import AdaptiveConcurrency, FixedConcurrency
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _round(
+    controller: AdaptiveConcurrency,
+    clock: FakeClock,
+    seconds: float,
+    failed: int = 0,
+    throttled: bool = False,
+) -> None:
+    size = max(controller.limit, 4)
+    clock.now += seconds
+    for i in range(size):
+        controller.record(failed=i < failed, throttled=throttled and i == 0)
+
+
+def test_adaptive_concurrency_grows_while_throughput_keeps_up():
+    clock = FakeClock()
+    controller = AdaptiveConcurrency(maximum=10, clock=clock)
+    assert controller.limit == 4
+
+    limits: List[int] = []
+    for _ in range(3):
+        _round(controller, clock, seconds=1.0)
+        limits.append(controller.limit)
+
+    assert limits == [5, 6, 7]
+    assert controller.peak == 7
+
+
+def test_adaptive_concurrency_steps_back_when_throughput_drops():
+    clock = FakeClock()
+    controller = AdaptiveConcurrency(maximum=10, clock=clock)
+
+    _round(controller, clock, seconds=1.0)  # 4/s at 4
+    _round(controller, clock, seconds=5.0)  # 1/s at 5
+    assert controller.limit == 4
+    assert controller.peak == 5
+
+
+@pytest.mark.parametrize("failed, throttled", [(0, True), (4, False)])
+def test_adaptive_concurrency_halves_on_throttling_or_errors(failed, throttled):
+    clock = FakeClock()
+    controller = AdaptiveConcurrency(maximum=32, initial=16, clock=clock)
+
+    _round(controller, clock, seconds=1.0, failed=failed, throttled=throttled)
+    assert controller.limit == 8
+
+
+def test_adaptive_concurrency_tolerates_occasional_errors():
+    clock = FakeClock()
+    controller = AdaptiveConcurrency(maximum=32, initial=16, clock=clock)
+
+    _round(controller, clock, seconds=1.0, failed=1)
+    assert controller.limit == 17
+
+
+def test_adaptive_concurrency_stays_within_limits():
+    clock = FakeClock()
+    controller = AdaptiveConcurrency(maximum=5, minimum=2, clock=clock)
+
+    for _ in range(5):
+        _round(controller, clock, seconds=1.0)
+    assert controller.limit == 5
+
+    for _ in range(5):
+        _round(controller, clock, seconds=1.0, throttled=True)
+    assert controller.limit == 2
+
+
+def test_adaptive_concurrency_rejects_invalid_limits():
+    with pytest.raises(ValueError):
+        AdaptiveConcurrency(maximum=2, minimum=3)
+
+
+def test_fixed_concurrency_ignores_results():
+    controller = FixedConcurrency(3)
+    controller.record(failed=True, throttled=True)
+    assert controller.limit == 3
+    assert controller.maximum == 3
@@ -372,6 +372,33 @@ class TestConfigSchema(unittest.TestCase):
         self.assertIn("MISSING_REPOS_VAR", str(context.exception))
         self.assertIn("not set", str(context.exception))
 
+    def test_config_rejects_batch_mode_with_deduplicate(self):
+        """Test that batch mode can't be combined with deduplicate"""
+        from marshmallow import ValidationError
+
+        from autopr.config import CONFIG_SCHEMA
+
+        data = {
+            "credentials": {"api_key": "test_key", "ssh_key_file": "/test/key"},
+            "pr": {
+                "title": "Test PR",
+                "message": "Test message",
+                "branch": "test-branch",
+                "body": "Test body",
+                "draft": False,
+            },
+            "update_command": ["echo", "test"],
+            "update_command_mode": "batch",
+            "deduplicate": True,
+        }
+
+        with self.assertRaises(ValidationError) as context:
+            CONFIG_SCHEMA.load(data)
+        self.assertIn("deduplicate", context.exception.messages)
+
+        data["deduplicate"] = False
+        self.assertEqual(CONFIG_SCHEMA.load(data).update_command_mode, "batch")
+
     def test_config_custom_repos_dir_serialization(self):
         """Test that Config correctly serializes custom_repos_dir"""
         from autopr.config import CONFIG_SCHEMA, Config, Credentials, PrTemplate
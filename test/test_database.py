@@ -1,8 +1,15 @@
+import contextlib
+import copy
+import io
 import unittest
 from test.test_utils import get_repository
+from typing import Any, Dict
 from unittest.mock import Mock
 
-from autopr.database import Database
+import pytest
+from marshmallow import ValidationError
+
+from autopr.database import DATABASE_SCHEMA, Database, DecodeError, database_from_dict
 
 
 class DatabaseTest(unittest.TestCase):
@@ -100,6 +107,116 @@ class DatabaseTest(unittest.TestCase):
         self.assertEqual(1, len(repositories))
         self.assertEqual("non-removed", repositories[0].name)
 
+    def test_get_repository(self):
+        db = Database(
+            user=Mock(),
+            repositories=[get_repository("first"), get_repository("second")],
+        )
+
+        self.assertEqual("second", db.get_repository("den", "second").name)
+        self.assertIsNone(db.get_repository("other", "second"))
+
+        # changes made to the list directly are picked up as well
+        db.repositories.append(get_repository("third"))
+        self.assertEqual("third", db.get_repository("den", "third").name)
+
+    def test_upsert_refreshes_existing(self):
+        existing = get_repository("first", done=True)
+        existing.existing_pr = 3
+        db = Database(user=Mock(), repositories=[existing])
+
+        result = db.upsert(get_repository("first", default_branch="develop"))
+
+        self.assertIs(existing, result)
+        self.assertEqual(1, len(db.repositories))
+        self.assertEqual("develop", existing.default_branch)
+        self.assertEqual(3, existing.existing_pr)
+        self.assertTrue(existing.done)
+
+    def test_upsert_follows_renames(self):
+        existing = get_repository("old-name")
+        existing.github_id = 42
+        db = Database(user=Mock(), repositories=[existing])
+
+        renamed = get_repository("new-name")
+        renamed.github_id = 42
+        db.upsert(renamed)
+
+        self.assertEqual(1, len(db.repositories))
+        self.assertEqual("new-name", db.repositories[0].name)
+        self.assertIs(existing, db.get_repository("den", "new-name"))
+        self.assertIs(existing, db.get_repository_by_id(42))
+        self.assertIsNone(db.get_repository("den", "old-name"))
+
+    def test_merge_into_marks_removed(self):
+        db_first = Database(
+            user=Mock(),
+            repositories=[
+                get_repository("first"),
+                get_repository("second", removed=True),
+            ],
+        )
+        db_second = Database(user=Mock(), repositories=[get_repository("second")])
+
+        db_first.merge_into(db_second)
+
+        self.assertTrue(db_first.repositories[0].removed)
+        self.assertFalse(db_first.repositories[1].removed)
+
+    def test_reset_from_unknown(self):
+        db = Database(user=Mock(), repositories=[get_repository("first", done=True)])
+
+        db.reset_from(selected_repos=["den/unknown", "den/first"])
+
+        self.assertFalse(db.repositories[0].done)
+
+    def test_reset_from_output(self):
+        db = Database(user=Mock(), repositories=[get_repository("first", done=True)])
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            db.reset_from(selected_repos=["den/unknown", "den/first", "den/first"])
+
+        self.assertEqual(
+            "den/first was reset\nden/unknown was not in the database\n",
+            output.getvalue(),
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
+
+
+def _repository_dict(**values) -> Dict[str, Any]:
+    return {
+        "owner": "den",
+        "name": "repo",
+        "ssh_url": "git@github.com:den/repo.git",
+        "default_branch": "main",
+        **values,
+    }
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        {"pull_duration": 3},
+        {"pull_duration": 2.5, "size": 10, "existing_pr": 1, "done": True},
+        {"existing_pr": None, "last_run_changed": None},
+    ],
+)
+def test_codec_loads_like_schema(values: Dict[str, Any]):
+    data = {"user": None, "repositories": [_repository_dict(**values)]}
+
+    assert database_from_dict(copy.deepcopy(data)) == DATABASE_SCHEMA.load(
+        copy.deepcopy(data)
+    )
+
+
+@pytest.mark.parametrize("values", [{"size": True}, {"pull_duration": False}])
+def test_codec_rejects_booleans_as_numbers_like_schema(values: Dict[str, Any]):
+    data = {"user": None, "repositories": [_repository_dict(**values)]}
+
+    with pytest.raises(DecodeError):
+        database_from_dict(copy.deepcopy(data))
+    with pytest.raises(ValidationError):
+        DATABASE_SCHEMA.load(copy.deepcopy(data))
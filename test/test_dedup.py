@@ -0,0 +1,67 @@
+import threading
+from typing import List, Optional
+
+import pytest
+
+from autopr import dedup
+
+
+@pytest.fixture
+def results():
+    results = dedup.UpdateResults()
+    yield results
+    results.close()
+
+
+def test_first_claim_runs_later_ones_reuse(results: dedup.UpdateResults):
+    assert results.claim("tree", "one") is None
+    results.store("tree", "diff --git a/f b/f\n")
+
+    shared = results.claim("tree", "two")
+
+    assert shared is not None
+    assert shared.repository == "one"
+    assert shared.patch_file is not None
+    assert shared.patch_file.read_text() == "diff --git a/f b/f\n"
+    assert results.claim("other tree", "two") is None
+
+
+def test_result_without_changes(results: dedup.UpdateResults):
+    assert results.claim("tree", "one") is None
+    results.store("tree", "")
+
+    shared = results.claim("tree", "two")
+
+    assert shared is not None
+    assert shared.patch_file is None
+
+
+def test_claim_waits_for_running_command(results: dedup.UpdateResults):
+    assert results.claim("tree", "one") is None
+    claimed: List[Optional[dedup.SharedResult]] = []
+    waiter = threading.Thread(
+        target=lambda: claimed.append(results.claim("tree", "two"))
+    )
+    waiter.start()
+
+    waiter.join(timeout=0.1)
+    assert waiter.is_alive()
+    results.store("tree", "")
+    waiter.join(timeout=5)
+
+    assert len(claimed) == 1 and claimed[0] is not None
+
+
+def test_released_claim_is_taken_over(results: dedup.UpdateResults):
+    assert results.claim("tree", "one") is None
+    claimed: List[Optional[dedup.SharedResult]] = []
+    waiter = threading.Thread(
+        target=lambda: claimed.append(results.claim("tree", "two"))
+    )
+    waiter.start()
+
+    results.release("tree")
+    waiter.join(timeout=5)
+
+    # the waiting repository has to run the command itself
+    assert claimed == [None]
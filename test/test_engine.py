@@ -0,0 +1,63 @@
+import asyncio
+import io
+import os
+
+import pytest
+
+from autopr import engine, logs
+from autopr.util import CliException
+
+
+def test_run_cmd_returns_output():
+    assert asyncio.run(engine.run_cmd(["echo", "hello"])) == "hello\n"
+
+
+def test_run_cmd_raises_on_failure():
+    with pytest.raises(CliException, match="code: 3"):
+        asyncio.run(engine.run_cmd(["sh", "-c", "echo broken; exit 3"]))
+
+
+def test_run_cmd_streams_final_progress_states():
+    stream = io.StringIO()
+    output = logs.PrefixedOutput("[repo] ", stream)
+    command = ["printf", "Receiving: 1%%\rReceiving: 100%%, done.\nremote: ok\n"]
+
+    captured = asyncio.run(engine.run_cmd(command, output=output))
+
+    assert stream.getvalue() == (
+        "[repo]     Receiving: 100%, done.\n[repo]     remote: ok\n"
+    )
+    assert captured == "Receiving: 1%\rReceiving: 100%, done.\nremote: ok\n"
+
+
+def test_prefixed_output_writes_complete_lines():
+    stream = io.StringIO()
+    output = logs.PrefixedOutput("[repo] ", stream)
+
+    output.write("first\nsec")
+    assert stream.getvalue() == "[repo] first\n"
+    output.write("ond\n")
+    output.write("partial")
+    output.flush()
+    assert stream.getvalue() == "[repo] first\n[repo] second\n[repo] partial\n"
+
+
+def test_cancelled_command_is_terminated():
+    stream = io.StringIO()
+    output = logs.PrefixedOutput("", stream)
+
+    async def cancel_running_command():
+        task = asyncio.create_task(
+            engine.run_cmd(["sh", "-c", "echo $$; exec sleep 30"], output=output)
+        )
+        while stream.getvalue() == "":
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(asyncio.wait_for(cancel_running_command(), 10))
+
+    pid = int(stream.getvalue())
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
@@ -0,0 +1,106 @@
+import subprocess
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from autopr import repo
+
+
+def _git(repo_dir: Path, *args: str) -> str:
+    return subprocess.check_output(["git", "-C", f"{repo_dir}", *args]).decode()
+
+
+@pytest.fixture(params=repo.GIT_BACKENDS)
+def backend(request) -> repo.GitBackend:
+    if request.param == repo.GIT_BACKEND_LIBGIT2:
+        pytest.importorskip("pygit2")
+        return repo.LibGit2Backend()
+    return repo.GitBackend()
+
+
+@pytest.fixture
+def repo_dir(tmp_path: Path) -> Path:
+    repo_dir = tmp_path / "repo"
+    subprocess.check_output(["git", "init", "-b", "main", f"{repo_dir}"])
+    _git(repo_dir, "config", "user.name", "Test")
+    _git(repo_dir, "config", "user.email", "test@test.com")
+    _git(repo_dir, "config", "commit.gpgsign", "false")
+    (repo_dir / "keep.txt").write_text("keep")
+    (repo_dir / "remove.txt").write_text("remove")
+    _git(repo_dir, "add", "--all")
+    _git(repo_dir, "commit", "-m", "first")
+    return repo_dir
+
+
+def test_reset_to_branch_discards_changes(backend, repo_dir):
+    _git(repo_dir, "checkout", "-b", "autopr")
+    (repo_dir / "keep.txt").write_text("changed")
+    _git(repo_dir, "commit", "-am", "previous run")
+    (repo_dir / "remove.txt").write_text("uncommitted")
+
+    backend.reset_to_branch(repo_dir, "main", "autopr")
+
+    assert _git(repo_dir, "symbolic-ref", "HEAD").strip() == "refs/heads/autopr"
+    assert _git(repo_dir, "rev-parse", "autopr") == _git(repo_dir, "rev-parse", "main")
+    assert (repo_dir / "keep.txt").read_text() == "keep"
+    assert _git(repo_dir, "status", "--porcelain") == ""
+
+
+def test_add_all_and_commit(backend, repo_dir):
+    backend.reset_to_branch(repo_dir, "main", "autopr")
+    assert not backend.has_staged_changes(repo_dir)
+
+    (repo_dir / "keep.txt").write_text("changed")
+    (repo_dir / "remove.txt").unlink()
+    (repo_dir / "new.txt").write_text("new")
+    backend.add_all(repo_dir)
+    assert backend.has_staged_changes(repo_dir)
+    assert "new.txt" in backend.staged_diff(repo_dir)
+
+    backend.commit(repo_dir, "Update files\n\n\nwith details  \n")
+
+    assert _git(repo_dir, "status", "--porcelain") == ""
+    assert _git(repo_dir, "log", "-1", "--format=%an <%ae>%n%B") == (
+        "Test <test@test.com>\nUpdate files\n\nwith details\n\n"
+    )
+    assert _git(repo_dir, "ls-files").split() == ["keep.txt", "new.txt"]
+    assert backend.rev_parse(repo_dir, "refs/heads/autopr") == (
+        _git(repo_dir, "rev-parse", "HEAD").strip()
+    )
+
+
+def test_has_staged_changes_does_not_render_the_diff(repo_dir):
+    (repo_dir / "keep.txt").write_text("changed")
+    _git(repo_dir, "add", "--all")
+
+    with mock.patch("autopr.repo.run_cmd", wraps=repo.run_cmd) as run_cmd:
+        assert repo.GitBackend().has_staged_changes(repo_dir)
+
+    command = run_cmd.call_args.args[0]
+    assert "--name-only" in command
+    assert "color.ui=always" not in command
+
+
+def test_libgit2_backend_hands_filtered_files_to_the_cli(repo_dir):
+    pytest.importorskip("pygit2")
+    (repo_dir / ".gitattributes").write_text("*.bin filter=lfs\n")
+    (repo_dir / "data.bin").write_text("data")
+
+    with mock.patch("autopr.repo.run_cmd", wraps=repo.run_cmd) as run_cmd:
+        repo.LibGit2Backend().add_all(repo_dir)
+
+    assert run_cmd.call_args.args[0][-2:] == ["add", "--all"]
+
+
+def test_libgit2_backend_commits_with_hooks_through_the_cli(repo_dir):
+    pytest.importorskip("pygit2")
+    hook = repo_dir / ".git" / "hooks" / "commit-msg"
+    hook.write_text("#!/bin/sh\necho '\\nSigned-off-by: Hook' >> \"$1\"\n")
+    hook.chmod(0o755)
+    (repo_dir / "keep.txt").write_text("changed")
+    _git(repo_dir, "add", "--all")
+
+    repo.LibGit2Backend().commit(repo_dir, "Update")
+
+    assert "Signed-off-by: Hook" in _git(repo_dir, "log", "-1", "--format=%B")
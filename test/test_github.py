@@ -1,8 +1,22 @@
+from pathlib import Path
+from test.test_utils import run_cli, simple_test_config, simple_test_database
 from unittest.mock import Mock, patch
 
+from github import GithubException
+
+from autopr import workdir
 from autopr.config import FILTER_MODE_ADD, FILTER_MODE_REMOVE, Filter, PrTemplate
 from autopr.database import Repository
-from autopr.github import FilterInfo, create_pr, gather_repository_list
+from autopr.github import (
+    FilterInfo,
+    PullRequestInfo,
+    create_pr,
+    gather_repository_list,
+    get_default_branch_tips,
+    get_pull_requests,
+    secondary_rate_limit_delay,
+)
+from autopr.ratelimit import DEFAULT_RETRY_AFTER
 
 
 @patch("autopr.github._list_all_repositories")
@@ -373,3 +387,153 @@ def _get_fake_repository_tuple(
     )
 
     return filter_info, repository
+
+
+def test_create_pr_retries_after_secondary_rate_limit():
+    mock_gh = Mock()
+    mock_gh_repo = Mock()
+    mock_pull_request = Mock()
+    mock_gh.get_repo.return_value = mock_gh_repo
+    mock_gh_repo.create_pull.side_effect = [
+        GithubException(
+            403,
+            {"message": "You have exceeded a secondary rate limit."},
+            {"Retry-After": "30"},
+        ),
+        mock_pull_request,
+    ]
+    limiter = Mock()
+
+    repository = Repository(
+        owner="test-owner",
+        name="test-repo",
+        ssh_url="git@github.com:test-owner/test-repo.git",
+        default_branch="main",
+    )
+    result = create_pr(mock_gh, repository, PrTemplate(), limiter)
+
+    assert result == mock_pull_request
+    assert limiter.acquire.call_count == 2
+    limiter.pause.assert_called_once_with(30.0)
+
+
+def test_secondary_rate_limit_delay():
+    assert secondary_rate_limit_delay(GithubException(404, {}, {})) is None
+    assert secondary_rate_limit_delay(GithubException(403, "forbidden", {})) is None
+    assert (
+        secondary_rate_limit_delay(
+            GithubException(403, {"message": "abuse detection mechanism triggered"}, {})
+        )
+        == DEFAULT_RETRY_AFTER
+    )
+    assert (
+        secondary_rate_limit_delay(GithubException(429, {}, {"retry-after": "12"}))
+        == 12.0
+    )
+
+
+def _repository_with_pr(name: str, existing_pr=None) -> Repository:
+    return Repository(
+        owner="owner",
+        name=name,
+        ssh_url=f"git@github.com:owner/{name}.git",
+        default_branch="main",
+        existing_pr=existing_pr,
+    )
+
+
+def test_get_pull_requests_batches_queries():
+    mock_gh = Mock()
+
+    def respond(verb, url, input):
+        data = {}
+        for alias in [key for key in input["variables"] if key.startswith("number")]:
+            i = alias[len("number") :]
+            number = input["variables"][alias]
+            data[f"r{i}"] = {
+                "pullRequest": {
+                    "number": number,
+                    "state": "MERGED" if number % 2 else "OPEN",
+                    "merged": bool(number % 2),
+                    "url": f"https://github.com/pr/{number}",
+                }
+            }
+        return {}, {"data": data}
+
+    mock_gh.requester.requestJsonAndCheck.side_effect = respond
+    repositories = [_repository_with_pr(f"repo-{i}", i) for i in range(1, 151)]
+    repositories.append(_repository_with_pr("no-pr"))
+
+    result = get_pull_requests(mock_gh, repositories)
+
+    assert mock_gh.requester.requestJsonAndCheck.call_count == 2
+    assert len(result) == 150
+    assert result["owner/repo-1"].merged
+    assert result["owner/repo-1"].state == "closed"
+    assert result["owner/repo-2"].state == "open"
+    assert result["owner/repo-2"].html_url == "https://github.com/pr/2"
+    query = mock_gh.requester.requestJsonAndCheck.call_args_list[0][1]["input"]
+    assert "r99: repository(owner: $owner99, name: $name99)" in query["query"]
+
+
+def test_get_pull_requests_skips_missing():
+    mock_gh = Mock()
+    mock_gh.requester.requestJsonAndCheck.return_value = (
+        {},
+        {
+            "data": {"r0": None},
+            "errors": [{"type": "NOT_FOUND", "message": "Could not resolve"}],
+        },
+    )
+
+    result = get_pull_requests(mock_gh, [_repository_with_pr("gone", 1)])
+
+    assert result == {}
+
+
+def test_get_pull_requests_without_prs_does_not_query():
+    mock_gh = Mock()
+
+    assert get_pull_requests(mock_gh, [_repository_with_pr("no-pr")]) == {}
+    mock_gh.requester.requestJsonAndCheck.assert_not_called()
+
+
+def test_get_default_branch_tips():
+    mock_gh = Mock()
+    mock_gh.requester.requestJsonAndCheck.return_value = (
+        {},
+        {
+            "data": {
+                "r0": {"defaultBranchRef": {"name": "main", "target": {"oid": "abc"}}},
+                "r1": {
+                    "defaultBranchRef": {"name": "renamed", "target": {"oid": "def"}}
+                },
+                "r2": None,
+            }
+        },
+    )
+    repositories = [_repository_with_pr(name) for name in ["one", "two", "gone"]]
+
+    result = get_default_branch_tips(mock_gh, repositories)
+
+    assert result == {"owner/one": "abc"}
+
+
+@patch("autopr._create_github_client")
+@patch("autopr.github.get_pull_requests")
+def test_close_reports_merged_pull_requests(
+    get_pull_requests_mock: Mock, _create_github_client: Mock, tmp_path
+):
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = simple_test_database()
+    db.repositories[0].existing_pr = 1
+    get_pull_requests_mock.return_value = {
+        db.repositories[0].full_name: PullRequestInfo(
+            number=1, state="closed", merged=True, html_url="https://pr/1"
+        )
+    }
+
+    result = run_cli(wd, ["close"], cfg=simple_test_config(), db=db)
+
+    assert "Pull request already merged for test (https://pr/1)" in result.output
+    _create_github_client.return_value.requester.requestJsonAndCheck.assert_not_called()
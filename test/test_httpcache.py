@@ -0,0 +1,98 @@
+import io
+from pathlib import Path
+from typing import List, Optional
+from unittest.mock import patch
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from autopr.httpcache import CachingAdapter, HttpCache
+
+
+def _response(status: int, body: str = "", etag: Optional[str] = None):
+    response = requests.Response()
+    response.status_code = status
+    response.encoding = "utf-8"
+    response._content = body.encode()
+    response.raw = io.BytesIO()
+    if etag:
+        response.headers["ETag"] = etag
+    response.headers["X-RateLimit-Remaining"] = "4999"
+    return response
+
+
+def _session(cache: HttpCache) -> requests.Session:
+    session = requests.Session()
+    session.mount("https://", CachingAdapter(cache))
+    return session
+
+
+def test_conditional_request_is_served_from_cache(tmp_path):
+    cache = HttpCache(Path(tmp_path))
+    sent_headers: List[dict] = []
+
+    def send(self, request, **kwargs):
+        sent_headers.append(dict(request.headers))
+        if request.headers.get("If-None-Match") == '"v1"':
+            return _response(304)
+        return _response(200, '{"name": "repo"}', etag='"v1"')
+
+    with patch.object(HTTPAdapter, "send", send):
+        first = _session(cache).get("https://api.github.com/repos/owner/repo")
+        # a new session, as if the next command was run
+        second = _session(HttpCache(Path(tmp_path))).get(
+            "https://api.github.com/repos/owner/repo"
+        )
+
+    assert "If-None-Match" not in sent_headers[0]
+    assert sent_headers[1]["If-None-Match"] == '"v1"'
+    assert first.json() == {"name": "repo"}
+    assert second.status_code == 200
+    assert second.json() == {"name": "repo"}
+    assert cache.stats.misses == 1
+
+
+def test_cache_key_depends_on_token(tmp_path):
+    cache = HttpCache(Path(tmp_path))
+
+    def send(self, request, **kwargs):
+        assert "If-None-Match" not in request.headers
+        return _response(200, "{}", etag='"v1"')
+
+    with patch.object(HTTPAdapter, "send", send):
+        session = _session(cache)
+        session.get("https://api.github.com/user", headers={"Authorization": "a"})
+        session.get("https://api.github.com/user", headers={"Authorization": "b"})
+
+    assert cache.stats.misses == 2
+    assert cache.stats.hits == 0
+
+
+def test_non_get_requests_are_not_cached(tmp_path):
+    cache = HttpCache(Path(tmp_path))
+
+    def send(self, request, **kwargs):
+        return _response(200, "{}", etag='"v1"')
+
+    with patch.object(HTTPAdapter, "send", send):
+        _session(cache).post("https://api.github.com/graphql", data="{}")
+
+    assert cache.stats.misses == 0
+    assert list(Path(tmp_path).iterdir()) == []
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = HttpCache(Path(tmp_path), max_size=600)
+    body = "x" * 200
+
+    def send(self, request, **kwargs):
+        return _response(200, body, etag='"v1"')
+
+    with patch.object(HTTPAdapter, "send", send):
+        session = _session(cache)
+        for i in range(5):
+            session.get(f"https://api.github.com/repos/owner/repo-{i}")
+
+    assert cache.stats.evictions > 0
+    total = sum(f.stat().st_size for f in Path(tmp_path).glob("*.json"))
+    assert total <= 600
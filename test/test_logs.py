@@ -0,0 +1,107 @@
+import asyncio
+import threading
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from autopr import engine, logs, repo
+from autopr.util import CliException
+
+
+@pytest.fixture(autouse=True)
+def _stop_logging():
+    yield
+    logs.stop()
+
+
+def test_phase_writes_commands_and_output(tmp_path: Path):
+    logs.start(tmp_path)
+    with logs.phase("repo", "transform"):
+        assert repo.run_cmd(["echo", "hello"]) == "hello\n"
+        asyncio.run(engine.run_cmd(["echo", "world"]))
+
+    assert (tmp_path / "repo" / "transform.log").read_text() == (
+        "$ echo hello\nhello\n$ echo world\nworld\n"
+    )
+
+
+def test_phase_replaces_older_log(tmp_path: Path):
+    logs.start(tmp_path)
+    with logs.phase("repo", "push"):
+        repo.run_cmd(["echo", "first"])
+    with logs.phase("repo", "push"):
+        repo.run_cmd(["echo", "second"])
+
+    assert (tmp_path / "repo" / "push.log").read_text() == "$ echo second\nsecond\n"
+
+
+def test_phase_without_commands_creates_no_log(tmp_path: Path):
+    logs.start(tmp_path)
+    with logs.phase("repo", "pr"):
+        pass
+
+    assert not (tmp_path / "repo").exists()
+
+
+def test_no_log_without_logs_dir(tmp_path: Path):
+    with logs.phase("repo", "transform") as log:
+        assert log is None
+        assert repo.run_cmd(["echo", "hello"]) == "hello\n"
+
+
+def test_phases_are_separate_per_thread(tmp_path: Path):
+    logs.start(tmp_path)
+
+    def work(name: str):
+        with logs.phase(name, "transform"):
+            repo.run_cmd(["echo", name])
+
+    threads = [threading.Thread(target=work, args=(name,)) for name in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert (tmp_path / "a" / "transform.log").read_text() == "$ echo a\na\n"
+    assert (tmp_path / "b" / "transform.log").read_text() == "$ echo b\nb\n"
+
+
+def test_uncaptured_output_keeps_only_the_end_in_memory(tmp_path: Path):
+    logs.start(tmp_path)
+    command = ["sh", "-c", "seq 1 2000; exit 2"]
+    with mock.patch("autopr.logs.TAIL_SIZE", 100):
+        with logs.phase("repo", "transform"):
+            with pytest.raises(CliException) as e:
+                repo.run_cmd(command, capture=False)
+
+    log = tmp_path / "repo" / "transform.log"
+    message = f"{e.value}"
+    assert "failed (code: 2)" in message
+    assert f"bytes omitted, see {log}]" in message
+    assert message.endswith("\n2000\n")
+    assert "\n1000\n" not in message
+    # the complete output is in the log
+    assert log.read_text().splitlines()[1:] == [
+        *(f"{i}" for i in range(1, 2001)),
+        "exit code 2",
+    ]
+
+
+def test_captured_output_is_complete():
+    with mock.patch("autopr.logs.TAIL_SIZE", 100):
+        output = repo.run_cmd(["seq", "1", "2000"])
+
+    assert output.splitlines() == [f"{i}" for i in range(1, 2001)]
+
+
+def test_echo_prints_output_with_repository_prefix(tmp_path: Path, capsys):
+    logs.start(tmp_path, echo=True)
+    with logs.phase("repo", "transform"):
+        repo.run_cmd(["sh", "-c", "echo one; printf 'progress\\rdone'"])
+
+    lines = capsys.readouterr().out.splitlines()
+    assert [line for line in lines if line.startswith("[repo]")] == [
+        "[repo]     one",
+        "[repo]     done",
+    ]
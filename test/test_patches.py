@@ -0,0 +1,135 @@
+from pathlib import Path
+from test.test_utils import (
+    init_git_repos,
+    run_cli,
+    simple_test_config,
+    simple_test_database,
+)
+
+import pytest
+
+from autopr import database, patches, workdir
+from autopr.util import CliException
+
+_PATCH = """\
+diff --git a/one.txt b/one.txt
+index 1111111..2222222 100644
+--- a/one.txt
++++ b/one.txt
+@@ -1,2 +1,2 @@
+-old
++new
+ same
+diff --git a/two.txt b/two.txt
+new file mode 100644
+index 0000000..3333333
+--- /dev/null
++++ b/two.txt
+@@ -0,0 +1,2 @@
++--- not a header
++second
+"""
+
+
+def test_summarize_counts_files_and_lines():
+    summary = patches.summarize("den/repo", _PATCH)
+
+    assert summary.status == patches.PatchStatus.CHANGED
+    assert (summary.files, summary.added, summary.removed) == (2, 3, 1)
+
+
+def test_summarize_empty_patch():
+    summary = patches.summarize("den/repo", "")
+
+    assert summary.status == patches.PatchStatus.UNCHANGED
+    assert (summary.files, summary.added, summary.removed) == (0, 0, 0)
+
+
+def test_write_index_sorted_by_repository(tmp_path: Path):
+    patches.write_index(
+        tmp_path,
+        [
+            patches.PatchSummary("den/b", patches.PatchStatus.FAILED),
+            patches.PatchSummary(
+                "den/a", patches.PatchStatus.CHANGED, 1, 2, 3, "a.patch"
+            ),
+        ],
+    )
+
+    assert (tmp_path / patches.INDEX_FILE_NAME).read_text().splitlines() == [
+        "repository\tstatus\tfiles\tadded\tremoved\tpatch",
+        "den/a\tchanged\t1\t2\t3\ta.patch",
+        "den/b\tfailed\t0\t0\t0\t",
+    ]
+
+
+def test_saved_patch_records_base_and_inputs(tmp_path: Path):
+    patches.write_patch(tmp_path, "repo", _PATCH, "abc123", "inputs")
+
+    saved = patches.read_patch(tmp_path, "repo")
+
+    assert saved is not None
+    assert (saved.path, saved.base_sha, saved.inputs) == (
+        tmp_path / "repo.patch",
+        "abc123",
+        "inputs",
+    )
+    assert saved.path.read_text().endswith(_PATCH)
+    assert patches.read_patch(tmp_path, "other") is None
+
+
+def test_test_all_writes_patches(tmp_path: Path):
+    wd = workdir.WorkDir(tmp_path)
+    db = simple_test_database()
+    db.repositories.append(
+        database.Repository(
+            owner="test",
+            name="other",
+            ssh_url="test@testytest.com",
+            default_branch="master",
+        )
+    )
+    init_git_repos(wd, db)
+    output_dir = tmp_path / "out"
+    # a patch of an earlier run which no longer applies
+    output_dir.mkdir()
+    (output_dir / "other.patch").write_text("stale")
+    cfg = simple_test_config()
+    cfg.update_command = [
+        "bash",
+        "-c",
+        "[ $(basename $PWD) = test ] && echo 'test' > testfile.txt || true",
+    ]
+
+    result = run_cli(
+        wd,
+        ["test", "--all", "--output-dir", f"{output_dir}", "-j", "2"],
+        cfg=cfg,
+        db=db,
+    )
+
+    assert "Tested 2 repositories: 1 changed, 1 unchanged" in result.output
+    patch = (output_dir / "test.patch").read_text()
+    assert "+++ b/testfile.txt" in patch
+    assert "+test" in patch
+    assert not (output_dir / "other.patch").exists()
+    assert (output_dir / patches.INDEX_FILE_NAME).read_text().splitlines()[1:] == [
+        "test/other\tunchanged\t0\t0\t0\t",
+        "test/test\tchanged\t1\t1\t0\ttest.patch",
+    ]
+    # the run is recorded like in the interactive test
+    assert workdir.read_database(wd).repositories[0].last_run_changed is True
+
+
+def test_output_dir_needs_all(tmp_path: Path):
+    wd = workdir.WorkDir(tmp_path)
+    db = simple_test_database()
+    init_git_repos(wd, db)
+
+    with pytest.raises(CliException, match="only used together with --all"):
+        run_cli(
+            wd,
+            ["test", "--output-dir", f"{tmp_path / 'out'}"],
+            cfg=simple_test_config(),
+            db=db,
+        )
@@ -0,0 +1,235 @@
+import threading
+from pathlib import Path
+from test.test_utils import get_repository, simple_test_config, simple_test_database
+from typing import List
+from unittest import mock
+
+import click
+import pytest
+
+from autopr import workdir
+from autopr.pipeline import Job, Pipeline, Stage, prefetch_tests
+from autopr.util import CliException
+
+
+def _jobs(count: int) -> List[Job]:
+    return [
+        Job(index=index, total=count, repository=get_repository(f"repo-{index}"))
+        for index in range(1, count + 1)
+    ]
+
+
+def test_pipeline_runs_all_stages():
+    seen: List[str] = []
+    lock = threading.Lock()
+
+    def record(stage: str):
+        def func(job: Job) -> bool:
+            with lock:
+                seen.append(f"{stage}:{job.repository.name}")
+            return True
+
+        return func
+
+    pipeline = Pipeline(
+        [Stage("first", record("first"), 2), Stage("second", record("second"), 3)],
+        queue_size=1,
+    )
+    pipeline.run(_jobs(5))
+
+    assert len(seen) == 10
+    for index in range(1, 6):
+        assert f"first:repo-{index}" in seen
+        assert f"second:repo-{index}" in seen
+
+
+def test_pipeline_drops_jobs_that_do_not_pass():
+    reached: List[str] = []
+
+    pipeline = Pipeline(
+        [
+            Stage("filter", lambda job: job.index % 2 == 0),
+            Stage("collect", lambda job: reached.append(job.repository.name) or True),
+        ]
+    )
+    pipeline.run(_jobs(4))
+
+    assert sorted(reached) == ["repo-2", "repo-4"]
+
+
+def test_pipeline_continues_after_cli_exception():
+    reached: List[str] = []
+
+    def fail_first(job: Job) -> bool:
+        if job.index == 1:
+            raise CliException("broken")
+        return True
+
+    pipeline = Pipeline(
+        [
+            Stage("fail", fail_first),
+            Stage("collect", lambda job: reached.append(job.repository.name) or True),
+        ]
+    )
+    pipeline.run(_jobs(3))
+
+    assert sorted(reached) == ["repo-2", "repo-3"]
+
+
+def test_pipeline_runs_batches():
+    batches: List[List[str]] = []
+    reached: List[str] = []
+
+    def batch(jobs: List[Job]) -> List[Job]:
+        batches.append([job.repository.name for job in jobs])
+        return [job for job in jobs if job.index != 2]
+
+    pipeline = Pipeline(
+        [
+            Stage("batch", lambda job: job.index != 5, batch=batch, batch_size=2),
+            Stage("collect", lambda job: reached.append(job.repository.name) or True),
+        ]
+    )
+    pipeline.run(_jobs(5))
+
+    assert batches == [["repo-1", "repo-2"], ["repo-3", "repo-4"]]
+    assert sorted(reached) == ["repo-1", "repo-3", "repo-4"]
+
+
+def test_pipeline_continues_after_failed_batch():
+    reached: List[str] = []
+
+    def batch(jobs: List[Job]) -> List[Job]:
+        if jobs[0].index == 1:
+            raise CliException("broken")
+        return jobs
+
+    pipeline = Pipeline(
+        [
+            Stage("batch", lambda job: True, batch=batch, batch_size=2),
+            Stage("collect", lambda job: reached.append(job.repository.name) or True),
+        ]
+    )
+    pipeline.run(_jobs(3))
+
+    assert reached == ["repo-3"]
+
+
+def test_pipeline_reraises_unexpected_errors():
+    def explode(job: Job) -> bool:
+        raise RuntimeError("boom")
+
+    pipeline = Pipeline([Stage("explode", explode), Stage("noop", lambda job: True)])
+
+    with pytest.raises(RuntimeError):
+        pipeline.run(_jobs(3))
+
+
+def test_pipeline_later_stage_does_not_block_earlier_stage():
+    release = threading.Event()
+    transformed: List[int] = []
+
+    def transform(job: Job) -> bool:
+        transformed.append(job.index)
+        if len(transformed) == 3:
+            release.set()
+        return True
+
+    def push(job: Job) -> bool:
+        # the first push only finishes once later jobs have been transformed
+        if job.index == 1:
+            assert release.wait(timeout=5)
+        return True
+
+    pipeline = Pipeline([Stage("transform", transform), Stage("push", push)])
+    pipeline.run(_jobs(3))
+
+    assert transformed == [1, 2, 3]
+
+
+def _fake_reset_and_run_script(prepared: List[str], gates: dict):
+    def reset_and_run_script(repository, db, cfg, wd, pull, inputs, out=None):
+        gate = gates.get(repository.name)
+        if gate is not None:
+            gate.started.set()
+            assert gate.wait(timeout=5)
+        click.echo(f"Preparing {repository.name}", file=out)
+        prepared.append(repository.name)
+        if repository.name == "broken":
+            raise CliException("broken")
+        return repository.name != "skipped"
+
+    return reset_and_run_script
+
+
+@pytest.mark.parametrize("prefetch", [0, 1, 3])
+def test_prefetch_tests_yields_in_order(tmp_path: Path, prefetch: int):
+    names = ["one", "skipped", "broken", "four"]
+    prepared: List[str] = []
+
+    with mock.patch(
+        "autopr.repo.reset_and_run_script",
+        _fake_reset_and_run_script(prepared, {}),
+    ), mock.patch(
+        "autopr.repo.get_diff", lambda repos_dir, repository: f"diff {repository.name}"
+    ), mock.patch(
+        "autopr.repo.get_patch", return_value="patch"
+    ), mock.patch(
+        "autopr.repo.get_default_branch_sha", return_value="sha"
+    ):
+        results = list(
+            prefetch_tests(
+                [get_repository(name) for name in names],
+                simple_test_database(),
+                simple_test_config(),
+                workdir.WorkDir(tmp_path),
+                False,
+                None,
+                prefetch,
+            )
+        )
+
+    assert [result.repository.name for result in results] == names
+    assert [result.ran for result in results] == [True, False, False, True]
+    assert results[0].diff == "diff one"
+    assert results[0].patch == "patch"
+    assert results[0].sha == "sha"
+    assert f"{results[2].error}" == "broken"
+    if prefetch > 0:
+        # printed when the repository is shown rather than in between
+        assert results[3].output == "Preparing four\n"
+
+
+def test_prefetch_tests_prepares_while_caller_waits(tmp_path: Path):
+    prepared: List[str] = []
+    gate = threading.Event()
+    gate.started = threading.Event()  # type: ignore[attr-defined]
+    gates = {"three": gate}
+
+    with mock.patch(
+        "autopr.repo.reset_and_run_script",
+        _fake_reset_and_run_script(prepared, gates),
+    ), mock.patch("autopr.repo.get_diff", return_value=""), mock.patch(
+        "autopr.repo.get_patch", return_value=""
+    ), mock.patch(
+        "autopr.repo.get_default_branch_sha", return_value="sha"
+    ):
+        results = prefetch_tests(
+            [get_repository(name) for name in ["one", "two", "three", "four"]],
+            simple_test_database(),
+            simple_test_config(),
+            workdir.WorkDir(tmp_path),
+            False,
+            None,
+            prefetch=2,
+        )
+        assert next(results).repository.name == "one"
+        # while "one" is shown, "two" and "three" are prepared, not "four"
+        assert gate.started.wait(timeout=5)  # type: ignore[attr-defined]
+        assert "four" not in prepared
+
+        # closing waits for "three", but never starts "four"
+        gate.set()
+        results.close()
+
+    assert sorted(prepared) == ["one", "three", "two"]
@@ -0,0 +1,316 @@
+import asyncio
+import io
+import subprocess
+from pathlib import Path
+from typing import Optional
+from unittest import mock
+
+import pytest
+
+from autopr import database, repo
+from autopr.util import CliException
+
+
+def _git(*args: str) -> str:
+    return subprocess.check_output(["git", *args]).decode().strip()
+
+
+def _create_upstream(tmp_path: Path) -> Path:
+    upstream = tmp_path / "upstream"
+    _git("init", "-b", "main", f"{upstream}")
+    _git("-C", f"{upstream}", "config", "user.name", "Test")
+    _git("-C", f"{upstream}", "config", "user.email", "test@test.com")
+    _git("-C", f"{upstream}", "config", "commit.gpgsign", "false")
+    _commit(upstream, "first")
+    return upstream
+
+
+def _commit(upstream: Path, content: str):
+    (upstream / "file.txt").write_text(content)
+    (upstream / "docs").mkdir(exist_ok=True)
+    (upstream / "docs" / "index.md").write_text(content)
+    _git("-C", f"{upstream}", "add", "--all")
+    _git("-C", f"{upstream}", "commit", "-m", content)
+
+
+def _pull(
+    tmp_path: Path,
+    repository: database.Repository,
+    options: Optional[repo.CloneOptions] = None,
+) -> repo.SyncOutcome:
+    return repo.pull_repository(
+        database.GitUser(name="Test", email="test@test.com"),
+        tmp_path / "key",
+        tmp_path / "repos",
+        repository,
+        True,
+        options=options or repo.CloneOptions(mirror_dir=tmp_path / "mirrors"),
+    )
+
+
+def test_clone_from_mirror(tmp_path):
+    upstream = _create_upstream(tmp_path)
+    repository = database.Repository(
+        owner="org", name="repo", ssh_url=f"{upstream}", default_branch="main"
+    )
+
+    _pull(tmp_path, repository)
+
+    mirror = tmp_path / "mirrors" / "org" / "repo.git"
+    repo_dir = tmp_path / "repos" / "repo"
+    assert (repo_dir / "file.txt").read_text() == "first"
+    assert _git("-C", f"{repo_dir}", "remote", "get-url", "origin") == f"{upstream}"
+    alternates = repo_dir / ".git" / "objects" / "info" / "alternates"
+    assert alternates.read_text().strip() == f"{mirror / 'objects'}"
+
+
+def test_update_from_mirror(tmp_path):
+    upstream = _create_upstream(tmp_path)
+    repository = database.Repository(
+        owner="org", name="repo", ssh_url=f"{upstream}", default_branch="main"
+    )
+    _pull(tmp_path, repository)
+
+    _commit(upstream, "second")
+    _pull(tmp_path, repository)
+
+    repo_dir = tmp_path / "repos" / "repo"
+    mirror = tmp_path / "mirrors" / "org" / "repo.git"
+    assert (repo_dir / "file.txt").read_text() == "second"
+    assert _git("-C", f"{mirror}", "rev-parse", "main") == _git(
+        "-C", f"{upstream}", "rev-parse", "main"
+    )
+
+
+def test_sparse_partial_clone(tmp_path):
+    upstream = _create_upstream(tmp_path)
+    _git("-C", f"{upstream}", "config", "uploadpack.allowFilter", "true")
+    repository = database.Repository(
+        owner="org", name="repo", ssh_url=f"file://{upstream}", default_branch="main"
+    )
+    options = repo.CloneOptions(
+        sparse_checkout=["/file.txt"], clone_filter="blob:none", skip_lfs_smudge=True
+    )
+
+    _pull(tmp_path, repository, options)
+
+    repo_dir = tmp_path / "repos" / "repo"
+    assert (repo_dir / "file.txt").read_text() == "first"
+    assert not (repo_dir / "docs").exists()
+    assert _git("-C", f"{repo_dir}", "config", "remote.origin.partialclonefilter") == (
+        "blob:none"
+    )
+    assert _git("-C", f"{repo_dir}", "config", "filter.lfs.smudge").endswith("%f")
+
+    # the patterns are kept on updates and dropped once no longer configured
+    _commit(upstream, "second")
+    _pull(tmp_path, repository, options)
+    assert (repo_dir / "file.txt").read_text() == "second"
+    assert not (repo_dir / "docs").exists()
+
+    _pull(tmp_path, repository, repo.CloneOptions())
+    assert (repo_dir / "docs" / "index.md").read_text() == "second"
+
+
+def test_sparse_clone_from_mirror(tmp_path):
+    upstream = _create_upstream(tmp_path)
+    repository = database.Repository(
+        owner="org", name="repo", ssh_url=f"{upstream}", default_branch="main"
+    )
+    options = repo.CloneOptions(
+        mirror_dir=tmp_path / "mirrors", sparse_checkout=["docs/"]
+    )
+
+    _pull(tmp_path, repository, options)
+
+    repo_dir = tmp_path / "repos" / "repo"
+    assert not (repo_dir / "file.txt").exists()
+    assert (repo_dir / "docs" / "index.md").read_text() == "first"
+
+
+def test_sync_outcomes(tmp_path):
+    upstream = _create_upstream(tmp_path)
+    repository = database.Repository(
+        owner="org", name="repo", ssh_url=f"file://{upstream}", default_branch="main"
+    )
+    options = repo.CloneOptions()
+    repo_dir = tmp_path / "repos" / "repo"
+
+    assert _pull(tmp_path, repository, options) == repo.SyncOutcome.CLONED
+    assert _pull(tmp_path, repository, options) == repo.SyncOutcome.UP_TO_DATE
+
+    # local changes and other branches are discarded
+    (repo_dir / "file.txt").write_text("local change")
+    _git("-C", f"{repo_dir}", "checkout", "-b", "autopr")
+    _commit(upstream, "second")
+    assert _pull(tmp_path, repository, options) == repo.SyncOutcome.RESET
+    assert (repo_dir / "file.txt").read_text() == "second"
+    assert _git("-C", f"{repo_dir}", "branch", "--show-current") == "main"
+
+    # rewritten history is not a reason to clone again
+    (repo_dir / "untracked.txt").write_text("kept")
+    _git("-C", f"{upstream}", "checkout", "--orphan", "rewritten")
+    _commit(upstream, "rewritten")
+    _git("-C", f"{upstream}", "branch", "-M", "main")
+    assert _pull(tmp_path, repository, options) == repo.SyncOutcome.RESET
+    assert (repo_dir / "file.txt").read_text() == "rewritten"
+    assert (repo_dir / "untracked.txt").exists()
+
+
+def test_sync_reclones_corrupt_repository(tmp_path):
+    upstream = _create_upstream(tmp_path)
+    repository = database.Repository(
+        owner="org", name="repo", ssh_url=f"file://{upstream}", default_branch="main"
+    )
+    options = repo.CloneOptions()
+    _pull(tmp_path, repository, options)
+
+    (tmp_path / "repos" / "repo" / ".git" / "HEAD").unlink()
+
+    assert _pull(tmp_path, repository, options) == repo.SyncOutcome.RECLONED
+    assert (tmp_path / "repos" / "repo" / "file.txt").read_text() == "first"
+
+
+def test_sync_keeps_repository_on_other_errors(tmp_path):
+    upstream = _create_upstream(tmp_path)
+    repository = database.Repository(
+        owner="org", name="repo", ssh_url=f"file://{upstream}", default_branch="main"
+    )
+    _pull(tmp_path, repository, repo.CloneOptions())
+
+    repository.default_branch = "missing"
+    with pytest.raises(CliException):
+        _pull(tmp_path, repository, repo.CloneOptions())
+
+    assert (tmp_path / "repos" / "repo" / "file.txt").exists()
+
+
+@mock.patch("autopr.repo.asyncio.sleep")
+def test_retry_transient_errors(sleep: mock.AsyncMock):
+    func = mock.AsyncMock(
+        side_effect=[
+            CliException("ssh: connect to host github.com: Connection timed out"),
+            CliException("fatal: the remote end hung up unexpectedly"),
+            "done",
+        ]
+    )
+
+    assert asyncio.run(repo._retry_transient(func, io.StringIO())) == "done"
+    assert [call.args[0] for call in sleep.call_args_list] == [2.0, 4.0]
+
+
+@mock.patch("autopr.repo.asyncio.sleep")
+def test_no_retry_of_other_errors(sleep: mock.AsyncMock):
+    func = mock.AsyncMock(side_effect=CliException("fatal: couldn't find remote ref"))
+
+    with pytest.raises(CliException):
+        asyncio.run(repo._retry_transient(func, io.StringIO()))
+
+    assert func.call_count == 1
+    sleep.assert_not_called()
+
+
+def test_pull_parallel_reports_each_result(tmp_path, capsys):
+    upstream = _create_upstream(tmp_path)
+    repositories = [
+        database.Repository(
+            owner="org", name=name, ssh_url=f"file://{upstream}", default_branch="main"
+        )
+        for name in ["one", "two"]
+    ]
+    results = []
+
+    outcomes = repo.pull_repositories_parallel(
+        database.GitUser(name="Test", email="test@test.com"),
+        tmp_path / "key",
+        tmp_path / "repos",
+        repositories,
+        True,
+        2,
+        on_result=results.append,
+    )
+
+    assert outcomes == {repo.SyncOutcome.CLONED: 2}
+    assert sorted(id(result.repository) for result in results) == sorted(
+        id(repository) for repository in repositories
+    )
+    head = _git("-C", f"{upstream}", "rev-parse", "main")
+    assert all(result.sha == head for result in results)
+    # output is printed as it happens, marked with the repository
+    output = capsys.readouterr().out
+    assert "[one] Pulling repository 'one':" in output
+    assert "[two]   - Cloning branch 'main'" in output
+
+
+def test_configure_repositories_updates_unchanged_clones(tmp_path):
+    upstream = _create_upstream(tmp_path)
+    repository = database.Repository(
+        owner="org", name="repo", ssh_url=f"{upstream}", default_branch="main"
+    )
+    _pull(tmp_path, repository, repo.CloneOptions())
+    repo_dir = tmp_path / "repos" / "repo"
+
+    failed = repo.configure_repositories(
+        database.GitUser(name="Other", email="other@test.com"),
+        tmp_path / "key",
+        tmp_path / "repos",
+        [repository],
+        2,
+        repo.CloneOptions(sparse_checkout=["/file.txt"], skip_lfs_smudge=True),
+    )
+
+    assert failed == 0
+    assert _git("-C", f"{repo_dir}", "config", "user.name") == "Other"
+    assert _git("-C", f"{repo_dir}", "config", "filter.lfs.required") == "false"
+    assert (repo_dir / "file.txt").exists()
+    assert not (repo_dir / "docs").exists()
+
+
+def test_needs_sync(tmp_path):
+    repository = database.Repository(
+        owner="org", name="repo", ssh_url="", default_branch="main", synced_sha="abc"
+    )
+
+    assert repo.needs_sync(tmp_path, repository, "abc")  # not cloned yet
+    (tmp_path / "repo").mkdir()
+    assert not repo.needs_sync(tmp_path, repository, "abc")
+    assert repo.needs_sync(tmp_path, repository, "def")
+    assert repo.needs_sync(tmp_path, repository, None)
+
+
+def test_pull_order():
+    def repository(name: str, size=None, pull_duration=None) -> database.Repository:
+        return database.Repository(
+            owner="org",
+            name=name,
+            ssh_url="",
+            default_branch="main",
+            size=size,
+            pull_duration=pull_duration,
+        )
+
+    repositories = [
+        repository("fast", size=900_000, pull_duration=1.0),
+        repository("small-new", size=10),
+        repository("slow", size=10, pull_duration=60.0),
+        repository("large-new", size=500_000),
+        repository("unknown"),
+    ]
+
+    order = [repositories[index].name for index in repo.pull_order(repositories)]
+
+    # the timed pulls ran at ~15 MB/s, so "large-new" should take ~34 seconds
+    assert order == ["slow", "large-new", "fast", "small-new", "unknown"]
+
+
+def test_pull_order_without_timed_pulls():
+    repositories = [
+        database.Repository(
+            owner="org", name=name, ssh_url="", default_branch="main", size=size
+        )
+        for name, size in [("small", 10), ("large", 500_000), ("unknown", None)]
+    ]
+
+    order = [repositories[index].name for index in repo.pull_order(repositories)]
+
+    assert order == ["large", "small", "unknown"]
@@ -0,0 +1,73 @@
+from typing import List
+
+from autopr.ratelimit import RateLimiter, TokenBucket, create_limiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps: List[float] = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def _limiter(clock: FakeClock, buckets: List[TokenBucket]) -> RateLimiter:
+    return RateLimiter("test", buckets, clock=clock, sleep=clock.sleep)
+
+
+def test_token_bucket_allows_burst_then_waits():
+    clock = FakeClock()
+    limiter = _limiter(clock, [TokenBucket(rate=0.5, capacity=2, now=clock.now)])
+
+    assert limiter.acquire() == 0.0
+    assert limiter.acquire() == 0.0
+    assert limiter.acquire() == 2.0
+    assert limiter.waited == 2.0
+
+
+def test_token_bucket_refills_while_idle():
+    clock = FakeClock()
+    limiter = _limiter(clock, [TokenBucket(rate=0.1, capacity=1, now=clock.now)])
+
+    limiter.acquire()
+    clock.now += 30.0  # nothing was pushed in the meantime
+    assert limiter.acquire() == 0.0
+    assert clock.sleeps == []
+
+
+def test_limiter_respects_all_buckets():
+    clock = FakeClock()
+    limiter = _limiter(
+        clock,
+        [
+            TokenBucket.per_period(5, 60.0, clock.now),
+            TokenBucket.per_period(3, 3600.0, clock.now),
+        ],
+    )
+
+    for _ in range(3):
+        limiter.acquire()
+
+    # per-minute bucket would allow it, but the hourly one is empty
+    clock.now += 60.0
+    assert limiter.acquire() == 1200.0 - 60.0
+
+
+def test_limiter_pause():
+    clock = FakeClock()
+    limiter = _limiter(clock, [])
+
+    limiter.pause(45.0)
+    assert limiter.acquire() == 45.0
+    assert limiter.acquire() == 0.0
+
+
+def test_create_limiter_without_limits_never_waits():
+    limiter = create_limiter("test")
+    assert limiter.buckets == []
+    assert limiter.acquire() == 0.0
@@ -10,16 +10,41 @@ from test.test_utils import (
 from typing import Dict, List, Optional
 from unittest.mock import Mock, patch
 
-from autopr import workdir
+import pytest
+
+from autopr import config, repo, workdir
+from autopr.database import Repository
 
 
 def _test_cmd(
-    cmd: List[str], additional_env: Optional[Dict[str, str]] = None
+    cmd: List[str],
+    additional_env: Optional[Dict[str, str]] = None,
+    cwd: Optional[Path] = None,
+    capture: bool = True,
 ) -> Optional[str]:
-    commands = ["reset", "checkout", "add", "commit", "bash"]
+    if "fetch" in cmd:
+        # there is no remote, pretend it is at the local HEAD
+        subprocess.check_output(
+            ["git", "-C", cmd[2], "update-ref", "FETCH_HEAD", "HEAD"]
+        )
+        return ""
+
+    commands = [
+        "reset",
+        "checkout",
+        "add",
+        "diff",
+        "commit",
+        "bash",
+        "rev-parse",
+        "apply",
+        "ls-tree",
+    ]
     if any(subcommand in cmd for subcommand in commands):
         try:
-            return subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode()
+            return subprocess.check_output(
+                cmd, stderr=subprocess.STDOUT, cwd=cwd
+            ).decode()
         except subprocess.CalledProcessError as exc:
             raise Exception(
                 f"Command {' '.join(cmd)} failed (code: {exc.returncode}):\n{exc.output}"
@@ -28,9 +53,26 @@ def _test_cmd(
     return None
 
 
+async def _test_cmd_async(
+    cmd: List[str],
+    additional_env: Optional[Dict[str, str]] = None,
+    cwd: Optional[Path] = None,
+    output=None,
+    capture: bool = True,
+) -> Optional[str]:
+    return _test_cmd(cmd, additional_env, cwd, capture)
+
+
+def _mock_created_pr(create_github_client: Mock, number: int = 1):
+    gh = create_github_client.return_value
+    gh.get_repo.return_value.create_pull.return_value.number = number
+
+
 @patch("autopr.repo.run_cmd", new=_test_cmd)
+@patch("autopr.engine.run_cmd", new=_test_cmd_async)
 @patch("autopr.github.create_github_client")
 def test_create_files(_create_github_client: Mock, tmp_path):
+    _mock_created_pr(_create_github_client)
     testkey = Path(tmp_path) / "testkey"
     testkey.touch()
 
@@ -47,8 +89,10 @@ def test_create_files(_create_github_client: Mock, tmp_path):
 
 
 @patch("autopr.repo.run_cmd", new=_test_cmd)
+@patch("autopr.engine.run_cmd", new=_test_cmd_async)
 @patch("autopr.github.create_github_client")
 def test_api_key_env_var(_create_github_client: Mock, monkeypatch, tmp_path):
+    _mock_created_pr(_create_github_client)
     wd = workdir.WorkDir(Path(tmp_path))
     db = simple_test_database()
     init_git_repos(wd, db)
@@ -62,3 +106,273 @@ def test_api_key_env_var(_create_github_client: Mock, monkeypatch, tmp_path):
     assert (
         _create_github_client.call_args_list[0][0][0] == "env_var_test"
     ), f"wrong api_key used for create_github_client: {_create_github_client.call_args_list}"
+
+
+@patch("autopr.repo.run_cmd", new=_test_cmd)
+@patch("autopr.engine.run_cmd", new=_test_cmd_async)
+@patch("autopr.github.create_github_client")
+def test_skip_unchanged(_create_github_client: Mock, tmp_path):
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = simple_test_database()
+    init_git_repos(wd, db)
+    cfg = simple_test_config()
+    cfg.update_command = ["bash", "-c", "true"]
+
+    run_cli(wd, ["run", "--no-pull-repos"], cfg=cfg, db=db)
+    repository = workdir.read_database(wd).repositories[0]
+    assert repository.done
+    assert repository.last_run_changed is False
+
+    run_cli(wd, ["reset", "all"])
+    result = run_cli(wd, ["run", "--no-pull-repos"])
+    assert "Skipping 'test'" in result.output
+    assert "Skipped 1 repositories" in result.output
+    assert workdir.read_database(wd).repositories[0].done
+
+    # a different update command has to run again
+    cfg.update_command = ["bash", "-c", "true # changed"]
+    run_cli(wd, ["reset", "all"])
+    result = run_cli(wd, ["run", "--no-pull-repos"], cfg=cfg)
+    assert "Skipping 'test'" not in result.output
+
+
+@pytest.mark.parametrize(
+    "mode, script",
+    [
+        (config.UPDATE_COMMAND_MODE_EACH, "../../fix.py"),
+        (config.UPDATE_COMMAND_MODE_BATCH, "../fix.py"),
+    ],
+)
+def test_fingerprint_resolves_paths_where_command_runs(
+    tmp_path, mode: str, script: str
+):
+    (tmp_path / "fix.py").write_text("print('one')")
+    cfg = simple_test_config()
+    cfg.update_command = ["python", script]
+    cfg.update_command_mode = mode
+
+    before = repo.get_update_command_fingerprint(cfg, tmp_path / "repos")
+    (tmp_path / "fix.py").write_text("print('two')")
+
+    assert repo.get_update_command_fingerprint(cfg, tmp_path / "repos") != before
+
+
+@patch("autopr.repo.run_cmd", new=_test_cmd)
+@patch("autopr.engine.run_cmd", new=_test_cmd_async)
+@patch("autopr.github.create_github_client")
+def test_run_from_patches(_create_github_client: Mock, tmp_path):
+    _mock_created_pr(_create_github_client)
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = simple_test_database()
+    init_git_repos(wd, db)
+    runs = tmp_path / "runs"
+    cfg = simple_test_config()
+    cfg.update_command = ["bash", "-c", f"echo test > testfile.txt; echo >> {runs}"]
+
+    run_cli(wd, ["test", "--all"], cfg=cfg, db=db)
+    assert runs.read_text() == "\n"
+
+    result = run_cli(wd, ["run", "--no-pull-repos", "--from-patches"])
+    assert "Applying saved patch test.patch" in result.output
+    assert "Applied 1 saved patches" in result.output
+    # the update command did not run again, its changes were committed
+    assert runs.read_text() == "\n"
+    assert _create_github_client.return_value.get_repo.return_value.create_pull.called
+    repo_dir = wd.repos_dir / "test"
+    committed = subprocess.check_output(
+        ["git", "-C", f"{repo_dir}", "show", "--name-only", "--format=", "HEAD"]
+    )
+    assert committed.decode().split() == ["testfile.txt"]
+
+
+@patch("autopr.repo.run_cmd", new=_test_cmd)
+@patch("autopr.engine.run_cmd", new=_test_cmd_async)
+@patch("autopr.github.create_github_client")
+def test_run_from_patches_runs_command_when_base_moved(
+    _create_github_client: Mock, tmp_path
+):
+    _mock_created_pr(_create_github_client)
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = simple_test_database()
+    init_git_repos(wd, db)
+    runs = tmp_path / "runs"
+    cfg = simple_test_config()
+    cfg.update_command = ["bash", "-c", f"echo test > testfile.txt; echo >> {runs}"]
+
+    run_cli(wd, ["test", "--all"], cfg=cfg, db=db)
+    # a new commit on the default branch
+    repo_dir = wd.repos_dir / "test"
+    subprocess.check_output(["git", "-C", f"{repo_dir}", "checkout", "-f", "master"])
+    subprocess.check_output(
+        ["git", "-C", f"{repo_dir}", "commit", "--allow-empty", "-m", "moved"]
+    )
+
+    result = run_cli(wd, ["run", "--no-pull-repos", "--from-patches"])
+    assert "The default branch moved since the patch was saved" in result.output
+    assert "Applied 0 saved patches" in result.output
+    assert "for 1 outdated ones" in result.output
+    assert runs.read_text() == "\n\n"
+
+
+@pytest.mark.parametrize("paths", [[], ["testfile.txt", "missing"]])
+@patch("autopr.repo.run_cmd", new=_test_cmd)
+@patch("autopr.engine.run_cmd", new=_test_cmd_async)
+@patch("autopr.github.create_github_client")
+def test_run_deduplicates_update_command(
+    _create_github_client: Mock, tmp_path, paths: List[str]
+):
+    _mock_created_pr(_create_github_client)
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = simple_test_database()
+    for name in ["other", "different"]:
+        db.repositories.append(
+            Repository(
+                owner="test",
+                name=name,
+                ssh_url="test@testytest.com",
+                default_branch="master",
+            )
+        )
+    init_git_repos(wd, db)
+    # all repositories start out the same, except for this one
+    different = wd.repos_dir / "different"
+    (different / "testfile.txt").write_text("different\n")
+    subprocess.check_output(["git", "-C", f"{different}", "add", "testfile.txt"])
+    subprocess.check_output(["git", "-C", f"{different}", "commit", "-m", "different"])
+    runs = tmp_path / "runs"
+    cfg = simple_test_config()
+    cfg.update_command = ["bash", "-c", f"echo test >> testfile.txt; echo >> {runs}"]
+    cfg.deduplicate = True
+    cfg.deduplicate_paths = paths
+
+    result = run_cli(
+        wd,
+        ["run", "--no-pull-repos", "--transform-workers", "2", "--push-delay", "0"],
+        cfg=cfg,
+        db=db,
+    )
+
+    assert runs.read_text() == "\n\n"
+    assert "Ran the update command 2 times" in result.output
+    assert "reused its changes for 1 repositories" in result.output
+    for name, content in [
+        ("test", "test\n"),
+        ("other", "test\n"),
+        ("different", "different\ntest\n"),
+    ]:
+        assert (wd.repos_dir / name / "testfile.txt").read_text() == content
+        log = subprocess.check_output(
+            [
+                "git",
+                "-C",
+                f"{wd.repos_dir / name}",
+                "log",
+                "-1",
+                "--format=%s",
+                "autopr",
+            ]
+        )
+        assert log.decode().strip() == cfg.pr.message
+
+
+@pytest.mark.parametrize("batch_input", ["arguments", "manifest"])
+@patch("autopr._create_github_client")
+def test_run_batches_update_command(
+    _create_github_client: Mock, tmp_path, batch_input: str
+):
+    _mock_created_pr(_create_github_client)
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = simple_test_database()
+    for name in ["other", "third"]:
+        db.repositories.append(
+            Repository(
+                owner="test",
+                name=name,
+                ssh_url="test@testytest.com",
+                default_branch="master",
+            )
+        )
+    init_git_repos(wd, db)
+    runs = tmp_path / "runs"
+    dirs = '"$@"' if batch_input == "arguments" else '$(cat "$1")'
+    cfg = simple_test_config()
+    cfg.update_command = [
+        "bash",
+        "-c",
+        f"for d in {dirs}; do echo $(basename $d) > $d/testfile.txt; done; echo >> {runs}",
+        "update",
+    ]
+    cfg.update_command_mode = config.UPDATE_COMMAND_MODE_BATCH
+    cfg.update_command_batch_size = 2
+    cfg.update_command_batch_input = batch_input
+
+    result = run_cli(
+        wd,
+        ["run", "--no-pull-repos", "--push-delay", "0"],
+        cfg=cfg,
+        db=db,
+    )
+
+    assert runs.read_text() == "\n\n"
+    assert "Ran the update command 2 times in batches of up to 2" in result.output
+    # the stages run concurrently, their output is marked with the repository
+    assert "[other]   - Committing changes to 'other'" in result.output
+    assert "[third]   - Pushing changes of 'third'" in result.output
+    for name in ["test", "other", "third"]:
+        repo_dir = wd.repos_dir / name
+        assert (repo_dir / "testfile.txt").read_text() == f"{name}\n"
+        log = subprocess.check_output(
+            ["git", "-C", f"{repo_dir}", "log", "-1", "--format=%s", "autopr"]
+        )
+        assert log.decode().strip() == cfg.pr.message
+
+
+@patch("autopr._create_github_client")
+def test_run_batch_keeps_saved_patches_when_command_fails(
+    _create_github_client: Mock, tmp_path
+):
+    _mock_created_pr(_create_github_client)
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = simple_test_database()
+    db.repositories.append(
+        Repository(
+            owner="test",
+            name="other",
+            ssh_url="test@testytest.com",
+            default_branch="master",
+        )
+    )
+    init_git_repos(wd, db)
+    fail = tmp_path / "fail"
+    cfg = simple_test_config()
+    cfg.update_command = [
+        "bash",
+        "-c",
+        f'[ -e {fail} ] && exit 1; for d in "$@"; do '
+        "[ $(basename $d) = test ] && echo test > $d/testfile.txt; done; true",
+        "update",
+    ]
+    cfg.update_command_mode = config.UPDATE_COMMAND_MODE_BATCH
+    run_cli(wd, ["test", "--all"], cfg=cfg, db=db)
+    fail.touch()
+
+    result = run_cli(
+        wd,
+        [
+            "run",
+            "--no-pull-repos",
+            "--from-patches",
+            "--no-skip-unchanged",
+            "--transform-workers",
+            "1",
+            "--push-delay",
+            "0",
+        ],
+    )
+
+    assert "Error: [other]" in result.output
+    # the failed command did not affect the repository with a saved patch
+    log = subprocess.check_output(
+        ["git", "-C", f"{wd.repos_dir / 'test'}", "log", "-1", "--format=%s", "autopr"]
+    )
+    assert log.decode().strip() == cfg.pr.message
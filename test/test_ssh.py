@@ -0,0 +1,72 @@
+import shlex
+import socket
+import stat
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from autopr import ssh
+
+
+@pytest.fixture(autouse=True)
+def _stop_pool():
+    yield
+    ssh.stop()
+
+
+def _options(command: str) -> dict:
+    arguments = shlex.split(command)
+    return dict(
+        arguments[i + 1].split("=", 1)
+        for i, argument in enumerate(arguments)
+        if argument == "-o"
+    )
+
+
+def test_git_ssh_command_without_pool():
+    assert ssh.git_ssh_command(Path("key")) == "ssh -i key -o IdentitiesOnly=yes"
+
+
+def test_git_ssh_command_shares_connections(tmp_path):
+    pool = ssh.start(tmp_path / "ssh", connections=2)
+
+    paths = [
+        _options(ssh.git_ssh_command(Path("key")))["ControlPath"] for _ in range(3)
+    ]
+
+    assert paths == [
+        f"{pool.control_dir}/0-%r@%h:%p",
+        f"{pool.control_dir}/1-%r@%h:%p",
+        f"{pool.control_dir}/0-%r@%h:%p",
+    ]
+    assert _options(ssh.git_ssh_command(Path("key")))["ControlMaster"] == "auto"
+    assert stat.S_IMODE(pool.control_dir.stat().st_mode) == 0o700
+
+
+def test_control_dir_of_long_paths_is_shortened(tmp_path):
+    ssh_dir = tmp_path / ("long" * 20) / "ssh"
+
+    directory = ssh.control_dir(ssh_dir)
+
+    assert len(f"{directory}") <= ssh.MAX_CONTROL_DIR_LENGTH
+    assert directory == ssh.control_dir(ssh_dir)
+    assert directory != ssh.control_dir(tmp_path / ("other" * 20) / "ssh")
+
+
+@mock.patch("autopr.ssh.subprocess.run")
+def test_stop_closes_master_connections(run: mock.Mock, tmp_path):
+    pool = ssh.start(tmp_path / "ssh")
+    ssh.git_ssh_command(Path("key"))
+    master = socket.socket(socket.AF_UNIX)
+    master.bind(f"{pool.control_dir / '0-git@github.com:22'}")
+
+    ssh.stop()
+    master.close()
+
+    assert run.call_count == 1
+    command = run.call_args.args[0]
+    assert command[:2] == ["ssh", "-o"]
+    assert command[2] == f"ControlPath={pool.control_dir / '0-git@github.com:22'}"
+    assert command[3:5] == ["-O", "exit"]
+    assert ssh.git_ssh_command(Path("key")) == "ssh -i key -o IdentitiesOnly=yes"
@@ -0,0 +1,28 @@
+import subprocess
+import sys
+from pathlib import Path
+
+from click.testing import CliRunner
+
+from autopr import _get_version, cli
+
+HEAVY_MODULES = ["github", "marshmallow", "requests", "single_source", "yaml"]
+
+
+def test_import_does_not_load_heavy_modules():
+    code = (
+        "import sys, autopr; "
+        f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    output = subprocess.check_output(
+        [sys.executable, "-c", code], cwd=Path(__file__).parent.parent, text=True
+    )
+    assert output.split() == []
+
+
+def test_version():
+    result = CliRunner().invoke(cli, ["--version"])
+
+    assert result.exit_code == 0
+    assert result.output == f"auto-pr: {_get_version()}\n"
+    assert _get_version() != "unknown"
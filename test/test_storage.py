@@ -0,0 +1,220 @@
+import json
+from pathlib import Path
+from test.test_utils import get_repository, run_cli, simple_test_database
+
+import pytest
+
+from autopr import database, storage, workdir
+
+
+def _write_database(wd: workdir.WorkDir, count: int):
+    db = simple_test_database()
+    db.repositories = [get_repository(f"repo-{i}") for i in range(count)]
+    workdir.write_database(wd, db)
+    return db
+
+
+def test_update_repository_appends_to_journal(tmp_path):
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = _write_database(wd, 3)
+    snapshot = wd.database_file.read_text()
+
+    db.repositories[1].done = True
+    workdir.update_repository(wd, db, db.repositories[1])
+
+    assert wd.database_file.read_text() == snapshot
+    # the header ties the journal to the snapshot, db.json is left untouched
+    assert len(wd.storage.journal_path.read_text().splitlines()) == 2
+    assert json.loads(snapshot).keys() == {"user", "repositories"}
+
+    db_read = workdir.read_database(workdir.WorkDir(Path(tmp_path)))
+    assert [r.done for r in db_read.repositories] == [False, True, False]
+
+
+def test_write_database_compacts_journal(tmp_path):
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = _write_database(wd, 2)
+
+    db.repositories[0].done = True
+    workdir.update_repository(wd, db, db.repositories[0])
+    workdir.write_database(wd, db)
+
+    assert not wd.storage.journal_path.exists()
+    data = json.loads(wd.database_file.read_text())
+    assert data["repositories"][0]["done"]
+
+
+def test_journal_compacts_when_grown(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "MIN_COMPACTION_ENTRIES", 2)
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = _write_database(wd, 2)
+
+    for repository in db.repositories:
+        repository.done = True
+        workdir.update_repository(wd, db, repository)
+    assert wd.storage.journal_path.exists()
+
+    workdir.update_repository(wd, db, db.repositories[0])
+    assert not wd.storage.journal_path.exists()
+    assert all(r.done for r in workdir.read_database(wd).repositories)
+
+
+def test_interrupted_append_is_ignored(tmp_path):
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = _write_database(wd, 2)
+
+    db.repositories[0].done = True
+    workdir.update_repository(wd, db, db.repositories[0])
+    with open(wd.storage.journal_path, "a") as f:
+        f.write('{"repository": {"owner": "den", "na')
+
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = workdir.read_database(wd)
+    assert [r.done for r in db.repositories] == [True, False]
+
+    db.repositories[1].done = True
+    workdir.update_repository(wd, db, db.repositories[1])
+    db = workdir.read_database(workdir.WorkDir(Path(tmp_path)))
+    assert [r.done for r in db.repositories] == [True, True]
+
+
+class _Crash(Exception):
+    pass
+
+
+def _crash_after_write(monkeypatch):
+    atomic_write = storage.atomic_write
+
+    def write_and_crash(path, data):
+        atomic_write(path, data)
+        raise _Crash()
+
+    monkeypatch.setattr(storage, "atomic_write", write_and_crash)
+
+
+@pytest.mark.parametrize("other_done", [False, True])
+def test_journal_of_interrupted_compaction_is_ignored(
+    tmp_path, monkeypatch, other_done
+):
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = _write_database(wd, 2)
+
+    db.repositories[0].done = True
+    workdir.update_repository(wd, db, db.repositories[0])
+    # crash after writing the snapshot, before the journal is removed; without
+    # other changes the new snapshot is identical to the one the journal extends
+    db.repositories[0].done = False
+    db.repositories[1].done = other_done
+    with monkeypatch.context() as m:
+        _crash_after_write(m)
+        with pytest.raises(_Crash):
+            workdir.write_database(wd, db)
+
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = workdir.read_database(wd)
+    assert [r.done for r in db.repositories] == [False, other_done]
+
+    db.repositories[1].done = True
+    workdir.update_repository(wd, db, db.repositories[1])
+    db = workdir.read_database(workdir.WorkDir(Path(tmp_path)))
+    assert [r.done for r in db.repositories] == [False, True]
+
+
+def test_journal_without_header_is_kept_on_compaction(tmp_path, monkeypatch):
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = _write_database(wd, 2)
+    db.repositories[0].done = True
+    workdir.update_repository(wd, db, db.repositories[0])
+    entries = wd.storage.journal_path.read_text().splitlines()[1:]
+    wd.storage.journal_path.write_text("\n".join(entries) + "\n")
+
+    # crash while the journal of an earlier version gets its header
+    with monkeypatch.context() as m:
+        _crash_after_write(m)
+        with pytest.raises(_Crash):
+            workdir.write_database(wd, db)
+
+    db = workdir.read_database(workdir.WorkDir(Path(tmp_path)))
+    assert [r.done for r in db.repositories] == [True, False]
+
+
+def test_import_copy_of_database_file(tmp_path):
+    first = workdir.WorkDir(Path(tmp_path) / "first")
+    first.location.mkdir()
+    _write_database(first, 2)
+    second = workdir.WorkDir(Path(tmp_path) / "second")
+    second.location.mkdir()
+
+    workdir.import_database(second, first.database_file)
+
+    assert len(workdir.read_database(second).repositories) == 2
+
+
+def test_export_and_import(tmp_path):
+    wd = workdir.WorkDir(Path(tmp_path) / "first")
+    wd.location.mkdir()
+    db = _write_database(wd, 2)
+    db.repositories[0].done = True
+    workdir.update_repository(wd, db, db.repositories[0])
+
+    exported = Path(tmp_path) / "export.json"
+    run_cli(wd, ["db", "export", f"{exported}"])
+    assert json.loads(exported.read_text())["repositories"][0]["done"]
+
+    wd_other = workdir.WorkDir(Path(tmp_path) / "second")
+    wd_other.location.mkdir()
+    run_cli(wd_other, ["db", "import", f"{exported}"])
+    db_other = workdir.read_database(wd_other)
+    assert [r.name for r in db_other.repositories] == ["repo-0", "repo-1"]
+    assert db_other.repositories[0].done
+
+
+def test_codec_matches_schema():
+    db = simple_test_database()
+    db.repositories.append(get_repository("other", done=True))
+    db.repositories[1].existing_pr = 12
+    db.repositories[1].github_id = 34
+
+    data = database.database_to_dict(db)
+
+    assert data == database.DATABASE_SCHEMA.dump(db)
+    assert database.database_from_dict(data) == database.DATABASE_SCHEMA.load(data)
+
+
+def test_codec_rejects_invalid_data():
+    data = database.database_to_dict(simple_test_database())
+
+    for invalid in [
+        {"name": "missing fields"},
+        {**data["repositories"][0], "done": "yes"},
+        {**data["repositories"][0], "unknown": 1},
+    ]:
+        with pytest.raises(database.DecodeError):
+            database.database_from_dict({**data, "repositories": [invalid]})
+
+
+def test_convert_to_binary_and_back(tmp_path):
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = _write_database(wd, 3)
+    db.repositories[0].done = True
+    workdir.update_repository(wd, db, db.repositories[0])
+
+    run_cli(wd, ["db", "format", "binary"])
+    assert wd.binary_database_file.exists()
+    assert not wd.database_file.exists()
+    assert not wd.storage.journal_path.exists()
+
+    wd = workdir.WorkDir(Path(tmp_path))
+    db = workdir.read_database(wd)
+    assert [r.done for r in db.repositories] == [True, False, False]
+
+    # partial updates work on top of the binary snapshot as well
+    db.repositories[2].done = True
+    workdir.update_repository(wd, db, db.repositories[2])
+    wd = workdir.WorkDir(Path(tmp_path))
+    assert workdir.read_database(wd).repositories[2].done
+
+    run_cli(wd, ["db", "format", "json"])
+    assert not wd.binary_database_file.exists()
+    data = json.loads(wd.database_file.read_text())
+    assert [r["done"] for r in data["repositories"]] == [True, False, True]
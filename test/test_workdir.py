@@ -0,0 +1,61 @@
+from pathlib import Path
+from test.test_utils import simple_test_config, simple_test_database
+from unittest import mock
+
+import yaml
+
+from autopr import workdir
+
+
+def _write_workdir(tmp_path) -> workdir.WorkDir:
+    wd = workdir.WorkDir(Path(tmp_path))
+    workdir.write_config(wd, simple_test_config())
+    workdir.write_database(wd, simple_test_database())
+    return wd
+
+
+def test_config_is_parsed_once(tmp_path):
+    _write_workdir(tmp_path)
+    wd = workdir.WorkDir(Path(tmp_path))
+
+    with mock.patch("yaml.safe_load", wraps=yaml.safe_load) as load:
+        for _ in range(10):
+            assert wd.repos_dir == Path(tmp_path) / "repos"
+            workdir.read_config(wd)
+
+    assert load.call_count == 1
+
+
+def test_config_is_reloaded_when_file_changes(tmp_path):
+    wd = _write_workdir(tmp_path)
+    assert workdir.read_config(wd).pr.title != "changed"
+
+    cfg = simple_test_config()
+    cfg.pr.title = "changed"
+    workdir.write_config(workdir.WorkDir(Path(tmp_path)), cfg)
+
+    assert workdir.read_config(wd).pr.title == "changed"
+
+
+def test_database_is_loaded_once(tmp_path):
+    _write_workdir(tmp_path)
+    wd = workdir.WorkDir(Path(tmp_path))
+
+    db = workdir.read_database(wd)
+    workdir.update_repository(wd, db, db.repositories[0])
+
+    assert workdir.read_database(wd) is db
+
+
+def test_database_is_reloaded_when_file_changes(tmp_path):
+    wd = _write_workdir(tmp_path)
+    db = workdir.read_database(wd)
+
+    wd_other = workdir.WorkDir(Path(tmp_path))
+    db_other = workdir.read_database(wd_other)
+    db_other.repositories[0].done = True
+    workdir.update_repository(wd_other, db_other, db_other.repositories[0])
+
+    db_reloaded = workdir.read_database(wd)
+    assert db_reloaded is not db
+    assert db_reloaded.repositories[0].done